@@ -0,0 +1,8 @@
+import time
+from dotenv import load_dotenv
+
+# start of the cold start as the startup profile sees it, see api.startup
+IMPORT_STARTED = time.perf_counter()
+
+# once for the whole package, before any module reads its settings
+load_dotenv()
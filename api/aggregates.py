@@ -0,0 +1,272 @@
+"""
+Incremental per-sensor aggregates over fixed time windows.
+
+Every accepted reading updates count, min, max and sum per metric for each
+configured window size, so dashboards read the running values instead of
+re-scanning WeatherData (see queries/15_min_agg.sql). Closed windows can be
+persisted to the WeatherRollup table.
+"""
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from attrs import define, field, validators
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('Temperature', 'Pressure', 'Humidity', 'PM10', 'PM25')
+# columns of the per-window statistics array
+COUNT, MIN, MAX, SUM = range(4)
+
+series_count = metrics.gauge('aggregate_series', 'Sensor and window combinations being aggregated')
+late_dropped = metrics.counter('aggregate_late_readings_total',
+                               'Readings older than the aggregate history, not aggregated')
+rollups_written = metrics.counter('aggregate_rollup_rows_total',
+                                  'Closed window rows written to the rollup table')
+rollups_failed = metrics.counter('aggregate_rollup_rows_failed_total',
+                                 'Closed window rows lost because the rollup write failed')
+
+
+def _parse_windows(value: str) -> Tuple[int, ...]:
+    return tuple(sorted({int(part) for part in value.split(',') if part.strip()}))
+
+
+def parse_metric_values(value: str, setting: str) -> Dict[str, float]:
+    """``Temperature=0.2,Pressure=50`` -> {'Temperature': 0.2, 'Pressure': 50.0}
+
+    Raises:
+        ValueError: For an unknown metric or a negative value
+    """
+    values = {}
+    for part in value.split(','):
+        if not part.strip():
+            continue
+        name, _, number = part.partition('=')
+        name = name.strip()
+        if name not in METRICS:
+            raise ValueError(f"Unknown measurement {name!r} in {setting}, expected one of {METRICS}")
+        values[name] = float(number)
+        if values[name] < 0:
+            raise ValueError(f"{setting} of {name} must not be negative")
+    return values
+
+
+@define
+class WindowSeries:
+    """Ring buffer of the last ``history`` windows of one sensor and window size."""
+    window: int
+    history: int
+    starts: np.ndarray = field(init=False)
+    stats: np.ndarray = field(init=False)
+    current: int = field(init=False, default=-1)
+    closed: bool = field(init=False, default=False)
+
+    def __attrs_post_init__(self):
+        self.starts = np.full(self.history, -1, dtype=np.int64)
+        self.stats = np.zeros((self.history, len(METRICS), 4))
+
+    def _slot(self, start: int) -> int:
+        return (start // self.window) % self.history
+
+    def update(self, timestamp: float, values: np.ndarray) -> Optional[Tuple[int, np.ndarray]]:
+        """Add one reading, NaN where a metric is missing.
+
+        Returns:
+            Optional[Tuple[int, np.ndarray]]: Start and statistics of the window
+                this reading closed, if any
+        """
+        start = int(timestamp // self.window) * self.window
+        slot = self._slot(start)
+        closed = None
+        if start > self.current:
+            if self.current >= 0 and not self.closed:
+                closed = (self.current, self.get(self.current))
+            self.current = start
+            self.closed = False
+            self.starts[slot] = start
+            self.stats[slot, :, COUNT] = 0
+            self.stats[slot, :, MIN] = np.nan
+            self.stats[slot, :, MAX] = np.nan
+            self.stats[slot, :, SUM] = 0
+        elif self.starts[slot] != start:
+            late_dropped.inc()
+            return None
+
+        present = ~np.isnan(values)
+        row = self.stats[slot]
+        row[:, COUNT] += present
+        # fmin/fmax ignore NaN, so a missing value never replaces a real one
+        row[:, MIN] = np.fmin(row[:, MIN], values)
+        row[:, MAX] = np.fmax(row[:, MAX], values)
+        row[:, SUM] += np.where(present, values, 0.0)
+        return closed
+
+    def windows(self, limit: int) -> List[Tuple[int, np.ndarray]]:
+        """Newest first, at most ``limit`` windows."""
+        result = []
+        if self.current < 0:
+            return result
+        for k in range(min(limit, self.history)):
+            start = self.current - k * self.window
+            stats = self.get(start)
+            if stats is not None:
+                result.append((start, stats))
+        return result
+
+    def get(self, start: int) -> Optional[np.ndarray]:
+        slot = self._slot(start)
+        return self.stats[slot].copy() if self.starts[slot] == start else None
+
+
+def summarize(stats: np.ndarray) -> Dict[str, Optional[dict]]:
+    """Per metric count, min, max and mean, None for metrics without readings."""
+    summary = {}
+    for i, name in enumerate(METRICS):
+        count = int(stats[i, COUNT])
+        if count == 0:
+            summary[name] = None
+            continue
+        summary[name] = {
+            'count': count,
+            'min': float(stats[i, MIN]),
+            'max': float(stats[i, MAX]),
+            'mean': float(stats[i, SUM]) / count
+        }
+    return summary
+
+
+@define
+class Aggregator:
+    """Running aggregates per sensor (``esp8266id``) and window size.
+
+    Fed from the ingest path on the event loop. Windows are aligned to the
+    epoch and keyed by their start time; readings that fall into a window
+    older than the ring buffer are dropped and counted. A window is closed
+    when its sensor reports in a later window, or by the periodic sweep once
+    its end has passed; closed windows are queued for ``rollup_sink``.
+    """
+    windows: Tuple[int, ...] = field(
+        factory=lambda: _parse_windows(os.getenv("AGG_WINDOWS", "60,900,3600")),
+        converter=lambda value: _parse_windows(value) if isinstance(value, str) else tuple(value)
+    )
+    history: int = field(
+        factory=lambda: int(os.getenv("AGG_HISTORY", 96)),
+        converter=int,
+        validator=validators.gt(0)
+    )
+    rollup_interval: float = field(
+        factory=lambda: float(os.getenv("AGG_ROLLUP_INTERVAL_S", 60)),
+        converter=float,
+        validator=validators.gt(0)
+    )
+    _series: Dict[Tuple[str, int], WindowSeries] = field(init=False, factory=dict)
+    _closed: List[dict] = field(init=False, factory=list)
+    _rollup_sink: Optional[Callable[[List[dict]], Awaitable[None]]] = field(init=False, default=None)
+    _rollup_task: Optional[asyncio.Task] = field(init=False, default=None)
+
+    def add(self, device_id: str, reading: dict, timestamp: Optional[float] = None):
+        """Add one transformed reading of ``device_id``, at ``timestamp`` or now."""
+        if timestamp is None:
+            timestamp = time.time()
+        values = np.array([np.nan if reading.get(name) is None else float(reading[name])
+                           for name in METRICS])
+        for window in self.windows:
+            key = (device_id, window)
+            series = self._series.get(key)
+            if series is None:
+                series = WindowSeries(window, self.history)
+                self._series[key] = series
+                series_count.set(len(self._series))
+            closed = series.update(timestamp, values)
+            if closed is not None:
+                self._close(device_id, window, *closed)
+
+    def query(self, window: int, device_id: Optional[str] = None,
+              limit: int = 1) -> Dict[str, List[dict]]:
+        """Latest ``limit`` windows per sensor, newest first.
+
+        Raises:
+            KeyError: If ``window`` is not an aggregated window size
+        """
+        if window not in self.windows:
+            raise KeyError(window)
+        result = {}
+        for (device, size), series in self._series.items():
+            if size != window or (device_id is not None and device != device_id):
+                continue
+            result[device] = [{'start': _isoformat(start), **summarize(stats)}
+                              for start, stats in series.windows(limit)]
+        return result
+
+    def sweep(self, now: Optional[float] = None):
+        """Close every window whose end has passed."""
+        if now is None:
+            now = time.time()
+        for (device, window), series in self._series.items():
+            if series.current >= 0 and not series.closed and series.current + window <= now:
+                series.closed = True
+                self._close(device, window, series.current, series.get(series.current))
+
+    def take_closed(self) -> List[dict]:
+        """Rollup rows of the windows closed since the last call (only kept once started)."""
+        rows, self._closed = self._closed, []
+        return rows
+
+    def _close(self, device_id: str, window: int, start: int, stats: np.ndarray):
+        if self._rollup_sink is None:
+            return
+        window_start = datetime.fromtimestamp(start, tz=timezone.utc).replace(tzinfo=None)
+        for name, summary in summarize(stats).items():
+            if summary is None:
+                continue
+            self._closed.append({
+                'DeviceId': device_id,
+                'WindowSeconds': window,
+                'WindowStart': window_start,
+                'Metric': name,
+                'Count': summary['count'],
+                'MinValue': summary['min'],
+                'MaxValue': summary['max'],
+                'MeanValue': summary['mean']
+            })
+
+    def start(self, rollup_sink: Callable[[List[dict]], Awaitable[None]]):
+        """Persist closed windows with ``rollup_sink`` every ``rollup_interval`` seconds."""
+        if self._rollup_task is not None:
+            return
+        self._rollup_sink = rollup_sink
+        self._rollup_task = asyncio.create_task(self._rollup_loop())
+
+    async def close(self):
+        """Stop the rollup task and persist the windows closed so far."""
+        if self._rollup_task is None:
+            return
+        self._rollup_task.cancel()
+        self._rollup_task = None
+        await self.write_rollups()
+
+    async def write_rollups(self):
+        """Sweep and hand the closed windows to the rollup sink."""
+        self.sweep()
+        rows = self.take_closed()
+        if not rows or self._rollup_sink is None:
+            return
+        try:
+            await self._rollup_sink(rows)
+            rollups_written.inc(len(rows))
+        except Exception as e:
+            rollups_failed.inc(len(rows))
+            logger.error(f"Error storing {len(rows)} rollup rows to database: {e}")
+
+    async def _rollup_loop(self):
+        while True:
+            await asyncio.sleep(self.rollup_interval)
+            await self.write_rollups()
+
+
+def _isoformat(start: int) -> str:
+    return datetime.fromtimestamp(start, tz=timezone.utc).isoformat()
@@ -0,0 +1,181 @@
+"""
+asyncio-native write path in front of SQLClient.
+"""
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, List, Optional, Set, Tuple
+from attrs import define, field, validators
+from api.sql_client import SQLClient
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+buffered_rows = metrics.gauge('db_buffered_rows', 'Rows waiting for the next batched insert')
+rows_dropped = metrics.counter('db_rows_dropped_total',
+                               'Rows dropped because the write buffer was full')
+
+
+@define
+class AsyncSQLClient:
+    """Buffers readings on the event loop and flushes them on a dedicated executor.
+
+    ``store_payload`` only appends to an in-memory buffer, so a slow
+    database never holds up a request. Batches are written by
+    ``SQLClient.insert_rows`` on a small thread pool of its own (at most
+    ``max_workers`` flushes in flight), which keeps database I/O off both
+    the event loop and the anyio threadpool that serves sync dependencies.
+    When the database falls behind by more than ``max_buffered_rows``, the
+    oldest rows are dropped and counted.
+    """
+    sql_client: SQLClient = field(kw_only=True)
+    max_workers: int = field(
+        kw_only=True,
+        factory=lambda: int(os.getenv("DB_MAX_WORKERS", 2)),
+        converter=int,
+        validator=validators.gt(0)
+    )
+    max_buffered_rows: int = field(
+        kw_only=True,
+        factory=lambda: int(os.getenv("DB_MAX_BUFFERED_ROWS", 10000)),
+        converter=int,
+        validator=validators.gt(0)
+    )
+    _buffer: List[dict] = field(init=False, factory=list)
+    _executor: Optional[ThreadPoolExecutor] = field(init=False, default=None)
+    _flush_task: Optional[asyncio.Task] = field(init=False, default=None)
+    _wakeup: Optional[asyncio.Event] = field(init=False, default=None)
+    _slots: Optional[asyncio.Semaphore] = field(init=False, default=None)
+    _inflight: Set[asyncio.Task] = field(init=False, factory=set)
+    _write_listeners: List[Callable[[], None]] = field(init=False, factory=list)
+
+    async def create_schema(self):
+        """Run the one-time schema migration without blocking the event loop."""
+        await self._run(self.sql_client.create_schema)
+
+    async def start(self):
+        """Start the executor and the task that flushes on size or time."""
+        if self._flush_task is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix="sql-writer")
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_workers)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Stop flushing on the timer, write what is buffered and shut the executor down."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        await self.flush()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def store_payload(self, payload_data: dict):
+        """Buffer one transformed reading for the next batched insert."""
+        await self.store_many([payload_data])
+
+    async def store_many(self, rows: List[dict]):
+        """Buffer a group of transformed readings for the next batched insert."""
+        self._buffer.extend(rows)
+        overflow = len(self._buffer) - self.max_buffered_rows
+        if overflow > 0:
+            del self._buffer[:overflow]
+            rows_dropped.inc(overflow)
+        buffered_rows.set(len(self._buffer))
+        if len(self._buffer) >= self.sql_client.flush_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Write all buffered rows now and wait for the insert to finish."""
+        rows = self._take_batch()
+        if rows:
+            await self._write(rows)
+
+    async def write_rows(self, rows: List[dict]):
+        """Insert ``rows`` right away, bypassing the buffer.
+
+        Raises:
+            Exception: If the insert failed, so the caller can retry
+        """
+        await self._run(self.sql_client.insert_rows, rows)
+        self._notify_written()
+
+    def add_write_listener(self, callback: Callable[[], None]):
+        """Call ``callback`` on the event loop after every committed insert."""
+        self._write_listeners.append(callback)
+
+    async def fetch_latest(self, device_id: Optional[str] = None,
+                           include_raw: bool = False) -> Optional[dict]:
+        """Newest reading, read on the writer executor."""
+        return await self._run(self.sql_client.fetch_latest, device_id, include_raw)
+
+    async def fetch_page(self,
+                         start: Optional[datetime],
+                         end: Optional[datetime],
+                         after: Optional[Tuple[datetime, int]],
+                         limit: int,
+                         device_id: Optional[str] = None,
+                         include_raw: bool = False) -> List[dict]:
+        """One keyset page of readings, see ``SQLClient.fetch_page``."""
+        return await self._run(self.sql_client.fetch_page,
+                               start, end, after, limit, device_id, include_raw)
+
+    async def write_rollups(self, rows: List[dict]):
+        """Insert closed aggregate windows on the writer executor.
+
+        Raises:
+            Exception: If the insert failed
+        """
+        await self._run(self.sql_client.insert_rollups, rows)
+
+    def _notify_written(self):
+        for callback in self._write_listeners:
+            callback()
+
+    def _take_batch(self) -> List[dict]:
+        rows, self._buffer = self._buffer, []
+        buffered_rows.set(0)
+        return rows
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def _flush_loop(self):
+        interval = self.sql_client.flush_interval_ms / 1000
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._buffer:
+                continue
+
+            # wait for a free writer, the buffer keeps filling meanwhile
+            await self._slots.acquire()
+            rows = self._take_batch()
+            if not rows:
+                # flush() took the rows while we waited
+                self._slots.release()
+                continue
+            task = asyncio.create_task(self._write(rows, release_slot=True))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _write(self, rows: List[dict], release_slot: bool = False):
+        try:
+            await self._run(self.sql_client.insert_rows, rows)
+            self._notify_written()
+        except Exception as e:
+            logger.error(f"Error storing {len(rows)} rows to database: {e}")
+        finally:
+            if release_slot:
+                self._slots.release()
@@ -0,0 +1,202 @@
+"""
+Per-device credentials and request rate limiting.
+
+Credentials are loaded once into dictionaries, so checking a request costs
+a lookup and a constant-time compare. Secrets can be stored as PBKDF2
+hashes; a hash is only verified the first time a secret is seen, later
+requests compare a keyed digest of the secret kept in memory.
+"""
+import os
+import json
+import time
+import hmac
+import hashlib
+import secrets
+import logging
+from typing import Dict, Optional, Tuple
+from attrs import define, field, validators
+
+logger = logging.getLogger(__name__)
+
+HASH_SCHEME = 'pbkdf2_sha256'
+HASH_ITERATIONS = 600_000
+
+# compared against when the username is unknown, so both paths cost the same
+_DUMMY_SECRET = secrets.token_bytes(16)
+
+
+def hash_secret(secret: str, iterations: int = HASH_ITERATIONS) -> str:
+    """Hash ``secret`` for the credentials file.
+
+    Returns:
+        str: ``pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>``
+    """
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', secret.encode(), salt, iterations)
+    return f"{HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def verify_hash(secret: str, encoded: str) -> bool:
+    """Check ``secret`` against a value produced by ``hash_secret``."""
+    try:
+        scheme, iterations, salt, expected = encoded.split('$')
+    except ValueError:
+        return False
+    if scheme != HASH_SCHEME:
+        return False
+    digest = hashlib.pbkdf2_hmac('sha256', secret.encode(), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(digest.hex(), expected)
+
+
+def api_key_digest(api_key: str) -> str:
+    """SHA-256 hex digest under which an API key is stored and looked up."""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+@define
+class Credential:
+    """Secret of one device, either in plain text or as a PBKDF2 hash."""
+    username: str
+    password: Optional[str] = None
+    password_hash: Optional[str] = None
+
+    @property
+    def is_hashed(self) -> bool:
+        return self.password_hash is not None
+
+
+@define
+class CredentialStore:
+    """Device credentials and API keys, looked up in constant time.
+
+    ``API_USERNAME``/``API_PASSWORD`` remain a single device. More devices
+    come from ``API_CREDENTIALS_FILE``, a JSON list of objects with a
+    ``username`` and one of ``password``, ``password_hash`` (see
+    ``hash_secret``), ``api_key`` or ``api_key_sha256``.
+    """
+    credentials: Dict[str, Credential] = field(factory=dict)
+    api_keys: Dict[str, str] = field(factory=dict)
+    # per-process key, cached digests are useless outside this process
+    _cache_key: bytes = field(init=False, factory=lambda: secrets.token_bytes(32))
+    _verified: Dict[str, bytes] = field(init=False, factory=dict)
+
+    @classmethod
+    def from_env(cls) -> 'CredentialStore':
+        store = cls()
+        username = os.getenv("API_USERNAME", '')
+        password = os.getenv("API_PASSWORD", '')
+        path = os.getenv("API_CREDENTIALS_FILE", '')
+        if username or not path:
+            store.add(Credential(username, password=password))
+
+        if path:
+            with open(path, encoding='utf-8') as f:
+                entries = json.load(f)
+            for entry in entries:
+                store.add_entry(entry)
+            logger.info(f"Loaded {len(entries)} device credentials from {path}")
+        return store
+
+    def add(self, credential: Credential):
+        self.credentials[credential.username] = credential
+        self._verified.pop(credential.username, None)
+
+    def add_entry(self, entry: dict):
+        """Add one entry of the credentials file.
+
+        Raises:
+            ValueError: If the entry has no username or no secret
+        """
+        username = entry.get('username')
+        if not username:
+            raise ValueError(f"Credential entry without a username: {sorted(entry)}")
+        if 'api_key' in entry:
+            self.api_keys[api_key_digest(entry['api_key'])] = username
+        elif 'api_key_sha256' in entry:
+            self.api_keys[entry['api_key_sha256'].lower()] = username
+        elif 'password' in entry or 'password_hash' in entry:
+            self.add(Credential(username,
+                                password=entry.get('password'),
+                                password_hash=entry.get('password_hash')))
+        else:
+            raise ValueError(f"Credential entry for {username} has no secret")
+
+    def cached(self, username: str, password: str) -> Tuple[Optional[Credential], bool]:
+        """Check a username and password without hashing.
+
+        Returns:
+            Tuple[Optional[Credential], bool]: The device's credential (None if
+                unknown) and whether the password is accepted. A hashed
+                credential that has not been seen with this password yet
+                returns False and needs ``verify_slow``.
+        """
+        credential = self.credentials.get(username)
+        if credential is None:
+            secrets.compare_digest(password.encode(), _DUMMY_SECRET)
+            return None, False
+        if not credential.is_hashed:
+            return credential, secrets.compare_digest(password.encode(), credential.password.encode())
+        known = self._verified.get(username)
+        if known is None:
+            return credential, False
+        return credential, hmac.compare_digest(known, self._digest(password))
+
+    def verify_slow(self, credential: Credential, password: str) -> bool:
+        """Verify against the stored hash and remember the result.
+
+        CPU bound, run it off the event loop.
+        """
+        if not verify_hash(password, credential.password_hash):
+            return False
+        self._verified[credential.username] = self._digest(password)
+        return True
+
+    def lookup_api_key(self, api_key: str) -> Optional[str]:
+        """Return the device an API key belongs to, if any."""
+        return self.api_keys.get(api_key_digest(api_key))
+
+    def _digest(self, password: str) -> bytes:
+        return hmac.digest(self._cache_key, password.encode(), 'sha256')
+
+
+@define
+class RateLimiter:
+    """Token bucket per device, kept in memory.
+
+    ``rate`` requests per second are allowed on average, with bursts of up
+    to ``burst``. A rate of 0 disables the limit.
+    """
+    rate: float = field(
+        factory=lambda: float(os.getenv("AUTH_RATE_LIMIT", 0)),
+        converter=float,
+        validator=validators.ge(0.0)
+    )
+    burst: float = field(
+        factory=lambda: float(os.getenv("AUTH_RATE_BURST", 10)),
+        converter=float,
+        validator=validators.gt(0.0)
+    )
+    _buckets: Dict[str, Tuple[float, float]] = field(init=False, factory=dict)
+
+    def acquire(self, key: str) -> float:
+        """Take a token for ``key``.
+
+        Returns:
+            float: 0 if the request may proceed, otherwise the seconds until
+                the next token is available
+        """
+        if self.rate == 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[key] = (tokens - 1, now)
+        return 0.0
+
+
+if __name__ == '__main__':
+    from getpass import getpass
+    print(hash_secret(getpass("Secret to hash: ")))
@@ -0,0 +1,79 @@
+"""
+TTL/LRU cache for encoded read responses.
+"""
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Hashable, Optional, Tuple
+from attrs import define, field, validators
+from api import metrics
+
+cache_hits = metrics.counter('read_cache_hits_total', 'Read responses served from the cache')
+cache_misses = metrics.counter('read_cache_misses_total', 'Read responses fetched from the database')
+cache_entries = metrics.gauge('read_cache_entries', 'Read responses held in the cache')
+
+
+@define
+class ResponseCache:
+    """Encoded responses keyed by query, evicted by age and least recent use.
+
+    Every entry records the end of the time range it covers (None when the
+    range is open, as for "latest"). ``invalidate`` drops the entries new
+    rows could belong to and keeps closed historical ranges.
+    """
+    maxsize: int = field(
+        factory=lambda: int(os.getenv("READ_CACHE_SIZE", 256)),
+        converter=int,
+        validator=validators.ge(0)
+    )
+    ttl: float = field(
+        factory=lambda: float(os.getenv("READ_CACHE_TTL_S", 5)),
+        converter=float,
+        validator=validators.ge(0.0)
+    )
+    _entries: 'OrderedDict[Hashable, Tuple[float, Optional[datetime], bytes]]' = field(
+        init=False, factory=OrderedDict)
+    _generation: int = field(init=False, default=0)
+
+    @property
+    def generation(self) -> int:
+        """Bumped by every ``invalidate``; pass it to ``put`` to skip results fetched before."""
+        return self._generation
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+                cache_entries.set(len(self._entries))
+            cache_misses.inc()
+            return None
+        self._entries.move_to_end(key)
+        cache_hits.inc()
+        return entry[2]
+
+    def put(self, key: Hashable, value: bytes, end: Optional[datetime] = None,
+            generation: Optional[int] = None):
+        if self.maxsize == 0 or self.ttl == 0:
+            return
+        if generation is not None and generation != self._generation:
+            # rows were written while this result was being read
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, end, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        cache_entries.set(len(self._entries))
+
+    def invalidate(self, since: Optional[datetime] = None):
+        """Drop entries whose range is open or ends at or after ``since``, all if None."""
+        self._generation += 1
+        if since is None:
+            self._entries.clear()
+        else:
+            stale = [key for key, (_, end, _) in self._entries.items()
+                     if end is None or end >= since]
+            for key in stale:
+                del self._entries[key]
+        cache_entries.set(len(self._entries))
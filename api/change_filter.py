@@ -0,0 +1,144 @@
+"""
+Change detection between the transformer and the MQTT and SQL sinks.
+
+Sensors post their full reading every interval whether or not anything
+moved. With a deadband per measurement and/or a minimum interval per
+device, only readings that changed enough are published (and, depending
+on ``FILTER_SQL_STORE``, stored), so broker messages and database rows
+grow with real change rather than with devices times posting frequency.
+The running aggregates still see every reading.
+"""
+import os
+import time
+import logging
+from typing import Dict, List, Optional
+import numpy as np
+from attrs import define, field, validators
+from api import metrics
+from api.aggregates import METRICS, parse_metric_values
+
+logger = logging.getLogger(__name__)
+
+SQL_STORE_MODES = ('changes', 'all', 'rollup')
+
+decisions = metrics.counter('filter_readings_total',
+                            'Readings passed or suppressed by the change filter')
+tracked_devices = metrics.gauge('filter_devices', 'Devices with change filter state')
+
+
+@define
+class ChangeFilter:
+    """Per-device deadband and minimum interval filter.
+
+    A reading passes when its device is new, when at least one measurement
+    with a deadband moved by more than the band since the last reading
+    that passed (or appeared or disappeared), or when ``max_interval``
+    seconds went by without one. Within ``min_interval`` seconds of the
+    last reading that passed nothing does. Measurements without a deadband
+    are not compared; without any deadband, only the intervals apply.
+
+    The last passed values and times live in two numpy arrays with one row
+    per device, so thousands of devices cost a few hundred kilobytes.
+    """
+    deadbands: Dict[str, float] = field(
+        factory=lambda: parse_metric_values(os.getenv("FILTER_DEADBAND", ""), "FILTER_DEADBAND"),
+        converter=lambda value: (parse_metric_values(value, "FILTER_DEADBAND")
+                                 if isinstance(value, str) else dict(value))
+    )
+    min_interval: float = field(
+        factory=lambda: float(os.getenv("FILTER_MIN_INTERVAL_S", 0)),
+        converter=float,
+        validator=validators.ge(0.0)
+    )
+    max_interval: float = field(
+        factory=lambda: float(os.getenv("FILTER_MAX_INTERVAL_S", 0)),
+        converter=float,
+        validator=validators.ge(0.0)
+    )
+    sql_store: str = field(
+        factory=lambda: os.getenv("FILTER_SQL_STORE", "changes").strip().lower(),
+        validator=validators.in_(SQL_STORE_MODES)
+    )
+    _bands: np.ndarray = field(init=False)
+    _compared: np.ndarray = field(init=False)
+    _rows: Dict[str, int] = field(init=False, factory=dict)
+    _values: np.ndarray = field(init=False)
+    _times: np.ndarray = field(init=False)
+
+    def __attrs_post_init__(self):
+        self._bands = np.array([self.deadbands.get(name, np.inf) for name in METRICS])
+        self._compared = np.array([name in self.deadbands for name in METRICS])
+        self._values = np.full((16, len(METRICS)), np.nan)
+        self._times = np.zeros(16)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.deadbands) or self.min_interval > 0
+
+    def check(self, device_id: str, reading: dict, now: Optional[float] = None) -> bool:
+        """Decide whether ``reading`` passes and remember it if so.
+
+        Returns:
+            bool: True if the reading should be published
+        """
+        if not self.enabled:
+            return True
+        if now is None:
+            now = time.monotonic()
+        values = np.array([np.nan if reading.get(name) is None else float(reading[name])
+                           for name in METRICS])
+        row = self._rows.get(device_id)
+        if row is None:
+            row = self._add_device(device_id)
+        elif not self._changed(row, values, now):
+            decisions.inc(decision='suppressed')
+            return False
+        self._values[row] = values
+        self._times[row] = now
+        decisions.inc(decision='passed')
+        return True
+
+    def select(self, results: List[dict], accepted: Optional[List[bool]] = None,
+               now: Optional[float] = None) -> List[bool]:
+        """``check`` every reading in order; readings not accepted are skipped and don't pass."""
+        if accepted is None:
+            accepted = [True] * len(results)
+        return [ok and self.check(result['DeviceId'], result, now)
+                for result, ok in zip(results, accepted)]
+
+    def forget(self, device_id: str):
+        """Drop the state of ``device_id``; its next reading passes."""
+        row = self._rows.pop(device_id, None)
+        if row is None:
+            return
+        # move the last row into the gap to keep the arrays dense
+        last = len(self._rows)
+        if row != last:
+            moved = next(device for device, index in self._rows.items() if index == last)
+            self._rows[moved] = row
+            self._values[row] = self._values[last]
+            self._times[row] = self._times[last]
+        tracked_devices.set(len(self._rows))
+
+    def _changed(self, row: int, values: np.ndarray, now: float) -> bool:
+        elapsed = now - self._times[row]
+        if self.min_interval and elapsed < self.min_interval:
+            return False
+        if self.max_interval and elapsed >= self.max_interval:
+            return True
+        if not self.deadbands:
+            return True
+        last = self._values[row]
+        appeared = np.isnan(last) != np.isnan(values)
+        # NaN compares False, so a measurement missing on both sides never counts
+        moved = np.abs(values - last) > self._bands
+        return bool(np.any(self._compared & (appeared | moved)))
+
+    def _add_device(self, device_id: str) -> int:
+        row = len(self._rows)
+        if row == len(self._times):
+            self._values = np.vstack([self._values, np.full_like(self._values, np.nan)])
+            self._times = np.concatenate([self._times, np.zeros_like(self._times)])
+        self._rows[device_id] = row
+        tracked_devices.set(len(self._rows))
+        return row
@@ -0,0 +1,39 @@
+"""
+Lossless line encoding shared by the spool files and the sink socket.
+
+Readings and rows go through orjson, with Decimal and datetime values
+tagged as ``{"$decimal": "21.30"}`` and ``{"$datetime": "..."}`` so they
+come back with the same type and precision. One newline-terminated JSON
+document per line, so both formats can be read back with ``readline``.
+"""
+import json
+from datetime import datetime
+from decimal import Decimal
+import orjson
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return {'$decimal': str(value)}
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _object_hook(obj: dict):
+    if len(obj) == 1:
+        if '$decimal' in obj:
+            return Decimal(obj['$decimal'])
+        if '$datetime' in obj:
+            return datetime.fromisoformat(obj['$datetime'])
+    return obj
+
+
+def encode_line(obj) -> bytes:
+    """Encode ``obj`` as one JSON line, keeping Decimal and datetime values exact."""
+    return orjson.dumps(obj, default=_default,
+                        option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def decode_line(line: bytes):
+    return json.loads(line, object_hook=_object_hook)
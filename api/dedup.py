@@ -0,0 +1,84 @@
+"""
+In-memory index of recently accepted readings, to drop retried posts.
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+from attrs import define, field, validators
+from api import metrics
+
+lookups = metrics.counter('dedup_lookups_total', 'Readings checked against the dedup index')
+duplicates = metrics.counter('dedup_duplicates_total', 'Readings dropped as duplicates of a recent post')
+hit_ratio = metrics.gauge('dedup_hit_ratio', 'Share of checked readings that were duplicates')
+index_size = metrics.gauge('dedup_index_entries', 'Readings held in the dedup index')
+
+DedupKey = Tuple[str, int, int]
+
+
+@define
+class DedupIndex:
+    """Bounded set of (esp8266id, content hash, time bucket) keys.
+
+    Firmware retries a POST that timed out with the same sensordatavalues,
+    so a retry within the same or the next ``window`` seconds is found with
+    two dictionary lookups. Keys expire after two windows and the oldest
+    are evicted beyond ``max_entries``; 0 disables the index.
+    """
+    window: float = field(
+        factory=lambda: float(os.getenv("DEDUP_WINDOW_S", 60)),
+        converter=float,
+        validator=validators.gt(0.0)
+    )
+    max_entries: int = field(
+        factory=lambda: int(os.getenv("DEDUP_MAX_ENTRIES", 100000)),
+        converter=int,
+        validator=validators.ge(0)
+    )
+    # insertion order is expiry order, the TTL is the same for every key
+    _entries: 'OrderedDict[Hashable, float]' = field(init=False, factory=OrderedDict)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def key(self, reading, now: Optional[float] = None) -> DedupKey:
+        """Key of a validated ``SensorReading`` in the current time bucket."""
+        if now is None:
+            now = time.time()
+        content = hash(tuple((value.value_type, value.value) for value in reading.sensordatavalues))
+        return reading.esp8266id, content, int(now // self.window)
+
+    def check_and_add(self, key: DedupKey) -> bool:
+        """Record ``key``.
+
+        Returns:
+            bool: True if the same reading was recorded in this or the previous bucket
+        """
+        now = time.monotonic()
+        self._expire(now)
+        device, content, bucket = key
+        lookups.inc()
+        is_duplicate = key in self._entries or (device, content, bucket - 1) in self._entries
+        if is_duplicate:
+            duplicates.inc()
+        else:
+            self._entries[key] = now + 2 * self.window
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            index_size.set(len(self._entries))
+        hit_ratio.set(duplicates.value() / lookups.value())
+        return is_duplicate
+
+    def discard(self, key: DedupKey):
+        """Forget ``key``, e.g. when the reading was not accepted after all."""
+        if self._entries.pop(key, None) is not None:
+            index_size.set(len(self._entries))
+
+    def _expire(self, now: float):
+        entries = self._entries
+        while entries:
+            oldest = next(iter(entries))
+            if entries[oldest] > now:
+                break
+            del entries[oldest]
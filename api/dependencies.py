@@ -1,34 +1,90 @@
-import os
-import secrets
-from dotenv import load_dotenv
-from fastapi import HTTPException, Depends, status
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
+import logging
+from fastapi import HTTPException, Depends, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.security import APIKeyHeader, HTTPBasic, HTTPBasicCredentials
+from .auth import CredentialStore, RateLimiter
+from .sink import SinkError, SinkUnavailable
+from . import metrics
 
+logger = logging.getLogger(__name__)
 
-load_dotenv()
 
-security = HTTPBasic()
+security = HTTPBasic(auto_error=False)
+api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
-API_USERNAME = os.getenv("API_USERNAME", '')
-API_PASSWORD = os.getenv("API_PASSWORD", '')
+credential_store = CredentialStore.from_env()
+rate_limiter = RateLimiter()
 
+auth_failures = metrics.counter('auth_failures_total', 'Requests rejected for bad credentials')
+rate_limited = metrics.counter('auth_rate_limited_total', 'Requests rejected by the per-device rate limit')
 
-def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)):
-    """Verify HTTP Basic Authentication credentials"""
-    # Ensure variables are str
-    username = str(credentials.username)
-    password = str(credentials.password)
-    api_user = str(API_USERNAME)
-    api_pass = str(API_PASSWORD)
 
-    is_username_correct = secrets.compare_digest(username, api_user)
-    is_password_correct = secrets.compare_digest(password, api_pass)
+def _unauthorized() -> HTTPException:
+    auth_failures.inc()
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid credentials",
+        headers={"WWW-Authenticate": "Basic"},
+    )
 
-    if not (is_username_correct and is_password_correct):
+
+async def _acquire(username: str) -> float:
+    if rate_limiter.rate == 0:
+        return 0.0
+    # imported here, the routers import this module
+    from .routers.sensor_readings import sink_client
+    if not sink_client.enabled:
+        return rate_limiter.acquire(username)
+    try:
+        # the workers share the sink's buckets, so the limit holds across them
+        return await sink_client.call('allow', username)
+    except (SinkError, SinkUnavailable) as e:
+        logger.warning(f"Rate limit checked by this worker only, sink unavailable: {e}")
+        return rate_limiter.acquire(username)
+
+
+async def verify_credentials(
+    request: Request,
+    credentials: HTTPBasicCredentials | None = Depends(security),
+    api_key: str | None = Depends(api_key_header),
+) -> str:
+    """Verify HTTP Basic credentials or an ``X-API-Key`` header.
+
+    Async, so it runs on the event loop instead of the threadpool. FastAPI
+    caches it per request, so the app-wide dependency and the route
+    parameters share one check.
+
+    Returns:
+        str: The authenticated device (username)
+
+    Raises:
+        HTTPException: 401 for missing or invalid credentials, 429 when the
+            device is over its rate limit
+    """
+    if api_key is not None:
+        username = credential_store.lookup_api_key(api_key)
+        if username is None:
+            raise _unauthorized()
+    elif credentials is not None:
+        username = str(credentials.username)
+        password = str(credentials.password)
+        credential, ok = credential_store.cached(username, password)
+        if not ok and credential is not None and credential.is_hashed:
+            # first request with this secret, PBKDF2 is too slow for the loop
+            ok = await run_in_threadpool(credential_store.verify_slow, credential, password)
+        if not ok:
+            raise _unauthorized()
+    else:
+        raise _unauthorized()
+
+    retry_after = await _acquire(username)
+    if retry_after:
+        rate_limited.inc()
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid credentials",
-            headers={"WWW-Authenticate": "Basic"},
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(max(1, round(retry_after)))},
         )
 
+    request.state.device = username
     return username
@@ -0,0 +1,80 @@
+"""
+Single-pass JSON encoding of transformed readings.
+
+A reading is serialized once with orjson and the same bytes go to MQTT and
+to the SQL ``RawData`` JSON column. The raw sensor payload is kept as an
+``orjson.Fragment`` of the JSON Pydantic produced, so it is embedded as-is
+instead of being parsed and encoded again.
+"""
+from decimal import Decimal
+from typing import Callable
+import orjson
+
+RawJSON = orjson.Fragment
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'msgpack': 'application/msgpack',
+    'cbor': 'application/cbor',
+}
+
+
+def _decimal_as_str(value):
+    # matches the json.dumps(default=str) payloads subscribers already parse
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decimal_as_number(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def raw_json(data: bytes | str) -> RawJSON:
+    """Wrap already-serialized JSON so that encoders embed it unchanged."""
+    return orjson.Fragment(data)
+
+
+def dumps(obj) -> bytes:
+    """Encode a payload for MQTT, Decimal values as strings."""
+    return orjson.dumps(obj, default=_decimal_as_str)
+
+
+def dumps_response(obj) -> bytes:
+    """Encode an HTTP response body, Decimal values as numbers."""
+    return orjson.dumps(obj, default=_decimal_as_number)
+
+
+def payload_encoder(payload_format: str) -> Callable[[object], bytes]:
+    """Return the MQTT payload encoder for ``payload_format``.
+
+    ``json`` keeps Decimal values as strings like ``dumps``, ``msgpack``
+    encodes them as floats and ``cbor`` as exact decimal fractions (tag 4).
+    The binary formats need the optional ``msgpack`` or ``cbor2`` package
+    and cannot embed a RawJSON fragment.
+
+    Raises:
+        ValueError: For an unknown format or a missing package
+    """
+    if payload_format == 'json':
+        return dumps
+    if payload_format == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            raise ValueError("MQTT_PAYLOAD_FORMAT=msgpack requires the msgpack package")
+        return lambda obj: msgpack.packb(obj, default=_decimal_as_number)
+    if payload_format == 'cbor':
+        try:
+            import cbor2
+        except ImportError:
+            raise ValueError("MQTT_PAYLOAD_FORMAT=cbor requires the cbor2 package")
+        return cbor2.dumps
+    raise ValueError(f"Payload format must be one of {tuple(CONTENT_TYPES)}, got {payload_format!r}")
+
+
+def json_serializer(obj) -> str:
+    """SQLAlchemy ``json_serializer`` that passes RawJSON fragments through."""
+    return orjson.dumps(obj, default=_decimal_as_str).decode()
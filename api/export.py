@@ -0,0 +1,235 @@
+"""
+Streaming export of WeatherData to Parquet or CSV.
+
+Rows are read in chunks of ``EXPORT_CHUNK_ROWS``, flattened (``RawData``
+becomes one typed column per sensor value type) and converted to an Arrow
+record batch, which the writer appends to the output right away. Memory
+stays at one chunk however long the exported range:
+
+    python -m api.export --start 2025-01-01 --end 2025-04-01 -o q1.parquet
+    python -m api.export --format csv --device 6786729 --last-days 7 > week.csv
+
+Parquet needs ``pyarrow``, pinned in requirements.txt; an environment
+without it can still write CSV, with the ``csv`` module.
+"""
+import io
+import os
+import csv
+import sys
+import logging
+import argparse
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+import orjson
+from api.transformer import DEFAULT_VALUE_TYPES
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 5000))
+FORMATS = ('parquet', 'csv')
+MEDIA_TYPES = {
+    'parquet': 'application/vnd.apache.parquet',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+# (name, precision, scale) of the DECIMAL columns, as in WeatherData
+DECIMAL_COLUMNS = (('Temperature', 5, 2), ('Pressure', 6, 2), ('Humidity', 5, 2),
+                   ('PM10', 6, 2), ('PM25', 6, 2))
+# sensordatavalues flattened from RawData, signal already has its own column
+RAW_VALUE_TYPES = tuple(name for name in DEFAULT_VALUE_TYPES if name != 'signal') + \
+    ('samples', 'min_micro', 'max_micro', 'interval')
+
+
+def column_names(raw: bool = True) -> List[str]:
+    names = ['Id', 'Timestamp', 'DeviceId', *(name for name, _, _ in DECIMAL_COLUMNS),
+             'Signal', 'Quality']
+    if raw:
+        names += ['software_version', *RAW_VALUE_TYPES]
+    return names
+
+
+def _float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_columns(rows: List[dict], raw: bool = True) -> Dict[str, list]:
+    """Turn WeatherData rows into one list per column of ``column_names(raw)``."""
+    columns = {name: [row.get(name) for row in rows] for name in column_names(raw=False)}
+    if not raw:
+        return columns
+    versions = []
+    values = {name: [None] * len(rows) for name in RAW_VALUE_TYPES}
+    for i, row in enumerate(rows):
+        payload = row.get('RawData')
+        if isinstance(payload, (str, bytes)):
+            payload = orjson.loads(payload)
+        if not payload:
+            versions.append(None)
+            continue
+        versions.append(payload.get('software_version'))
+        for entry in payload.get('sensordatavalues', ()):
+            column = values.get(entry.get('value_type'))
+            if column is not None:
+                column[i] = _float(entry.get('value'))
+    columns['software_version'] = versions
+    columns.update(values)
+    return columns
+
+
+def arrow_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def arrow_schema(raw: bool = True):
+    import pyarrow as pa
+    fields = [pa.field('Id', pa.int64(), nullable=False),
+              pa.field('Timestamp', pa.timestamp('ms'), nullable=False),
+              pa.field('DeviceId', pa.string())]
+    fields += [pa.field(name, pa.decimal128(precision, scale))
+               for name, precision, scale in DECIMAL_COLUMNS]
+    fields.append(pa.field('Signal', pa.int16()))
+    fields.append(pa.field('Quality', pa.string()))
+    if raw:
+        fields.append(pa.field('software_version', pa.string()))
+        fields += [pa.field(name, pa.float64()) for name in RAW_VALUE_TYPES]
+    return pa.schema(fields)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file collecting what the writer produced since the last ``take``."""
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data, self._parts = b''.join(self._parts), []
+        return data
+
+
+class ExportWriter:
+    """Incremental Parquet or CSV writer.
+
+    ``write`` and ``close`` return the bytes of the output produced so far,
+    so the caller can stream them to a file or an HTTP response. With
+    pyarrow every chunk becomes one record batch (one Parquet row group).
+    """
+
+    def __init__(self, fmt: str, raw: bool = True):
+        """
+        Raises:
+            ValueError: For an unknown format, or Parquet without pyarrow
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f"Export format must be one of {FORMATS}, got {fmt!r}")
+        self.format = fmt
+        self.raw = raw
+        self.rows = 0
+        self._sink = _ChunkSink()
+        self._writer = None
+        self._csv = None
+        if arrow_available():
+            self._schema = arrow_schema(raw)
+            if fmt == 'parquet':
+                import pyarrow.parquet as pq
+                self._writer = pq.ParquetWriter(self._sink, self._schema, compression='zstd')
+            else:
+                import pyarrow.csv as pacsv
+                self._writer = pacsv.CSVWriter(self._sink, self._schema)
+        elif fmt == 'parquet':
+            raise ValueError("Parquet export requires the pyarrow package")
+        else:
+            self._text = io.TextIOWrapper(self._sink, encoding='utf-8', newline='', write_through=True)
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(column_names(raw))
+
+    def write(self, rows: List[dict]) -> bytes:
+        columns = to_columns(rows, self.raw)
+        if self._writer is not None:
+            import pyarrow as pa
+            self._writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=self._schema))
+        else:
+            self._csv.writerows(zip(*(map(_csv_value, column) for column in columns.values())))
+        self.rows += len(rows)
+        return self._sink.take()
+
+    def close(self) -> bytes:
+        """Finish the output (the Parquet footer) and return its last bytes."""
+        if self._writer is not None:
+            self._writer.close()
+        return self._sink.take()
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def export(chunks: Iterable[List[dict]], output, fmt: str, raw: bool = True) -> int:
+    """Write every chunk of rows to the binary file ``output``.
+
+    Returns:
+        int: Rows written
+    """
+    writer = ExportWriter(fmt, raw)
+    for rows in chunks:
+        output.write(writer.write(rows))
+    output.write(writer.close())
+    return writer.rows
+
+
+def main(argv=None):
+    from api.rds import RDSConfig
+    from api.sql_client import SQLClient
+
+    parser = argparse.ArgumentParser(description="Export WeatherData to Parquet or CSV")
+    parser.add_argument('--format', choices=FORMATS, default=None,
+                        help="default: from the output file name, else csv")
+    parser.add_argument('--start', type=datetime.fromisoformat, help="inclusive lower bound on Timestamp")
+    parser.add_argument('--end', type=datetime.fromisoformat, help="exclusive upper bound on Timestamp")
+    parser.add_argument('--last-days', type=float, help="instead of --start, the last N days")
+    parser.add_argument('--device', help="esp8266id, all sensors if omitted")
+    parser.add_argument('--no-raw', action='store_true', help="leave out the columns flattened from RawData")
+    parser.add_argument('--chunk-rows', type=int, default=EXPORT_CHUNK_ROWS)
+    parser.add_argument('-o', '--output', default='-', help="file to write, - for stdout")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    fmt = args.format or ('parquet' if args.output.endswith('.parquet') else 'csv')
+    start = args.start
+    if args.last_days is not None:
+        start = datetime.now() - timedelta(days=args.last_days)
+    chunks = SQLClient(rds_config=RDSConfig()).stream_rows(
+        start, args.end, args.chunk_rows, device_id=args.device, include_raw=not args.no_raw)
+    if args.output == '-':
+        rows = export(chunks, sys.stdout.buffer, fmt, raw=not args.no_raw)
+    else:
+        with open(args.output, 'wb') as output:
+            rows = export(chunks, output, fmt, raw=not args.no_raw)
+    logger.info(f"Exported {rows} rows as {fmt}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
+import time
+import asyncio
 import logging
 import json
+from contextlib import asynccontextmanager
+from typing import Optional
 from fastapi import FastAPI, Depends, Request
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from .dependencies import verify_credentials
-from .routers import sensor_readings
+from .middleware import MetricsMiddleware
+from .routers import sensor_readings, metrics, export
+from .startup import profile
 
 
 # Set up logging
@@ -12,8 +18,108 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-app = FastAPI(dependencies=[Depends(verify_credentials)])
+# uvicorn and the Functions host enter the lifespan of the same app and Mangum
+# calls ensure_started; the first one opens the sinks and the others share them
+_lifespan_users = 0
+_sinks_started: Optional[asyncio.Task] = None
+
+
+async def _connect_mqtt():
+    with profile.phase('mqtt_connect'):
+        await sensor_readings.mqtt_publisher.connect()
+
+
+async def _prepare_sql():
+    await sensor_readings.sql_agent.start()
+    # builds the engine, the first connection also wakes a paused (serverless) database
+    with profile.phase('sql_schema'):
+        try:
+            await sensor_readings.sql_agent.create_schema()
+        except Exception as e:
+            # the database may be paused (serverless), inserts will report errors
+            logger.error(f"Could not verify database schema: {e}")
+
+
+async def start_sinks():
+    """Connect MQTT and SQL, open the spool and start the rollups."""
+    # the broker handshake and the database round trips overlap
+    await asyncio.gather(_connect_mqtt(), _prepare_sql())
+    with profile.phase('spool_open'):
+        await sensor_readings.spool.open()
+    if sensor_readings.spool.enabled:
+        # without a broker MQTT is skipped, as it is without the spool; a replayer
+        # would retry forever and retention would drop the segments as unreplayed
+        if sensor_readings.mqtt_publisher.broker:
+            sensor_readings.spool.add_sink('mqtt', sensor_readings.deliver_to_mqtt)
+        sensor_readings.spool.add_sink('sql', sensor_readings.deliver_to_sql)
+    if sensor_readings.AGG_ROLLUP:
+        sensor_readings.aggregator.start(sensor_readings.sql_agent.write_rollups)
+    sql_store = sensor_readings.change_filter.sql_store
+    if sql_store == 'rollup' and not sensor_readings.AGG_ROLLUP:
+        logger.warning("FILTER_SQL_STORE=rollup with AGG_ROLLUP off, nothing is stored in the database")
+    if sql_store != 'changes' and sensor_readings.spool.enabled:
+        logger.warning(f"FILTER_SQL_STORE={sql_store} is ignored with the spool, "
+                       f"both sinks deliver the readings that pass the filter")
+
+
+async def stop_sinks():
+    """Flush and close what ``start_sinks`` opened."""
+    await sensor_readings.spool.close()
+    await sensor_readings.aggregator.close()
+    await sensor_readings.mqtt_publisher.close()
+    await sensor_readings.sql_agent.close()
+
+
+async def _start():
+    with profile.phase('lifespan'):
+        if sensor_readings.sink_client.enabled:
+            # a worker of the multi-worker mode, the sink process owns the connections
+            with profile.phase('sink_connect'):
+                await sensor_readings.sink_client.open()
+        else:
+            await start_sinks()
+    logger.info(profile.report())
+
+
+async def _stop():
+    if sensor_readings.sink_client.enabled:
+        await sensor_readings.sink_client.close()
+    else:
+        await stop_sinks()
+
+
+async def ensure_started():
+    """Open the shared sink connections unless they are open already.
+
+    For hosts that run no lifespan, or one per request like Mangum: the
+    connections then stay open for the life of the process.
+    """
+    global _sinks_started
+    if _sinks_started is None:
+        _sinks_started = asyncio.create_task(_start())
+    await _sinks_started
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the shared sink connections once for the whole process."""
+    global _lifespan_users, _sinks_started
+    _lifespan_users += 1
+    try:
+        await ensure_started()
+        yield
+    finally:
+        _lifespan_users -= 1
+        if _lifespan_users == 0:
+            _sinks_started = None
+            await _stop()
+
+
+app = FastAPI(dependencies=[Depends(verify_credentials)], lifespan=lifespan)
 app.include_router(sensor_readings.app)
+app.include_router(metrics.app)
+app.include_router(export.app)
+app.add_middleware(MetricsMiddleware)
 
 
 # Custom validation error handler
@@ -46,13 +152,4 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     )
 
 
-# debug
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    logger.info(f"Incoming request: {request.method} {request.url}")
-    logger.info(f"Content-Type: {request.headers.get('content-type')}")
-
-    response = await call_next(request)
-    logger.info(f"Response status: {response.status_code}")
-
-    return response
+profile.record('import', time.perf_counter() - profile.started)
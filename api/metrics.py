@@ -0,0 +1,202 @@
+"""
+In-process metrics (counters, gauges and histograms) for the ingest pipeline.
+"""
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Sequence, Tuple
+from attrs import define, field
+
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# seconds, tuned for the sub-millisecond to multi-second range of our sinks
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels: dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+@define
+class Counter:
+    """Monotonically increasing value, optionally split by labels."""
+    name: str
+    description: str = ''
+    _values: Dict[LabelKey, float] = field(factory=dict)
+    _lock: threading.Lock = field(factory=threading.Lock)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0.0)
+
+
+@define
+class Gauge:
+    """Value that can go up and down, optionally split by labels."""
+    name: str
+    description: str = ''
+    _values: Dict[LabelKey, float] = field(factory=dict)
+    _lock: threading.Lock = field(factory=threading.Lock)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0.0)
+
+
+@define
+class HistogramSample:
+    """Bucket counts, sum and count for one label set of a histogram."""
+    bucket_counts: list
+    sum: float = 0.0
+    count: int = 0
+
+
+@define
+class Histogram:
+    """Distribution of observed values in cumulative buckets."""
+    name: str
+    description: str = ''
+    buckets: tuple = field(default=DEFAULT_BUCKETS)
+    _samples: Dict[LabelKey, HistogramSample] = field(factory=dict)
+    _lock: threading.Lock = field(factory=threading.Lock)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            sample = self._samples.get(key)
+            if sample is None:
+                sample = HistogramSample(bucket_counts=[0] * len(self.buckets))
+                self._samples[key] = sample
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample.bucket_counts[i] += 1
+                    break
+            sample.sum += value
+            sample.count += 1
+
+    def sample(self, **labels) -> HistogramSample:
+        return self._samples.get(_label_key(labels),
+                                 HistogramSample(bucket_counts=[0] * len(self.buckets)))
+
+
+REGISTRY: Dict[str, object] = {}
+_registry_lock = threading.Lock()
+
+
+def _get_or_create(cls, name: str, description: str, **kwargs):
+    with _registry_lock:
+        metric = REGISTRY.get(name)
+        if metric is None:
+            metric = cls(name, description, **kwargs)
+            REGISTRY[name] = metric
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} already registered as {type(metric).__name__}")
+        return metric
+
+
+def counter(name: str, description: str = '') -> Counter:
+    """Return the registered counter ``name``, creating it on first use."""
+    return _get_or_create(Counter, name, description)
+
+
+def gauge(name: str, description: str = '') -> Gauge:
+    """Return the registered gauge ``name``, creating it on first use."""
+    return _get_or_create(Gauge, name, description)
+
+
+def histogram(name: str, description: str = '', buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    """Return the registered histogram ``name``, creating it on first use."""
+    return _get_or_create(Histogram, name, description, buckets=buckets)
+
+
+@contextmanager
+def timer(metric: Histogram, **labels):
+    """Observe the duration of the ``with`` block in seconds."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric.observe(time.perf_counter() - started, **labels)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def snapshot() -> Dict[str, dict]:
+    """Plain-data copy of every registered metric, e.g. to render in another process."""
+    families = {}
+    for name, metric in sorted(REGISTRY.items()):
+        kind = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}[type(metric)]
+        with metric._lock:
+            if kind == 'histogram':
+                series = [[list(key), [list(sample.bucket_counts), sample.sum, sample.count]]
+                          for key, sample in metric._samples.items()]
+            else:
+                series = [[list(key), value] for key, value in metric._values.items()]
+        families[name] = {'kind': kind, 'description': metric.description,
+                          'buckets': list(getattr(metric, 'buckets', ())), 'series': series}
+    return families
+
+
+def render_prometheus(others: Sequence[Tuple[LabelKey, Dict[str, dict]]] = ()) -> str:
+    """Render every registered metric in the Prometheus text exposition format.
+
+    Args:
+        others: (extra labels, ``snapshot()``) of other processes, whose
+            series are rendered with those labels in the same families
+    """
+    sources = [((), snapshot())] + list(others)
+    names = sorted({name for _, families in sources for name in families})
+    lines = []
+    for name in names:
+        family = next(families[name] for _, families in sources if name in families)
+        kind, buckets = family['kind'], family['buckets']
+        if family['description']:
+            lines.append(f"# HELP {name} {family['description']}")
+        lines.append(f"# TYPE {name} {kind}")
+
+        for extra, families in sources:
+            for key, value in families.get(name, {}).get('series', ()):
+                key = tuple(tuple(pair) for pair in key) + extra
+                if kind != 'histogram':
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+                    continue
+                bucket_counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, bucket_counts):
+                    cumulative += bucket_count
+                    le = (('le', _format_value(bound)),)
+                    lines.append(f"{name}_bucket{_format_labels(key, le)} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,82 @@
+"""
+Pure ASGI request instrumentation with sampled debug logging.
+"""
+import os
+import time
+import random
+import logging
+from attrs import define, field, validators
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+requests_total = metrics.counter('http_requests_total', 'HTTP requests by route and status')
+request_duration = metrics.histogram('http_request_duration_seconds',
+                                     'HTTP request latency by route')
+
+
+@define
+class DebugSampler:
+    """Fraction of requests to log at INFO, adjustable at runtime.
+
+    Assigning ``rate`` is converted and validated like the constructor argument.
+    """
+    rate: float = field(
+        factory=lambda: float(os.getenv("DEBUG_SAMPLE_RATE", 0)),
+        converter=float,
+        validator=[validators.ge(0.0), validators.le(1.0)]
+    )
+
+    def sampled(self) -> bool:
+        # the common case (rate 0) costs one comparison
+        return self.rate > 0 and random.random() < self.rate
+
+
+debug_sampler = DebugSampler()
+
+
+class MetricsMiddleware:
+    """Records request count and latency per route template.
+
+    A plain ASGI middleware: no request/response wrappers and no extra task,
+    unlike ``@app.middleware("http")``.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            # the router stores the matched route in the shared scope
+            route = scope.get('route')
+            path = getattr(route, 'path', 'unmatched')
+            method = scope['method']
+            requests_total.inc(method=method, route=path, status=status_code)
+            request_duration.observe(elapsed, method=method, route=path)
+            if debug_sampler.sampled():
+                logger.info("%s %s -> %s in %.1f ms (content-type %s)",
+                            method, scope['path'], status_code, elapsed * 1000,
+                            _header(scope, b'content-type'))
+
+
+def _header(scope, name: bytes):
+    for key, value in scope.get('headers', ()):
+        if key == name:
+            return value.decode('latin-1')
+    return None
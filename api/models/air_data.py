@@ -10,7 +10,8 @@ class SensorDataValue(BaseModel):
 
 
 class SensorReading(BaseModel):
-    esp8266id: str = Field(..., example="6786729", description="Chip id")
+    # stored in the String(32) DeviceId columns, a longer id would fail the whole insert batch
+    esp8266id: str = Field(..., max_length=32, example="6786729", description="Chip id")
     software_version: str = Field(..., example="NRZ-2024-135", description="Software version of the sensor")
     sensordatavalues: List[SensorDataValue] = Field(
         ...,
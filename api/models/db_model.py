@@ -3,19 +3,30 @@ from sqlalchemy import (
     Table,
     Column,
     Integer,
+    SmallInteger,
+    String,
+    Float,
     DateTime,
     Index
     )
 from sqlalchemy.dialects.mssql import JSON, DECIMAL
-from sqlalchemy.sql import text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.sql import func
 from attrs import define, field
 
+# SQLite stores CURRENT_TIMESTAMP as text without microseconds, bound values
+# must use the same format for range and keyset comparisons to work
+_SQLITE_DATETIME = sqlite.DATETIME(
+    storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"
+)
+
 
 @define
 class WeatherData():
     metadata: MetaData = field(factory=MetaData)
     schema_name: str = field(default='dbo')
     weather_data: Table = field(init=False)
+    weather_rollup: Table = field(init=False)
 
     def __attrs_post_init__(self):
         """Initialize the tables with the given schema."""
@@ -23,11 +34,20 @@ class WeatherData():
             'WeatherData',
             self.metadata,
             Column('Id', Integer, primary_key=True, autoincrement=True),
-            Column('Timestamp', DateTime, server_default=text('GETDATE()'), nullable=False),
+            Column('Timestamp', DateTime().with_variant(_SQLITE_DATETIME, 'sqlite'),
+                   server_default=func.current_timestamp(), nullable=False),
             Column('Temperature', DECIMAL(5, 2), nullable=False),
             Column('Pressure', DECIMAL(6, 2), nullable=False),
             Column('Humidity', DECIMAL(5, 2), nullable=False),
-            Column('RawData', JSON, nullable=False),
+            # nullable for rows written before the device columns existed
+            Column('DeviceId', String(32), nullable=True),
+            Column('PM10', DECIMAL(6, 2), nullable=True),
+            Column('PM25', DECIMAL(6, 2), nullable=True),
+            Column('Signal', SmallInteger, nullable=True),
+            # measurements flagged as outliers, see api.quality
+            Column('Quality', String(64), nullable=True),
+            # optional, see DB_STORE_RAW_DATA
+            Column('RawData', JSON, nullable=True),
             schema=self.schema_name
         )
 
@@ -35,3 +55,26 @@ class WeatherData():
         Index('ix_weatherdata_timestamp_temp',
               self.weather_data.c.Timestamp,
               self.weather_data.c.Temperature)
+        # per-sensor range queries seek on the device first
+        Index('ix_weatherdata_device_timestamp',
+              self.weather_data.c.DeviceId,
+              self.weather_data.c.Timestamp)
+
+        # closed aggregate windows, one row per sensor, window and metric
+        self.weather_rollup = Table(
+            'WeatherRollup',
+            self.metadata,
+            Column('DeviceId', String(32), primary_key=True),
+            Column('WindowSeconds', Integer, primary_key=True),
+            Column('WindowStart', DateTime, primary_key=True),
+            Column('Metric', String(16), primary_key=True),
+            Column('Count', Integer, nullable=False),
+            Column('MinValue', Float, nullable=False),
+            Column('MaxValue', Float, nullable=False),
+            Column('MeanValue', Float, nullable=False),
+            schema=self.schema_name
+        )
+
+        Index('ix_weatherrollup_window',
+              self.weather_rollup.c.WindowSeconds,
+              self.weather_rollup.c.WindowStart)
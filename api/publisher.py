@@ -1,104 +1,515 @@
 import os
 import ssl
-import json
+import time
 import asyncio
-from typing import Optional
-import paho.mqtt.client as mqtt
+import threading
+import uuid
+from string import Formatter
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 import logging
 from abc import ABC
-from dotenv import load_dotenv
+from . import metrics, encoding
+from .rds import _to_bool
+
+if TYPE_CHECKING:
+    # paho is imported in connect(), an instance without a broker never loads it
+    import paho.mqtt.client as mqtt
+    from paho.mqtt.properties import Properties
 
-load_dotenv()
 logger = logging.getLogger(__name__)
 
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'reject')
+TOPIC_FIELDS = ('esp8266id', 'measurement')
+PROTOCOLS = ('3.1.1', '5')
+# reading field -> {measurement} topic segment
+MEASUREMENTS = {
+    'Temperature': 'temperature',
+    'Pressure': 'pressure',
+    'Humidity': 'humidity',
+    'PM10': 'pm10',
+    'PM25': 'pm25',
+    'Signal': 'signal',
+}
+
+queue_depth = metrics.gauge('mqtt_queue_depth', 'Messages waiting in the publish queue')
+messages_dropped = metrics.counter('mqtt_messages_dropped_total',
+                                   'Messages dropped before reaching the broker')
+messages_published = metrics.counter('mqtt_messages_published_total',
+                                     'Messages acknowledged by the broker')
+publish_batch_size = metrics.histogram('mqtt_publish_batch_size',
+                                       'Messages handed to the client per drain iteration',
+                                       buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+enqueue_to_ack = metrics.histogram('mqtt_enqueue_to_ack_seconds',
+                                   'Time from enqueue to broker acknowledgement')
+publish_to_ack = metrics.histogram('mqtt_publish_to_ack_seconds',
+                                   'Time from handing a message to the client to its PUBACK')
+inflight_messages = metrics.gauge('mqtt_inflight_messages',
+                                  'Messages handed to the client and not acknowledged yet')
+inflight_window = metrics.gauge('mqtt_inflight_window',
+                                'Configured maximum of unacknowledged QoS 1 messages on the wire')
+
+
+class PublishQueueFull(Exception):
+    """Raised when the publish queue is full and the overflow policy rejects."""
+    pass
+
 
 class DefaultPublisher(ABC):
     pass
 
 
+class _AckGroup:
+    """Resolves one ack future once every message of a reading is acknowledged."""
+    __slots__ = ('remaining', 'future')
+
+    def __init__(self, remaining: int, future: asyncio.Future):
+        self.remaining = remaining
+        self.future = future
+
+
 class MQTTPublisher(DefaultPublisher):
     def __init__(self):
-        self.client: Optional[mqtt.Client] = None
+        self.client: Optional['mqtt.Client'] = None
         self.broker = os.getenv('BROKER_HIVE', '')
         self.port = 8883
         self.username = os.getenv('MQTT_USERNAME', '')
         self.password = os.getenv('MQTT_PASSWORD', '')
         self.topic = os.getenv('MQTT_TOPIC', 'sensor_data')
+        # e.g. uns/weather/{esp8266id}/{measurement}, defaults to the single MQTT_TOPIC
+        self.topic_template = os.getenv('MQTT_TOPIC_TEMPLATE', '') or self.topic
+        self.payload_format = os.getenv('MQTT_PAYLOAD_FORMAT', 'json')
+        self.include_raw_data = _to_bool(os.getenv('MQTT_INCLUDE_RAW_DATA', 'true'))
+        self.protocol_version = os.getenv('MQTT_PROTOCOL', '5')
+        # stable for the life of the process, so the broker can resume its session
+        self.client_id = os.getenv('MQTT_CLIENT_ID', '') or f"sensor-api-{uuid.uuid4().hex[:12]}"
+        self.max_inflight = int(os.getenv('MQTT_MAX_INFLIGHT', 100))
+        self.max_queued = int(os.getenv('MQTT_MAX_QUEUED', 0))
+        self.session_expiry = int(os.getenv('MQTT_SESSION_EXPIRY', 3600))
+        self.message_expiry = int(os.getenv('MQTT_MESSAGE_EXPIRY', 0))
+        self.topic_alias_max = int(os.getenv('MQTT_TOPIC_ALIAS_MAX', 0))
+        self.keepalive = int(os.getenv('MQTT_KEEPALIVE', 60))
+        self.connect_timeout = float(os.getenv('MQTT_CONNECT_TIMEOUT', 5))
+        self.reconnect_min_delay = int(os.getenv('MQTT_RECONNECT_MIN_DELAY', 1))
+        self.reconnect_max_delay = int(os.getenv('MQTT_RECONNECT_MAX_DELAY', 120))
+        self.queue_maxsize = int(os.getenv('MQTT_QUEUE_MAXSIZE', 1000))
+        self.overflow_policy = os.getenv('MQTT_QUEUE_OVERFLOW', 'reject')
+        self.block_timeout = float(os.getenv('MQTT_QUEUE_BLOCK_TIMEOUT', 5))
+        self.batch_size = int(os.getenv('MQTT_BATCH_SIZE', 50))
         self.connected = False
 
-    def on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            self.connected = True
-            logger.info("Connected to MQTT broker")
-        else:
-            logger.error(f"Failed to connect to MQTT broker: {rc}")
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"MQTT_QUEUE_OVERFLOW must be one of {OVERFLOW_POLICIES}, "
+                             f"got {self.overflow_policy!r}")
+        if self.protocol_version not in PROTOCOLS:
+            raise ValueError(f"MQTT_PROTOCOL must be one of {PROTOCOLS}, "
+                             f"got {self.protocol_version!r}")
+        topic_fields = {name for _, name, _, _ in Formatter().parse(self.topic_template) if name}
+        if not topic_fields <= set(TOPIC_FIELDS):
+            raise ValueError(f"MQTT_TOPIC_TEMPLATE may only use {TOPIC_FIELDS}, "
+                             f"got {sorted(topic_fields)}")
+        self._topic_is_static = not topic_fields
+        self._per_measurement = 'measurement' in topic_fields
+        self._encode = encoding.payload_encoder(self.payload_format)
+        # the binary formats can't embed the pre-serialized RawData fragment
+        self._strip_raw_data = not self.include_raw_data or self.payload_format != 'json'
+        # content type and expiry travel as v5 PUBLISH properties, built in connect()
+        self._publish_properties: Optional['Properties'] = None
+        # topic -> (alias, properties) for this connection, see _publish_target
+        self._aliases: Dict[str, Tuple[int, 'Properties']] = {}
+        self._alias_limit = 0
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._drain_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connected_event: Optional[asyncio.Event] = None
+        # (enqueue time, publish time, ack group) of in-flight messages by mid, resolved in on_publish
+        self._pending: Dict[int, Tuple[float, float, Optional[_AckGroup]]] = {}
+        # (ack time, error) of PUBACKs that arrived before the drain task recorded the mid
+        self._early_acks: Dict[int, Tuple[float, Optional[Exception]]] = {}
+        self._pending_lock = threading.Lock()
+        # publish() return codes meaning paho took the message, set in connect()
+        self._accepted_rc: Tuple[int, ...] = ()
+
+    @property
+    def is_v5(self) -> bool:
+        return self.protocol_version == '5'
+
+    def _make_publish_properties(self, topic_alias: Optional[int] = None) -> 'Properties':
+        from paho.mqtt.packettypes import PacketTypes
+        from paho.mqtt.properties import Properties
+
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.ContentType = encoding.CONTENT_TYPES[self.payload_format]
+        if self.message_expiry > 0:
+            # a retained reading older than this is stale, the broker discards it
+            properties.MessageExpiryInterval = self.message_expiry
+        if topic_alias is not None:
+            properties.TopicAlias = topic_alias
+        return properties
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logger.error(f"Failed to connect to MQTT broker: {reason_code}")
+            return
+        if self.is_v5:
+            self._reset_topic_aliases(client, getattr(properties, 'TopicAliasMaximum', 0))
+        self.connected = True
+        self._set_connected_event(True)
+        logger.info(f"Connected to MQTT broker (session present: {flags.session_present})")
 
-    def on_disconnect(self, client, userdata, rc):
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
         self.connected = False
-        logger.info("Disconnected from MQTT broker")
+        self._set_connected_event(False)
+        if not reason_code.is_failure:
+            logger.info("Disconnected from MQTT broker")
+        else:
+            # paho's network loop reconnects on its own with backoff
+            logger.warning(f"Unexpected disconnect from MQTT broker ({reason_code}), reconnecting")
 
-    def on_publish(self, client, userdata, mid):
+    def on_publish(self, client, userdata, mid, reason_code, properties):
+        acked_at = time.monotonic()
+        error = None
+        if reason_code.is_failure:
+            messages_dropped.inc(reason='broker_rejected')
+            error = RuntimeError(f"MQTT broker rejected the message: {reason_code}")
+            logger.error(str(error))
+        with self._pending_lock:
+            pending = self._pending.pop(mid, None)
+            if pending is None:
+                # ack arrived before the drain task recorded the mid
+                self._early_acks[mid] = (acked_at, error)
+                return
+            inflight_messages.set(len(self._pending))
+        self._record_ack(*pending, acked_at, error)
         logger.debug(f"Message published with mid: {mid}")
 
+    def _record_ack(self, enqueued_at: float, published_at: float, ack: Optional[_AckGroup],
+                    acked_at: float, error: Optional[Exception] = None):
+        enqueue_to_ack.observe(acked_at - enqueued_at)
+        publish_to_ack.observe(acked_at - published_at)
+        if error is None:
+            messages_published.inc()
+        if ack is not None:
+            # early acks are recorded from the drain task, the rest from the network thread
+            with self._pending_lock:
+                ack.remaining -= 1
+                done = ack.remaining == 0
+            if error is not None:
+                self._loop.call_soon_threadsafe(self._resolve_ack, ack.future, error)
+            elif done:
+                self._loop.call_soon_threadsafe(self._resolve_ack, ack.future, None)
+
+    @staticmethod
+    def _can_restore_topics(client, message_cls) -> bool:
+        """Whether paho has the private state ``_reset_topic_aliases`` rewrites.
+
+        Checked once per client, aliases stay off for a paho-mqtt release
+        that renamed it (tested with 2.1).
+        """
+        return (hasattr(client, '_out_message_mutex') and hasattr(client, '_out_messages')
+                and hasattr(message_cls, '_topic'))
+
+    def _reset_topic_aliases(self, client, broker_maximum: int):
+        """Start a new alias table for this connection (called from the network thread).
+
+        Aliases only live as long as a connection, but paho resends unacked
+        messages after a reconnect as they were first published. Messages
+        that went out as an alias only get their full topic back before
+        that happens; this relies on paho calling on_connect first, and on
+        paho's private message store (see ``_can_restore_topics``).
+        """
+        with self._pending_lock:
+            by_alias = {alias: topic for topic, (alias, _) in self._aliases.items()}
+            self._aliases = {}
+            self._alias_limit = min(self.topic_alias_max, broker_maximum)
+        if not by_alias:
+            return
+        with client._out_message_mutex:
+            for message in client._out_messages.values():
+                alias = getattr(message.properties, 'TopicAlias', None)
+                if alias in by_alias:
+                    message._topic = by_alias[alias].encode('utf-8')
+                    message.properties = self._publish_properties
+
+    def _publish_target(self, topic: str) -> Tuple[str, Optional['Properties']]:
+        """Topic and properties to publish with, replacing known topics by their alias."""
+        if self._alias_limit == 0:
+            return topic, self._publish_properties
+        with self._pending_lock:
+            known = self._aliases.get(topic)
+            if known is not None:
+                # PUBLISH carries the 2-byte alias instead of the topic string
+                return '', known[1]
+            if len(self._aliases) < self._alias_limit:
+                alias = len(self._aliases) + 1
+                properties = self._make_publish_properties(topic_alias=alias)
+                self._aliases[topic] = (alias, properties)
+                # the first PUBLISH with the full topic sets up the alias on the broker
+                return topic, properties
+        return topic, self._publish_properties
+
+    @staticmethod
+    def _resolve_ack(ack: asyncio.Future, error: Optional[Exception]):
+        if ack.done():
+            return
+        if error is None:
+            ack.set_result(None)
+        else:
+            ack.set_exception(error)
+
+    def _set_connected_event(self, connected: bool):
+        """Mirror the paho connection state into the event loop (called from the network thread)."""
+        if self._loop is None or self._connected_event is None:
+            return
+        method = self._connected_event.set if connected else self._connected_event.clear
+        try:
+            self._loop.call_soon_threadsafe(method)
+        except RuntimeError:
+            # event loop already closed during shutdown
+            pass
+
     async def connect(self):
-        """Initialize and connect to MQTT broker"""
+        """Open the long-lived connection to the MQTT broker.
+
+        Called once at application startup. The paho network thread keeps
+        the connection alive and reconnects with exponential backoff
+        (``MQTT_RECONNECT_MIN_DELAY`` to ``MQTT_RECONNECT_MAX_DELAY``
+        seconds), so requests never open connections of their own. Also
+        starts the task that drains the publish queue.
+        """
         if not self.broker:
             logger.warning("MQTT broker not configured, skipping MQTT setup")
             return False
 
+        if self.client:
+            # already started, the network loop handles reconnects
+            return self.connected
+
+        if self.payload_format != 'json' and not self.is_v5:
+            logger.warning(f"MQTT_PAYLOAD_FORMAT={self.payload_format} without MQTT_PROTOCOL=5, "
+                           f"subscribers won't see the content type")
+
+        self._loop = asyncio.get_running_loop()
+        self._connected_event = asyncio.Event()
+        self._queue = asyncio.Queue(maxsize=self.queue_maxsize)
+        self._drain_task = asyncio.create_task(self._drain())
+
         try:
-            self.client = mqtt.Client()
+            import paho.mqtt.client as mqtt
+            from paho.mqtt.enums import CallbackAPIVersion
+            from paho.mqtt.packettypes import PacketTypes
+            from paho.mqtt.properties import Properties
+
+            self._accepted_rc = (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN)
+            if self.is_v5:
+                self._publish_properties = self._make_publish_properties()
+            self.client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2,
+                                      client_id=self.client_id,
+                                      protocol=mqtt.MQTTv5 if self.is_v5 else mqtt.MQTTv311)
             self.client.on_connect = self.on_connect
             self.client.on_disconnect = self.on_disconnect
             self.client.on_publish = self.on_publish
+            # QoS 1 throughput is bound by the unacknowledged messages allowed on the wire
+            self.client.max_inflight_messages_set(self.max_inflight)
+            self.client.max_queued_messages_set(self.max_queued)
+            inflight_window.set(self.max_inflight)
+            if self.topic_alias_max > 0 and not self._can_restore_topics(self.client, mqtt.MQTTMessage):
+                # aliased messages resent after a reconnect would reach the broker without a topic
+                logger.warning("This paho-mqtt version doesn't expose its in-flight messages, "
+                               "MQTT_TOPIC_ALIAS_MAX is ignored")
+                self.topic_alias_max = 0
 
             # Setup TLS
             self.client.tls_set(tls_version=ssl.PROTOCOL_TLS)
             self.client.username_pw_set(self.username, self.password)
+            self.client.reconnect_delay_set(min_delay=self.reconnect_min_delay,
+                                            max_delay=self.reconnect_max_delay)
 
-            # Connect to broker
-            self.client.connect_async(self.broker, self.port, 60)
+            # Connect to broker. With v5 the broker keeps the session for
+            # session_expiry seconds, so a reconnect resumes the in-flight
+            # messages instead of starting over
+            connect_properties = None
+            if self.is_v5:
+                connect_properties = Properties(PacketTypes.CONNECT)
+                connect_properties.SessionExpiryInterval = self.session_expiry
+                if self.topic_alias_max > 0:
+                    connect_properties.TopicAliasMaximum = self.topic_alias_max
+            self.client.connect_async(self.broker, self.port, self.keepalive,
+                                      clean_start=mqtt.MQTT_CLEAN_START_FIRST_ONLY,
+                                      properties=connect_properties)
             self.client.loop_start()
 
-            # Wait for connection with timeout
-            for _ in range(50):  # 5 second timeout
-                if self.connected:
-                    return True
-                await asyncio.sleep(0.1)
-
-            logger.error("Timeout waiting for MQTT connection")
-            return False
+            # Wait for connection with timeout, on_connect sets the event
+            try:
+                await asyncio.wait_for(self._connected_event.wait(), self.connect_timeout)
+                return True
+            except asyncio.TimeoutError:
+                logger.error("Timeout waiting for MQTT connection, retrying in background")
+                return False
 
         except Exception as e:
             logger.error(f"Error connecting to MQTT broker: {e}")
             return False
 
-    def publish_payload(self, payload_data: dict):
-        """Publish payload to MQTT topic"""
-        if not self.client or not self.connected:
-            logger.warning("MQTT client not connected, skipping publish")
-            return
+    async def publish_payload(self, payload_data: dict, wait_ack: bool = False) -> bool:
+        """Enqueue a payload for publishing to the MQTT topic.
+
+        Args:
+            payload_data: Transformed reading
+            wait_ack: Wait until the broker has acknowledged the message
 
+        Returns:
+            bool: True if the payload was queued (and acknowledged, with wait_ack)
+
+        Raises:
+            PublishQueueFull: If the queue is full and the overflow policy
+                is ``reject`` (or ``block`` timed out), or with wait_ack if
+                the message was dropped to make room
+        """
+        if self._queue is None:
+            logger.warning("MQTT publisher not started, skipping publish")
+            return False
+
+        ack = self._loop.create_future() if wait_ack else None
+        item = (time.monotonic(), payload_data, ack)
         try:
-            # Convert payload to JSON string
-            json_payload = json.dumps(payload_data, default=str)
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            if self.overflow_policy == 'reject':
+                messages_dropped.inc(reason='rejected')
+                raise PublishQueueFull(f"MQTT publish queue full ({self.queue_maxsize})")
+            if self.overflow_policy == 'drop_oldest':
+                _, _, dropped_ack = self._queue.get_nowait()
+                self._queue.task_done()
+                if dropped_ack is not None:
+                    self._resolve_ack(dropped_ack, PublishQueueFull("Dropped from full MQTT publish queue"))
+                messages_dropped.inc(reason='drop_oldest')
+                self._queue.put_nowait(item)
+            else:
+                try:
+                    await asyncio.wait_for(self._queue.put(item), self.block_timeout)
+                except asyncio.TimeoutError:
+                    messages_dropped.inc(reason='block_timeout')
+                    raise PublishQueueFull(f"MQTT publish queue full after {self.block_timeout}s")
+
+        queue_depth.set(self._queue.qsize())
+        if ack is not None:
+            await ack
+        return True
 
-            # Publish with QoS 1 for guaranteed delivery
-            result = self.client.publish(self.topic,
-                                         json_payload,
-                                         qos=1,
-                                         retain=True)
+    async def publish_many(self, payloads: List[dict]) -> List[bool]:
+        """Enqueue a group of payloads.
 
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                logger.debug(f"Payload published to {self.topic}")
+        Returns:
+            list: Per payload, False if the full queue rejected it
+        """
+        accepted = []
+        for payload_data in payloads:
+            try:
+                await self.publish_payload(payload_data)
+            except PublishQueueFull:
+                accepted.append(False)
             else:
-                logger.error(f"Failed to publish payload: {result.rc}")
+                accepted.append(True)
+        return accepted
 
+    async def _drain(self):
+        """Publish queued messages in batches while the broker is connected."""
+        while True:
+            item = await self._queue.get()
+            batch = [item]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            queue_depth.set(self._queue.qsize())
+
+            # hold the batch until the network loop has (re)connected
+            await self._connected_event.wait()
+            publish_batch_size.observe(len(batch))
+            for enqueued_at, payload_data, ack in batch:
+                self._publish_one(enqueued_at, payload_data, ack)
+                self._queue.task_done()
+            # let request handlers run between batches
+            await asyncio.sleep(0)
+
+    def _messages(self, payload_data: dict) -> List[Tuple[str, bytes]]:
+        """Topic and encoded payload of every message a reading is published as."""
+        device_id = payload_data.get('DeviceId') or 'unknown'
+        if self._per_measurement:
+            return [(self.topic_template.format(esp8266id=device_id, measurement=segment),
+                     self._encode(payload_data[name]))
+                    for name, segment in MEASUREMENTS.items()
+                    if payload_data.get(name) is not None]
+
+        if self._strip_raw_data:
+            payload_data = {key: value for key, value in payload_data.items() if key != 'RawData'}
+        topic = self.topic_template if self._topic_is_static \
+            else self.topic_template.format(esp8266id=device_id)
+        # encoded once, with JSON the raw sensor payload is embedded without re-encoding
+        return [(topic, self._encode(payload_data))]
+
+    def _publish_one(self, enqueued_at: float, payload_data: dict, ack: Optional[asyncio.Future]):
+        """Serialize a reading and hand its messages to the paho client."""
+        try:
+            messages = self._messages(payload_data)
         except Exception as e:
-            logger.error(f"Error publishing to MQTT: {e}")
+            messages_dropped.inc(reason='publish_error')
+            logger.error(f"Error encoding MQTT payload: {e}")
+            if ack is not None:
+                self._resolve_ack(ack, e)
+            return
+        if not messages:
+            if ack is not None:
+                self._resolve_ack(ack, None)
+            return
+
+        group = _AckGroup(len(messages), ack) if ack is not None else None
+        for topic, body in messages:
+            try:
+                publish_topic, properties = self._publish_target(topic)
+                published_at = time.monotonic()
+                # Publish with QoS 1 for guaranteed delivery
+                result = self.client.publish(publish_topic,
+                                             body,
+                                             qos=1,
+                                             retain=True,
+                                             properties=properties)
+
+                # NO_CONN means paho kept the message and sends it after reconnecting
+                if result.rc not in self._accepted_rc:
+                    raise RuntimeError(f"MQTT publish failed: {result.rc}")
+
+                with self._pending_lock:
+                    early_ack = self._early_acks.pop(result.mid, None)
+                    if early_ack is None:
+                        self._pending[result.mid] = (enqueued_at, published_at, group)
+                        inflight_messages.set(len(self._pending))
+                if early_ack is not None:
+                    self._record_ack(enqueued_at, published_at, group, *early_ack)
+                logger.debug(f"Payload published to {topic}")
+
+            except Exception as e:
+                messages_dropped.inc(reason='publish_error')
+                logger.error(f"Error publishing to MQTT: {e}")
+                if ack is not None:
+                    self._resolve_ack(ack, e)
+
+    async def close(self, timeout: float = 5.0):
+        """Flush the publish queue (up to ``timeout`` seconds) and disconnect."""
+        if self._queue is not None and self.connected:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"{self._queue.qsize()} MQTT messages not published at shutdown")
+        if self._drain_task is not None:
+            self._drain_task.cancel()
+            self._drain_task = None
+        self._queue = None
+        self.disconnect()
 
     def disconnect(self):
-        """Disconnect from MQTT broker"""
+        """Disconnect from MQTT broker. Called once at application shutdown."""
         if self.client:
-            self.client.loop_stop()
             self.client.disconnect()
+            self.client.loop_stop()
+            self.client = None
+            self.connected = False
@@ -0,0 +1,167 @@
+"""
+Streaming outlier detection on the live readings.
+
+``ValidationRanges`` only rejects physically impossible values. Glitches
+inside the valid range, such as a BME280 self-heating jump or an SDS011 PM
+spike, are caught here by comparing every measurement with an
+exponentially weighted mean and variance of the same device. The state is
+constant per device and a reading is checked in constant time, so quality
+improves on the way in instead of by re-scanning WeatherData later.
+"""
+import os
+import logging
+from typing import Dict, List
+import numpy as np
+from attrs import define, field, validators
+from api import metrics
+from api.aggregates import METRICS, parse_metric_values
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ('off', 'flag', 'suppress')
+# measurements every reading must have, a reading with one of them suppressed is dropped
+REQUIRED_METRICS = ('Temperature', 'Pressure', 'Humidity')
+DEFAULT_MIN_STD = "Temperature=0.5,Pressure=1,Humidity=2,PM10=5,PM25=5"
+
+outliers = metrics.counter('quality_outliers_total', 'Measurements flagged as outliers')
+readings_dropped = metrics.counter('quality_readings_dropped_total',
+                                   'Readings not published or stored because of an outlier')
+tracked_devices = metrics.gauge('quality_devices', 'Devices with outlier detection state')
+
+
+@define
+class QualityMonitor:
+    """Per-device EWMA outlier detector.
+
+    A measurement is an outlier when it is more than ``threshold``
+    standard deviations from the device's EWMA mean, once the device sent
+    ``warmup`` readings. The standard deviation never goes below
+    ``min_std`` of the measurement, so a sensor that reported the same
+    value for hours isn't flagged for its first 0.01 change. Outliers
+    don't update the statistics; after ``persistence`` outliers in a row
+    the value is taken as a real change and the mean restarts from it.
+
+    Flagged measurements are listed in the reading's ``Quality`` field,
+    e.g. ``"PM25"`` or ``"Temperature,Humidity"`` (None if all are fine).
+    With ``action="suppress"`` outlying PM values are also set to None and
+    readings with an outlying temperature, pressure or humidity are not
+    published or stored.
+    """
+    action: str = field(
+        factory=lambda: os.getenv("QUALITY_ACTION", "off").strip().lower(),
+        validator=validators.in_(ACTIONS)
+    )
+    alpha: float = field(
+        factory=lambda: float(os.getenv("QUALITY_ALPHA", 0.1)),
+        converter=float,
+        validator=[validators.gt(0.0), validators.le(1.0)]
+    )
+    threshold: float = field(
+        factory=lambda: float(os.getenv("QUALITY_THRESHOLD", 4)),
+        converter=float,
+        validator=validators.gt(0.0)
+    )
+    warmup: int = field(
+        factory=lambda: int(os.getenv("QUALITY_WARMUP", 10)),
+        converter=int,
+        validator=validators.ge(1)
+    )
+    persistence: int = field(
+        factory=lambda: int(os.getenv("QUALITY_PERSISTENCE", 3)),
+        converter=int,
+        validator=validators.ge(1)
+    )
+    min_std: Dict[str, float] = field(
+        factory=lambda: parse_metric_values(os.getenv("QUALITY_MIN_STD", DEFAULT_MIN_STD),
+                                            "QUALITY_MIN_STD"),
+        converter=lambda value: (parse_metric_values(value, "QUALITY_MIN_STD")
+                                 if isinstance(value, str) else dict(value))
+    )
+    _std_floor: np.ndarray = field(init=False)
+    _required: np.ndarray = field(init=False)
+    _rows: Dict[str, int] = field(init=False, factory=dict)
+    _mean: np.ndarray = field(init=False)
+    _var: np.ndarray = field(init=False)
+    _streak: np.ndarray = field(init=False)
+    _count: np.ndarray = field(init=False)
+
+    def __attrs_post_init__(self):
+        self._std_floor = np.array([self.min_std.get(name, 0.0) for name in METRICS])
+        self._required = np.array([name in REQUIRED_METRICS for name in METRICS])
+        self._mean = np.full((16, len(METRICS)), np.nan)
+        self._var = np.zeros((16, len(METRICS)))
+        self._streak = np.zeros((16, len(METRICS)), dtype=np.int32)
+        self._count = np.zeros(16, dtype=np.int64)
+
+    @property
+    def enabled(self) -> bool:
+        return self.action != 'off'
+
+    def check(self, device_id: str, reading: dict) -> bool:
+        """Flag the outliers of ``reading`` in place and update the device statistics.
+
+        Returns:
+            bool: False if the reading should be dropped
+        """
+        if not self.enabled:
+            return True
+        values = np.array([np.nan if reading.get(name) is None else float(reading[name])
+                           for name in METRICS])
+        row = self._rows.get(device_id)
+        if row is None:
+            row = self._add_device(device_id)
+        mean, var, streak = self._mean[row], self._var[row], self._streak[row]
+
+        present = ~np.isnan(values)
+        # the first value of a measurement seeds its mean
+        seed = present & np.isnan(mean)
+        mean[seed] = values[seed]
+        deviation = values - mean
+        std = np.maximum(np.sqrt(var), self._std_floor)
+        with np.errstate(invalid='ignore'):
+            outlier = present & ~seed & (np.abs(deviation) > self.threshold * std)
+        if self._count[row] < self.warmup:
+            outlier[:] = False
+        streak[outlier] += 1
+        streak[~outlier] = 0
+        # the same jump several times in a row is a real change, restart from it
+        shifted = streak >= self.persistence
+        mean[shifted] = values[shifted]
+        streak[shifted] = 0
+        outlier &= ~shifted
+
+        update = present & ~seed & ~outlier & ~shifted
+        mean[update] += self.alpha * deviation[update]
+        var[update] = (1 - self.alpha) * (var[update] + self.alpha * deviation[update] ** 2)
+        self._count[row] += 1
+
+        if not outlier.any():
+            reading['Quality'] = None
+            return True
+        flagged = [name for name, flag in zip(METRICS, outlier) if flag]
+        reading['Quality'] = ','.join(flagged)
+        for name in flagged:
+            outliers.inc(measurement=name)
+        if self.action != 'suppress':
+            return True
+        if (outlier & self._required).any():
+            readings_dropped.inc()
+            return False
+        for name in flagged:
+            reading[name] = None
+        return True
+
+    def check_many(self, results: List[dict]) -> List[bool]:
+        """``check`` every reading in order."""
+        return [self.check(result['DeviceId'], result) for result in results]
+
+    def _add_device(self, device_id: str) -> int:
+        row = len(self._rows)
+        if row == len(self._count):
+            self._mean = np.vstack([self._mean, np.full_like(self._mean, np.nan)])
+            self._var = np.vstack([self._var, np.zeros_like(self._var)])
+            self._streak = np.vstack([self._streak, np.zeros_like(self._streak)])
+            self._count = np.concatenate([self._count, np.zeros_like(self._count)])
+        self._rows[device_id] = row
+        tracked_devices.set(len(self._rows))
+        return row
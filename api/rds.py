@@ -2,11 +2,22 @@
 MSSQLTips.com General database connection configuration class
 """
 import os
+import threading
+from typing import Optional
 from attrs import define, field, validators
+from sqlalchemy import event
 from sqlalchemy.engine import Engine, create_engine, URL
-from dotenv import load_dotenv
+from sqlalchemy.pool import StaticPool
+from api import metrics, encoding
 
-load_dotenv()
+pool_checked_out = metrics.gauge('db_pool_checked_out', 'Connections currently checked out of the pool')
+
+
+def _to_bool(value) -> bool:
+    """Convert an environment variable value such as 'true', '1' or 'no' to bool."""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
 
 
 @define
@@ -36,9 +47,66 @@ class RDSConfig:
         factory=lambda: os.getenv("DB_DRIVER", "mssql+pyodbc"),
         validator=validators.instance_of(str)
     )
+    DB_ODBC_DRIVER: str = field(
+        factory=lambda: os.getenv("DB_ODBC_DRIVER", "ODBC Driver 18 for SQL Server"),
+        validator=validators.instance_of(str)
+    )
+    DB_ENCRYPT: str = field(
+        factory=lambda: os.getenv("DB_ENCRYPT", "no"),
+        validator=validators.in_(("yes", "no", "mandatory", "optional", "strict"))
+    )
+    DB_TRUST_SERVER_CERTIFICATE: str = field(
+        factory=lambda: os.getenv("DB_TRUST_SERVER_CERTIFICATE", "yes"),
+        validator=validators.in_(("yes", "no"))
+    )
+    DB_CONNECT_TIMEOUT: int = field(
+        factory=lambda: int(os.getenv("DB_CONNECT_TIMEOUT", 30)),
+        converter=int,
+        validator=[validators.instance_of(int), validators.ge(0)]
+    )
+    DB_POOL_SIZE: int = field(
+        factory=lambda: int(os.getenv("DB_POOL_SIZE", 5)),
+        converter=int,
+        validator=[validators.instance_of(int), validators.gt(0)]
+    )
+    DB_MAX_OVERFLOW: int = field(
+        factory=lambda: int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        converter=int,
+        validator=[validators.instance_of(int), validators.ge(0)]
+    )
+    DB_POOL_TIMEOUT: float = field(
+        factory=lambda: float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        converter=float,
+        validator=[validators.instance_of(float), validators.gt(0)]
+    )
+    # serverless Azure SQL closes idle connections, recycle before that happens
+    DB_POOL_RECYCLE: int = field(
+        factory=lambda: int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        converter=int,
+        validator=validators.instance_of(int)
+    )
+    DB_POOL_PRE_PING: bool = field(
+        factory=lambda: os.getenv("DB_POOL_PRE_PING", "true"),
+        converter=_to_bool,
+        validator=validators.instance_of(bool)
+    )
+    DB_FAST_EXECUTEMANY: bool = field(
+        factory=lambda: os.getenv("DB_FAST_EXECUTEMANY", "true"),
+        converter=_to_bool,
+        validator=validators.instance_of(bool)
+    )
+    _engine: Optional[Engine] = field(init=False, default=None, repr=False)
+    _engine_lock: threading.Lock = field(init=False, factory=threading.Lock, repr=False)
+
+    @property
+    def is_sqlite(self) -> bool:
+        """SQLite stands in for SQL Server in local runs, tests and benchmarks."""
+        return self.DB_DRIVER.startswith("sqlite")
 
     @property
     def url(self) -> URL:
+        if self.is_sqlite:
+            return URL.create(drivername=self.DB_DRIVER, database=self.DB_DATABASE)
         return URL.create(
             drivername=self.DB_DRIVER,
             port=self.DB_PORT,
@@ -46,14 +114,63 @@ class RDSConfig:
             database=self.DB_DATABASE,
             username=self.DB_USERNAME,
             password=self.DB_PASSWORD,
-            query=dict(driver='ODBC Driver 18 for SQL Server',
+            query=dict(driver=self.DB_ODBC_DRIVER,
                        # Trusted_Connection='True',
-                       Encrypt='no',
-                       TrustServerCertificate='yes')
+                       Encrypt=self.DB_ENCRYPT,
+                       TrustServerCertificate=self.DB_TRUST_SERVER_CERTIFICATE)
         )
 
     def get_engine(self) -> Engine:
-        return create_engine(self.url)
+        """Return the engine for this configuration, building it on first use.
+
+        Building it imports the DBAPI driver (pyodbc), which is why it waits
+        for the first caller rather than the import of this module.
+        """
+        if self._engine is not None:
+            return self._engine
+        with self._engine_lock:
+            if self._engine is not None:
+                return self._engine
+            if self.is_sqlite:
+                self._engine = self._create_sqlite_engine()
+            else:
+                self._engine = create_engine(
+                    self.url,
+                    pool_size=self.DB_POOL_SIZE,
+                    max_overflow=self.DB_MAX_OVERFLOW,
+                    pool_timeout=self.DB_POOL_TIMEOUT,
+                    pool_recycle=self.DB_POOL_RECYCLE,
+                    pool_pre_ping=self.DB_POOL_PRE_PING,
+                    # batched inserts go through executemany, let pyodbc bind them as arrays
+                    fast_executemany=self.DB_FAST_EXECUTEMANY,
+                    connect_args={'timeout': self.DB_CONNECT_TIMEOUT},
+                    # RawData arrives pre-serialized, don't encode it twice
+                    json_serializer=encoding.json_serializer
+                )
+            instrument_pool(self._engine)
+        return self._engine
+
+    def _create_sqlite_engine(self) -> Engine:
+        # writes run on worker threads
+        kwargs = dict(connect_args={'check_same_thread': False},
+                      json_serializer=encoding.json_serializer)
+        if self.DB_DATABASE in ("", ":memory:"):
+            # in-memory data must outlive a single connection
+            kwargs['poolclass'] = StaticPool
+        engine = create_engine(self.url, **kwargs)
+        # SQLite has no dbo schema, keep the tables in the main database
+        return engine.execution_options(schema_translate_map={'dbo': None})
+
+
+def instrument_pool(engine: Engine):
+    """Track how many pooled connections are in use."""
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_conn, conn_record, conn_proxy):
+        pool_checked_out.inc()
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_conn, conn_record):
+        pool_checked_out.dec()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+from typing import AsyncIterator, List, Optional
+from fastapi import APIRouter, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from ..export import EXPORT_CHUNK_ROWS, MEDIA_TYPES, ExportWriter
+from .sensor_readings import sink_client, sql_agent
+
+app = APIRouter(include_in_schema=True)
+
+
+async def _sink_chunks(start: Optional[datetime], end: Optional[datetime],
+                       device: Optional[str], raw: bool) -> AsyncIterator[List[dict]]:
+    # in the multi-worker mode only the sink holds database connections, read keyset pages there
+    after = None
+    while True:
+        rows = await sink_client.call('page', start, end, after, EXPORT_CHUNK_ROWS, device, raw)
+        if rows:
+            yield rows
+        if len(rows) < EXPORT_CHUNK_ROWS:
+            return
+        after = (rows[-1]['Timestamp'], rows[-1]['Id'])
+
+
+@app.get("/export", response_model=None)
+async def export_readings(
+    format: str = Query('csv', pattern='^(csv|parquet)$'),
+    start: Optional[datetime] = Query(None, description="Inclusive lower bound on Timestamp"),
+    end: Optional[datetime] = Query(None, description="Exclusive upper bound on Timestamp"),
+    last_minutes: Optional[int] = Query(None, ge=1, description="Instead of start, the last N minutes"),
+    device: Optional[str] = Query(None, description="esp8266id, all sensors if omitted"),
+    raw: bool = Query(True, description="Flatten RawData into one column per value type")
+) -> Response:
+    """Readings in a time range as a Parquet or CSV download, oldest first.
+
+    Rows are read through a server-side cursor in chunks of
+    EXPORT_CHUNK_ROWS and written to the response as they are converted,
+    so long ranges neither load into memory nor wait for the whole file.
+
+    Raises:
+        HTTPException: 501 for Parquet when pyarrow is not installed
+    """
+    try:
+        writer = ExportWriter(format, raw)
+    except ValueError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    if last_minutes is not None:
+        start = datetime.now() - timedelta(minutes=last_minutes)
+
+    source = None
+    if sink_client.enabled:
+        chunks = _sink_chunks(start, end, device, raw)
+    else:
+        source = sql_agent.sql_client.stream_rows(start, end, EXPORT_CHUNK_ROWS, device, raw)
+        chunks = iterate_in_threadpool(source)
+    # the first chunk is read before responding, so database errors still get a status code
+    first = await anext(chunks, None)
+
+    async def stream() -> AsyncIterator[bytes]:
+        try:
+            if first is not None:
+                yield await run_in_threadpool(writer.write, first)
+                async for rows in chunks:
+                    yield await run_in_threadpool(writer.write, rows)
+            yield writer.close()
+        finally:
+            if source is not None:
+                # returns the connection if the client went away mid-export
+                await run_in_threadpool(source.close)
+
+    filename = f"weatherdata.{format}"
+    return StreamingResponse(stream(), media_type=MEDIA_TYPES[format],
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
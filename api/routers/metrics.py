@@ -0,0 +1,57 @@
+import logging
+from fastapi import APIRouter, HTTPException, Query, Response
+from .. import metrics as registry
+from ..middleware import debug_sampler
+from ..sink import SinkError, SinkUnavailable
+from .sensor_readings import sink_client
+
+logger = logging.getLogger(__name__)
+
+app = APIRouter(include_in_schema=True)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@app.get("/metrics", response_model=None)
+async def get_metrics() -> Response:
+    """Request, pipeline stage and sink metrics in Prometheus text format.
+
+    A worker of the multi-worker mode adds the sink process's metrics,
+    labelled ``process="sink"``.
+    """
+    others = []
+    if sink_client.enabled:
+        try:
+            others.append(((('process', 'sink'),), await sink_client.call('metrics')))
+        except (SinkError, SinkUnavailable) as e:
+            logger.warning(f"Sink metrics unavailable: {e}")
+    return Response(content=registry.render_prometheus(others), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def _set_sampling(rate: float):
+    debug_sampler.rate = rate
+
+
+# a rate set on any worker is pushed to all of them by the sink
+sink_client.add_event_listener('sampling', _set_sampling)
+
+
+@app.put("/debug/sampling", response_model=None)
+async def set_debug_sampling(rate: float = Query(..., ge=0.0, le=1.0)) -> dict:
+    """Set the fraction of requests logged at INFO (0 turns request logging off).
+
+    In the multi-worker mode the sink passes the rate on to every connected worker.
+
+    Raises:
+        HTTPException: 503 if the sink could not pass it on, only this worker uses it
+    """
+    try:
+        debug_sampler.rate = rate
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if sink_client.enabled:
+        try:
+            await sink_client.call('sampling', debug_sampler.rate)
+        except (SinkError, SinkUnavailable) as e:
+            raise HTTPException(status_code=503, detail=f"Sampling rate set on this worker only: {e}")
+    return {"debug_sample_rate": debug_sampler.rate}
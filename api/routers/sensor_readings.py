@@ -1,12 +1,28 @@
 
+import os
+import base64
+import asyncio
 import logging
-from typing import Dict
-from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Awaitable, Dict, List, Optional, Tuple
+import orjson
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter, ValidationError
 from ..models.air_data import SensorReading
 from ..dependencies import verify_credentials
-from ..rds import RDSConfig
-from ..publisher import MQTTPublisher
+from ..rds import RDSConfig, _to_bool
+from ..publisher import MQTTPublisher, PublishQueueFull
 from ..sql_client import SQLClient
+from ..async_sql_client import AsyncSQLClient
+from ..spool import PartialDelivery, Spool
+from ..aggregates import Aggregator
+from ..cache import ResponseCache
+from ..dedup import DedupIndex
+from ..change_filter import ChangeFilter
+from ..quality import QualityMonitor
+from ..sink import SinkClient, SinkUnavailable
+from .. import encoding, metrics
 from ..transformer import SensorDataTransformer
 
 
@@ -17,15 +33,73 @@ app = APIRouter(include_in_schema=True)
 mqtt_publisher = MQTTPublisher()
 
 rds_config = RDSConfig()
-sql_agent = SQLClient(rds_config=rds_config)
+sql_agent = AsyncSQLClient(sql_client=SQLClient(rds_config=rds_config))
 
 transformer = SensorDataTransformer()
 
+spool = Spool()
+
+dedup = DedupIndex()
+
+quality = QualityMonitor()
+
+change_filter = ChangeFilter()
+
+aggregator = Aggregator()
+AGG_ROLLUP = _to_bool(os.getenv("AGG_ROLLUP", "true"))
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 1000))
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+readings_adapter = TypeAdapter(List[SensorReading])
+
+# set in the workers of the multi-worker mode, see api.sink
+sink_client = SinkClient()
+
+read_cache = ResponseCache()
+READ_MAX_LIMIT = int(os.getenv("READ_MAX_LIMIT", 10000))
+READ_CHUNK_ROWS = int(os.getenv("READ_CHUNK_ROWS", 500))
+
+# the SQL write itself is db_flush_seconds, it runs after the response
+stage_duration = metrics.histogram('ingest_stage_seconds',
+                                   'Time spent per ingest stage on the request path')
+
+
+def _invalidate_reads():
+    # new rows get the database's current time; allow for a UTC/local clock and some skew
+    utc_now = datetime.now(timezone.utc).replace(tzinfo=None)
+    since = min(datetime.now(), utc_now) - timedelta(minutes=5)
+    read_cache.invalidate(since=since)
+
+
+sql_agent.add_write_listener(_invalidate_reads)
+sink_client.add_event_listener('written', _invalidate_reads)
+
+
+async def deliver_to_mqtt(records: List[dict]):
+    """Spool sink: returns once the broker acknowledged every record.
+
+    Raises:
+        PartialDelivery: With the number of records acknowledged before the
+            first one that failed. Only that prefix counts as delivered, every
+            record after it is replayed, including those acknowledged later
+    """
+    outcomes = await asyncio.gather(*(mqtt_publisher.publish_payload(record, wait_ack=True)
+                                      for record in records), return_exceptions=True)
+    for delivered, outcome in enumerate(outcomes):
+        if isinstance(outcome, BaseException):
+            raise PartialDelivery(delivered, outcome) from outcome
+        if not outcome:
+            raise PartialDelivery(delivered, ConnectionError("MQTT publisher not started"))
+
+
+async def deliver_to_sql(records: List[dict]):
+    """Spool sink: returns once the rows are committed."""
+    await sql_agent.write_rows(records)
+
 
 @app.post("/sensor-data",  response_model=None)
 async def receive_sensor_data(
     data: SensorReading,
-    background_tasks: BackgroundTasks,
     username: str = Depends(verify_credentials)
 ) -> Dict[str:str,
           str:SensorReading]:
@@ -37,32 +111,414 @@ async def receive_sensor_data(
     Returns:
         dict: debug data if testing locally.
     """
+    # a retried post is acknowledged again without reaching the sinks
+    dedup_key = dedup.key(data) if dedup.enabled else None
+    if dedup_key is not None and dedup.check_and_add(dedup_key):
+        return Response(content=encoding.dumps_response({
+            "status": "duplicate",
+            "message": f"Sensor data from {username} was already received"
+        }), media_type="application/json")
+
     try:
         # convert Pydantic model to dict
-        result_dict = transformer.transform_to_dict(data)
+        with metrics.timer(stage_duration, stage='transform'):
+            result_dict = transformer.transform_to_dict(data)
 
-        try:
-            background_tasks.add_task(
-                mqtt_publisher.connect
-            )
-            background_tasks.add_task(
-                mqtt_publisher.publish_payload,
-                result_dict
-            )
-            background_tasks.add_task(
-                sql_agent.store_payload,
-                result_dict
-            )
-        finally:
-            mqtt_publisher.disconnect()
-
-        return {
+        if not (await _dispatch([result_dict]))[0]:
+            raise PublishQueueFull("MQTT publish queue full, retry later")
+
+        # encoded directly, RawData is a pre-serialized fragment
+        return Response(content=encoding.dumps_response({
             "status": "success",
             "message": f"Sensor data received from {username} and will be published to MQTT",
             "data": result_dict
-        }
+        }), media_type="application/json")
+    except (PublishQueueFull, SinkUnavailable) as e:
+        if dedup_key is not None:
+            dedup.discard(dedup_key)
+        raise HTTPException(status_code=503, detail=f"Sensor data not accepted: {str(e)}")
+    except Exception as e:
+        if dedup_key is not None:
+            dedup.discard(dedup_key)
+        raise HTTPException(status_code=500, detail=f"Error processing sensor data: {str(e)}")
+
+
+async def _read_batch_items(request: Request) -> Tuple[list, Dict[int, str]]:
+    """Parse a JSON array or NDJSON body into raw items.
+
+    NDJSON is parsed line by line as the body streams in.
+
+    Returns:
+        tuple: Parsed items (None where a line failed to parse) and the
+        parse errors by item index
+    """
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+    errors: Dict[int, str] = {}
+
+    if content_type not in NDJSON_TYPES:
+        try:
+            items = orjson.loads(await request.body())
+        except orjson.JSONDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON body: {e}")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array of sensor readings")
+        if len(items) > BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail=f"Batch larger than {BATCH_MAX_ITEMS} readings")
+        return items, errors
+
+    items = []
+    pending = b''
+    async for chunk in request.stream():
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if not line.strip():
+                continue
+            if len(items) >= BATCH_MAX_ITEMS:
+                raise HTTPException(status_code=413, detail=f"Batch larger than {BATCH_MAX_ITEMS} readings")
+            try:
+                items.append(orjson.loads(line))
+            except orjson.JSONDecodeError as e:
+                errors[len(items)] = f"Invalid JSON: {e}"
+                items.append(None)
+    if pending.strip():
+        try:
+            items.append(orjson.loads(pending))
+        except orjson.JSONDecodeError as e:
+            errors[len(items)] = f"Invalid JSON: {e}"
+            items.append(None)
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch larger than {BATCH_MAX_ITEMS} readings")
+    return items, errors
+
+
+def _validate_batch(items: list, errors: Dict[int, str]) -> Dict[int, SensorReading]:
+    """Validate the parsed items with one TypeAdapter pass.
+
+    If some items are invalid, their errors are recorded and the rest are
+    validated again in a second pass.
+    """
+    indices = [i for i in range(len(items)) if i not in errors]
+    try:
+        readings = readings_adapter.validate_python([items[i] for i in indices])
+    except ValidationError as e:
+        for error in e.errors(include_url=False):
+            index = indices[error['loc'][0]]
+            location = '.'.join(str(part) for part in error['loc'][1:])
+            errors.setdefault(index, f"{location}: {error['msg']}" if location else error['msg'])
+        indices = [i for i in indices if i not in errors]
+        readings = readings_adapter.validate_python([items[i] for i in indices])
+    return dict(zip(indices, readings))
+
+
+async def dispatch_local(results: List[dict]) -> List[bool]:
+    """Hand a group of transformed readings to the sinks of this process.
+
+    Readings the change filter suppresses count as accepted, they only
+    reach the running aggregates (and SQL with ``FILTER_SQL_STORE=all``).
+    So do readings the quality stage drops, which reach nothing.
+
+    Returns:
+        list: Per reading, True if it was accepted
+    """
+    return await (await enqueue_local(results))
+
+
+async def enqueue_local(results: List[dict]) -> Awaitable[List[bool]]:
+    """The part of ``dispatch_local`` that fixes the order of the readings.
+
+    Groups reach the spool, or the MQTT and SQL queues, in the order of
+    the calls. Waiting for the spool fsync is left to the returned
+    awaitable, so the sink process can take the next group meanwhile and
+    both share one fsync.
+
+    Returns:
+        Awaitable: Resolves to what ``dispatch_local`` returns
+    """
+    with metrics.timer(stage_duration, stage='quality'):
+        kept = quality.check_many(results)
+    with metrics.timer(stage_duration, stage='filter'):
+        passed = change_filter.select(results, kept)
+    changes = [result for result, ok in zip(results, passed) if ok]
+    if spool.enabled:
+        # durable on disk before we acknowledge, the replayers fan out
+        try:
+            with metrics.timer(stage_duration, stage='spool_append'):
+                synced = spool.write(changes)
+        except Exception:
+            _forget_filtered(changes)
+            raise
+        return _spooled(results, kept, changes, synced)
+
+    # the publisher connection is shared and managed by the app lifespan,
+    # enqueueing is cheap and surfaces backpressure to the sensor
+    with metrics.timer(stage_duration, stage='mqtt_enqueue'):
+        published = iter(await mqtt_publisher.publish_many(changes))
+    accepted = [next(published) if ok else True for ok in passed]
+    # the sensor retries a rejected reading, it must not be filtered as unchanged then
+    _forget_filtered([result for result, ok, stored in zip(results, passed, accepted)
+                      if ok and not stored])
+    if change_filter.sql_store == 'all':
+        rows = [result for result, ok, stored in zip(results, kept, accepted) if ok and stored]
+    elif change_filter.sql_store == 'changes':
+        rows = [result for result, ok, stored in zip(results, passed, accepted) if ok and stored]
+    else:
+        # rollup only, WeatherRollup is written from the aggregates
+        rows = []
+    # buffered on the event loop, written by the SQL writer's own executor
+    with metrics.timer(stage_duration, stage='sql_enqueue'):
+        await sql_agent.store_many(rows)
+    _aggregate(results, kept, accepted)
+    done = asyncio.get_running_loop().create_future()
+    done.set_result(accepted)
+    return done
+
+
+async def _spooled(results: List[dict], kept: List[bool], changes: List[dict],
+                   synced: asyncio.Future) -> List[bool]:
+    try:
+        with metrics.timer(stage_duration, stage='spool_fsync'):
+            await asyncio.shield(synced)
+    except Exception:
+        _forget_filtered(changes)
+        raise
+    accepted = [True] * len(results)
+    _aggregate(results, kept, accepted)
+    return accepted
+
+
+def _aggregate(results: List[dict], kept: List[bool], accepted: List[bool]):
+    for result, ok, stored in zip(results, kept, accepted):
+        if ok and stored:
+            aggregator.add(result['DeviceId'], result)
+
+
+def _forget_filtered(results: List[dict]):
+    for result in results:
+        change_filter.forget(result['DeviceId'])
+
+
+async def _dispatch(results: List[dict]) -> List[bool]:
+    """Hand transformed readings to the sink process, or to the sinks of this one.
+
+    Raises:
+        SinkUnavailable: If the sink process can't be reached
+    """
+    if sink_client.enabled:
+        with metrics.timer(stage_duration, stage='sink_dispatch'):
+            return await sink_client.call('dispatch', results)
+    return await dispatch_local(results)
+
+
+@app.post("/sensor-data/batch", response_model=None)
+async def receive_sensor_data_batch(
+    request: Request,
+    username: str = Depends(verify_credentials)
+) -> Response:
+    """Accepts a JSON array or an NDJSON stream (application/x-ndjson) of sensor readings.
+
+    Every reading is validated, transformed with vectorized checks and handed to MQTT and SQL as
+    one group. Invalid readings don't fail the batch.
+
+    Raises:
+        HTTPException: 400 for a malformed body, 413 for an oversized batch
+
+    Returns:
+        dict: Counts and one result per reading, in input order.
+    """
+    items, errors = await _read_batch_items(request)
+    readings = _validate_batch(items, errors)
+
+    dedup_keys = {}
+    duplicate_indices = set()
+    if dedup.enabled:
+        for index in sorted(readings):
+            key = dedup.key(readings[index])
+            if dedup.check_and_add(key):
+                duplicate_indices.add(index)
+                del readings[index]
+            else:
+                dedup_keys[index] = key
+
+    try:
+        indices = sorted(readings)
+        with metrics.timer(stage_duration, stage='transform'):
+            results, reasons = transformer.transform_batch([readings[i] for i in indices])
+        result_indices = []
+        for index, reason in zip(indices, reasons):
+            if reason:
+                errors[index] = reason
+            else:
+                result_indices.append(index)
+
+        accepted = await _dispatch(results) if results else []
     except Exception as e:
+        # nothing was accepted, the retry must not be answered as a duplicate
+        for key in dedup_keys.values():
+            dedup.discard(key)
+        if isinstance(e, SinkUnavailable):
+            raise HTTPException(status_code=503, detail=f"Sensor data not accepted: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing sensor data: {str(e)}")
+    accepted_indices = set()
+    for index, ok in zip(result_indices, accepted):
+        if ok:
+            accepted_indices.add(index)
+        else:
+            errors[index] = "Publish queue full, retry later"
+
+    item_results = []
+    for index in range(len(items)):
+        if index in accepted_indices:
+            item_results.append({"index": index, "status": "accepted"})
+        elif index in duplicate_indices:
+            item_results.append({"index": index, "status": "duplicate"})
+        else:
+            if index in dedup_keys:
+                dedup.discard(dedup_keys[index])
+            item_results.append({"index": index, "status": "rejected", "error": errors[index]})
+
+    received = accepted_indices or duplicate_indices
+    body = {
+        "status": "success" if not errors else ("partial" if received else "failed"),
+        "message": f"{len(accepted_indices)} of {len(items)} readings received from {username}",
+        "accepted": len(accepted_indices),
+        "duplicates": len(duplicate_indices),
+        "rejected": len(items) - len(accepted_indices) - len(duplicate_indices),
+        "results": item_results
+    }
+    status_code = status.HTTP_200_OK if received or not items else status.HTTP_422_UNPROCESSABLE_ENTITY
+    return Response(content=encoding.dumps_response(body),
+                    status_code=status_code,
+                    media_type="application/json")
+
+
+@app.get("/aggregates", response_model=None)
+async def get_aggregates(
+    window: int = Query(900, description="Window size in seconds"),
+    device: Optional[str] = Query(None, description="esp8266id, all sensors if omitted"),
+    limit: int = Query(1, ge=1, description="Windows per sensor, newest first")
+) -> Dict[str, object]:
+    """Running count, min, max and mean per sensor, served from memory.
+
+    The newest window is still open. Closed windows are also written to the
+    WeatherRollup table for longer history.
+
+    Raises:
+        HTTPException: 400 if ``window`` is not an aggregated window size
+    """
+    try:
+        if sink_client.enabled:
+            sensors = await sink_client.call('aggregates', window, device, limit)
+        else:
+            sensors = aggregator.query(window, device_id=device, limit=limit)
+    except KeyError:
+        raise HTTPException(status_code=400,
+                            detail=f"window must be one of {list(aggregator.windows)} seconds")
+    return {"window": window, "sensors": sensors}
+
+
+def _encode_cursor(key: Tuple[datetime, int]) -> str:
+    timestamp, row_id = key
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{row_id}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@app.get("/readings/latest", response_model=None)
+async def get_latest_reading(
+    device: Optional[str] = Query(None, description="esp8266id, any sensor if omitted"),
+    raw: bool = Query(False, description="Include RawData")
+) -> Response:
+    """Newest stored reading, cached until the next insert or READ_CACHE_TTL_S.
+
+    Raises:
+        HTTPException: 404 if nothing has been stored yet
+    """
+    key = ('latest', device, raw)
+    body = read_cache.get(key)
+    if body is None:
+        generation = read_cache.generation
+        if sink_client.enabled:
+            row = await sink_client.call('latest', device, raw)
+        else:
+            row = await sql_agent.fetch_latest(device_id=device, include_raw=raw)
+        if row is None:
+            raise HTTPException(status_code=404, detail="No readings stored yet")
+        body = encoding.dumps_response(row)
+        read_cache.put(key, body, generation=generation)
+    return Response(content=body, media_type="application/json")
+
+
+async def _fetch_page(*args) -> List[dict]:
+    # in the multi-worker mode only the sink process holds database connections
+    if sink_client.enabled:
+        return await sink_client.call('page', *args)
+    return await sql_agent.fetch_page(*args)
+
+
+@app.get("/readings", response_model=None)
+async def get_readings(
+    start: Optional[datetime] = Query(None, description="Inclusive lower bound on Timestamp"),
+    end: Optional[datetime] = Query(None, description="Exclusive upper bound on Timestamp"),
+    last_minutes: Optional[int] = Query(None, ge=1, description="Instead of start, the last N minutes"),
+    device: Optional[str] = Query(None, description="esp8266id, all sensors if omitted"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    limit: int = Query(100, ge=1, le=READ_MAX_LIMIT),
+    raw: bool = Query(False, description="Include RawData")
+) -> Response:
+    """Readings in a time range, oldest first, one keyset page per request.
+
+    The page is streamed as it is read in chunks of READ_CHUNK_ROWS. The
+    body is ``{"items": [...], "next_cursor": ...}``; pass ``next_cursor``
+    back as ``cursor`` for the following page, it is null once the range
+    is exhausted.
+
+    Raises:
+        HTTPException: 400 for an invalid cursor
+    """
+    after = _decode_cursor(cursor) if cursor else None
+    # keyed on last_minutes rather than the computed start, so polling hits the cache
+    key = ('range', device, start, end, last_minutes, cursor, limit, raw)
+    body = read_cache.get(key)
+    if body is not None:
+        return Response(content=body, media_type="application/json")
+
+    if last_minutes is not None:
+        start = datetime.now() - timedelta(minutes=last_minutes)
+    generation = read_cache.generation
+    # the first chunk is read before responding, so database errors still get a status code
+    first = await _fetch_page(start, end, after, min(READ_CHUNK_ROWS, limit), device, raw)
+
+    async def stream() -> AsyncIterator[bytes]:
+        parts = []
+        rows, remaining, key_after = first, limit, after
+        while rows:
+            # one orjson call per chunk, without the enclosing brackets
+            part = encoding.dumps_response(rows)[1:-1]
+            parts.append(part)
+            yield (b',' if len(parts) > 1 else b'{"items":[') + part
+            remaining -= len(rows)
+            key_after = (rows[-1]['Timestamp'], rows[-1]['Id'])
+            if remaining == 0 or len(rows) < READ_CHUNK_ROWS:
+                break
+            rows = await _fetch_page(start, end, key_after, min(READ_CHUNK_ROWS, remaining),
+                                     device, raw)
+        if not parts:
+            yield b'{"items":['
+        more = remaining == 0 and key_after is not None
+        next_cursor = _encode_cursor(key_after) if more else None
+        tail = b'],"next_cursor":' + encoding.dumps_response(next_cursor) + b'}'
+        yield tail
+        body = b'{"items":[' + b','.join(parts) + tail
+        read_cache.put(key, body, end=end, generation=generation)
+
+    return StreamingResponse(stream(), media_type="application/json")
 
 
 @app.get("/", response_model=None)
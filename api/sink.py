@@ -0,0 +1,362 @@
+"""
+Sink process of the multi-worker mode.
+
+With ``SINK_SOCKET`` set, the HTTP workers only validate and transform
+readings. They hand them over a Unix socket to one sink process, which
+owns the single MQTT connection, the batched SQL writer, the spool and
+the running aggregates, so more workers don't mean more broker or
+database connections:
+
+    python -m api.sink --workers 4     # the sink plus 4 uvicorn workers
+    python -m api.sink                 # the sink alone
+
+Frames are newline-delimited JSON in the spool's line format
+(``api.codec``), so Decimal and datetime values are kept exact. A worker
+sends ``{"id", "op", "args"}`` and gets ``{"id", "result"}`` or
+``{"id", "error", "type"}`` back; the sink also pushes ``{"event"}``
+frames, e.g. after every committed insert, with an ``"args"`` list when
+the event carries values.
+"""
+import os
+import sys
+import asyncio
+import logging
+import signal
+import argparse
+import subprocess
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+from attrs import define, field, validators
+from api import metrics
+from api.codec import decode_line, encode_line
+
+logger = logging.getLogger(__name__)
+
+frames_sent = metrics.counter('sink_frames_total', 'Frames exchanged with the sink process')
+sink_unavailable = metrics.counter('sink_unavailable_total',
+                                   'Calls that failed because the sink process was unreachable')
+
+
+class SinkUnavailable(ConnectionError):
+    """Raised when the sink process can't be reached or the connection dropped."""
+    pass
+
+
+class SinkError(RuntimeError):
+    """An operation failed inside the sink process."""
+    pass
+
+
+def encode_frame(frame: dict) -> bytes:
+    return encode_line(frame)
+
+
+def decode_frame(line: bytes) -> dict:
+    return decode_line(line)
+
+
+Handler = Callable[..., Awaitable[object]]
+
+
+@define
+class SinkServer:
+    """Serves the worker connections of the sink process.
+
+    ``dispatch`` frames are started in order on each connection, so the
+    readings of one worker reach the spool or the MQTT queue in the order
+    it sent them. Such an ordered handler returns once that order is
+    fixed, with an awaitable for the rest (e.g. the spool fsync), which
+    runs concurrently with the next frames; everything else runs
+    concurrently from the start.
+    """
+    path: str
+    handlers: Dict[str, Handler]
+    ordered: Set[str] = field(factory=lambda: {'dispatch'})
+    _server: Optional[asyncio.AbstractServer] = field(init=False, default=None)
+    _writers: Set[asyncio.StreamWriter] = field(init=False, factory=set)
+    _tasks: Set[asyncio.Task] = field(init=False, factory=set)
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # left behind by a sink that didn't shut down cleanly
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path,
+                                                       limit=64 * 1024 * 1024)
+        logger.info(f"Sink listening on {self.path}")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+        # the workers see EOF and reconnect once a sink is back
+        writers = list(self._writers)
+        for writer in writers:
+            writer.close()
+        await asyncio.gather(*(writer.wait_closed() for writer in writers), return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def broadcast(self, event: str, *args):
+        """Push an event frame to every connected worker."""
+        frame = encode_frame({'event': event, 'args': args} if args else {'event': event})
+        for writer in self._writers:
+            writer.write(frame)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                frame = decode_frame(line)
+                frames_sent.inc(direction='received')
+                if frame['op'] in self.ordered:
+                    try:
+                        pending = await self.handlers[frame['op']](*frame['args'])
+                    except Exception as e:
+                        self._reply(frame, writer, error=e)
+                    else:
+                        self._spawn(self._handle(frame, writer, pending))
+                    await writer.drain()
+                else:
+                    self._spawn(self._handle(frame, writer))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, frame: dict, writer: asyncio.StreamWriter,
+                      pending: Optional[Awaitable] = None):
+        try:
+            if pending is None:
+                pending = self.handlers[frame['op']](*frame['args'])
+            result = await pending
+        except Exception as e:
+            self._reply(frame, writer, error=e)
+        else:
+            self._reply(frame, writer, result=result)
+
+    def _reply(self, frame: dict, writer: asyncio.StreamWriter, result=None,
+               error: Optional[Exception] = None):
+        if error is None:
+            reply = {'id': frame['id'], 'result': result}
+        else:
+            reply = {'id': frame['id'], 'error': str(error), 'type': type(error).__name__}
+        if not writer.is_closing():
+            writer.write(encode_frame(reply))
+            frames_sent.inc(direction='sent')
+
+
+@define
+class SinkClient:
+    """A worker's connection to the sink process.
+
+    Calls are pipelined over one connection and matched to their replies
+    by id. An empty ``path`` disables the client and the worker runs the
+    sinks itself.
+    """
+    path: str = field(
+        factory=lambda: os.getenv("SINK_SOCKET", ""),
+        validator=validators.instance_of(str)
+    )
+    connect_timeout: float = field(
+        factory=lambda: float(os.getenv("SINK_CONNECT_TIMEOUT", 30)),
+        converter=float,
+        validator=validators.ge(0.0)
+    )
+    call_timeout: float = field(
+        factory=lambda: float(os.getenv("SINK_CALL_TIMEOUT", 30)),
+        converter=float,
+        validator=validators.gt(0.0)
+    )
+    _writer: Optional[asyncio.StreamWriter] = field(init=False, default=None)
+    _reader_task: Optional[asyncio.Task] = field(init=False, default=None)
+    _pending: Dict[int, asyncio.Future] = field(init=False, factory=dict)
+    _next_id: int = field(init=False, default=0)
+    _listeners: Dict[str, List[Callable[..., None]]] = field(init=False, factory=dict)
+    _connect_lock: Optional[asyncio.Lock] = field(init=False, default=None)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def add_event_listener(self, event: str, callback: Callable[..., None]):
+        """Call ``callback`` with the event's args when the sink pushes ``event``."""
+        self._listeners.setdefault(event, []).append(callback)
+
+    async def open(self):
+        """Connect, waiting up to ``connect_timeout`` for the sink to come up.
+
+        Raises:
+            SinkUnavailable: If the sink didn't accept a connection in time
+        """
+        deadline = asyncio.get_running_loop().time() + self.connect_timeout
+        while True:
+            try:
+                await self._connect()
+                return
+            except SinkUnavailable:
+                if asyncio.get_running_loop().time() >= deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending(SinkUnavailable("Sink connection closed"))
+
+    async def call(self, op: str, *args):
+        """Run ``op`` in the sink process and return its result.
+
+        Raises:
+            SinkUnavailable: If the sink can't be reached
+            SinkError: If the operation failed in the sink (KeyError is re-raised as such)
+        """
+        if self._writer is None or self._writer.is_closing():
+            if self._connect_lock is None:
+                self._connect_lock = asyncio.Lock()
+            async with self._connect_lock:
+                if self._writer is None or self._writer.is_closing():
+                    await self._connect()
+        self._next_id += 1
+        call_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[call_id] = future
+        self._writer.write(encode_frame({'id': call_id, 'op': op, 'args': args}))
+        frames_sent.inc(direction='sent')
+        try:
+            await self._writer.drain()
+            return await asyncio.wait_for(future, self.call_timeout)
+        except asyncio.TimeoutError:
+            raise SinkUnavailable(f"Sink did not answer {op} within {self.call_timeout}s")
+        except ConnectionError as e:
+            raise SinkUnavailable(f"Sink connection lost: {e}")
+        finally:
+            self._pending.pop(call_id, None)
+
+    async def _connect(self):
+        try:
+            reader, self._writer = await asyncio.open_unix_connection(self.path,
+                                                                      limit=64 * 1024 * 1024)
+        except OSError as e:
+            sink_unavailable.inc()
+            raise SinkUnavailable(f"Sink not reachable at {self.path}: {e}")
+        self._reader_task = asyncio.create_task(self._read_loop(reader))
+        logger.info(f"Connected to the sink at {self.path}")
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                frame = decode_frame(line)
+                frames_sent.inc(direction='received')
+                if 'event' in frame:
+                    for callback in self._listeners.get(frame['event'], ()):
+                        callback(*frame.get('args', ()))
+                    continue
+                future = self._pending.get(frame['id'])
+                if future is None or future.done():
+                    continue
+                if 'error' in frame:
+                    error_cls = KeyError if frame['type'] == 'KeyError' else SinkError
+                    future.set_exception(error_cls(frame['error']))
+                else:
+                    future.set_result(frame['result'])
+        except ConnectionError:
+            pass
+        logger.warning("Sink connection lost, reconnecting on the next call")
+        self._fail_pending(SinkUnavailable("Sink connection lost"))
+        if self._writer is not None:
+            self._writer.close()
+
+    def _fail_pending(self, error: Exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+                sink_unavailable.inc()
+
+
+async def serve(path: str):
+    """Run the sinks and serve the workers until cancelled."""
+    from api.main import start_sinks, stop_sinks
+    from api.dependencies import rate_limiter
+    from api.routers import sensor_readings as ingest
+    from api.startup import profile
+
+    server = SinkServer(path, handlers={
+        'dispatch': ingest.enqueue_local,
+        'latest': ingest.sql_agent.fetch_latest,
+        'page': lambda start, end, after, *rest: ingest.sql_agent.fetch_page(
+            start, end, tuple(after) if after else None, *rest),
+        'aggregates': _async(ingest.aggregator.query),
+        'metrics': _async(metrics.snapshot),
+        # one token bucket per device for all workers
+        'allow': _async(rate_limiter.acquire),
+        'sampling': _async(lambda rate: server.broadcast('sampling', rate)),
+    })
+    ingest.sql_agent.add_write_listener(lambda: server.broadcast('written'))
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        # flush the MQTT queue, the SQL buffer and the spool before exiting
+        loop.add_signal_handler(signum, stopping.set)
+    with profile.phase('lifespan'):
+        await start_sinks()
+    await server.start()
+    logger.info(profile.report())
+    try:
+        await stopping.wait()
+    finally:
+        await server.close()
+        await stop_sinks()
+
+
+def _async(fn: Callable) -> Handler:
+    async def call(*args):
+        return fn(*args)
+    return call
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sink process of the multi-worker mode")
+    parser.add_argument('--socket', default=os.getenv("SINK_SOCKET", "") or "/tmp/sensor-api-sink.sock",
+                        help="Unix socket to serve the workers on [SINK_SOCKET]")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="also start this many uvicorn workers of api.main:app")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if not args.workers:
+        # the sink itself must not forward to a sink
+        os.environ.pop("SINK_SOCKET", None)
+        asyncio.run(serve(args.socket))
+        return
+
+    import uvicorn
+    sink = subprocess.Popen([sys.executable, '-m', 'api.sink', '--socket', args.socket])
+    os.environ["SINK_SOCKET"] = args.socket
+    try:
+        uvicorn.run("api.main:app", host=args.host, port=args.port, workers=args.workers)
+    finally:
+        sink.terminate()
+        sink.wait()
+
+
+if __name__ == "__main__":
+    main()
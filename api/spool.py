@@ -0,0 +1,425 @@
+"""
+Durable local write-ahead spool for readings on their way to the sinks.
+
+Readings are appended to segmented, append-only files and fsynced in
+batches before the request is acknowledged. One replayer per sink drains
+the spool from its own committed offset, so an MQTT or database outage
+only delays delivery instead of losing readings.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from attrs import define, field, validators
+from api import metrics
+from api.codec import decode_line, encode_line
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.seg'
+OFFSET_SUFFIX = '.offset'
+
+records_appended = metrics.counter('spool_records_appended_total', 'Readings written to the spool')
+records_delivered = metrics.counter('spool_records_delivered_total',
+                                    'Readings replayed from the spool to a sink')
+delivery_failures = metrics.counter('spool_delivery_failures_total',
+                                    'Failed attempts to deliver a spool batch to a sink')
+segments_dropped = metrics.counter('spool_segments_dropped_total',
+                                   'Segments deleted by the retention policy before every sink consumed them')
+spool_bytes = metrics.gauge('spool_bytes', 'Bytes on disk in spool segments')
+fsync_latency = metrics.histogram('spool_fsync_seconds', 'Duration of one batched fsync')
+
+# (segment id, byte position) of a record boundary
+Position = Tuple[int, int]
+# raises PartialDelivery if it delivered only part of the batch
+Deliver = Callable[[List[dict]], Awaitable[None]]
+
+
+class PartialDelivery(Exception):
+    """Raised by a sink that delivered only the first ``delivered`` records of a batch."""
+
+    def __init__(self, delivered: int, cause: BaseException):
+        super().__init__(f"{delivered} records delivered, then: {cause}")
+        self.delivered = delivered
+        self.cause = cause
+
+
+def encode_record(record: dict) -> bytes:
+    """Encode one reading as a spool line, see ``api.codec``."""
+    return encode_line(record)
+
+
+def decode_record(line: bytes) -> dict:
+    return decode_line(line)
+
+
+@define
+class SinkCursor:
+    """Replay state of one sink: its delivery callback and committed offset."""
+    name: str
+    deliver: Deliver
+    position: Position
+    wakeup: asyncio.Event = field(factory=asyncio.Event)
+    task: Optional[asyncio.Task] = None
+
+
+@define
+class Spool:
+    """Append-only, fsync-batched spool with per-sink replay offsets.
+
+    An empty ``directory`` disables the spool and readings go straight to
+    the sinks.
+    """
+    directory: str = field(
+        factory=lambda: os.getenv("SPOOL_DIR", ""),
+        validator=validators.instance_of(str)
+    )
+    segment_bytes: int = field(
+        factory=lambda: int(os.getenv("SPOOL_SEGMENT_BYTES", 16 * 1024 * 1024)),
+        converter=int,
+        validator=validators.gt(0)
+    )
+    max_bytes: int = field(
+        factory=lambda: int(os.getenv("SPOOL_MAX_BYTES", 1024 * 1024 * 1024)),
+        converter=int,
+        validator=validators.gt(0)
+    )
+    max_age_hours: float = field(
+        factory=lambda: float(os.getenv("SPOOL_MAX_AGE_HOURS", 168)),
+        converter=float,
+        validator=validators.gt(0)
+    )
+    fsync_interval_ms: int = field(
+        factory=lambda: int(os.getenv("SPOOL_FSYNC_INTERVAL_MS", 20)),
+        converter=int,
+        validator=validators.gt(0)
+    )
+    fsync_batch: int = field(
+        factory=lambda: int(os.getenv("SPOOL_FSYNC_BATCH", 256)),
+        converter=int,
+        validator=validators.gt(0)
+    )
+    replay_batch: int = field(
+        factory=lambda: int(os.getenv("SPOOL_REPLAY_BATCH", 100)),
+        converter=int,
+        validator=validators.gt(0)
+    )
+    _sinks: Dict[str, SinkCursor] = field(init=False, factory=dict)
+    _segment_id: int = field(init=False, default=0)
+    _fh = field(init=False, default=None)
+    _write_pos: int = field(init=False, default=0)
+    # everything before this position is on disk and visible to replayers
+    _synced: Position = field(init=False, default=(0, 0))
+    _unsynced: int = field(init=False, default=0)
+    _sync_waiter: Optional[asyncio.Future] = field(init=False, default=None)
+    _sync_now: Optional[asyncio.Event] = field(init=False, default=None)
+    _sync_task: Optional[asyncio.Task] = field(init=False, default=None)
+    # fsync and close of the segments rotated out since the last sync
+    _closing: List[asyncio.Task] = field(init=False, factory=list)
+    _retention_lock: threading.Lock = field(init=False, factory=threading.Lock)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    # --- segment files -------------------------------------------------
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.directory, f"{segment_id:020d}{SEGMENT_SUFFIX}")
+
+    def _segment_ids(self) -> List[int]:
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                      for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _open_segment(self, segment_id: int):
+        self._segment_id = segment_id
+        self._fh = open(self._segment_path(segment_id), 'ab')
+        self._write_pos = self._fh.tell()
+
+    def _rotate(self):
+        """Start the next segment; the full one is fsynced and closed in a thread.
+
+        The next ``_sync`` waits for that before it releases the appenders,
+        and only then lets the replayers past the full segment.
+        """
+        full = self._fh
+        full.flush()
+        self._open_segment(self._segment_id + 1)
+        self._closing.append(asyncio.get_running_loop().create_task(self._close_segment(full)))
+
+    async def _close_segment(self, fh):
+        try:
+            await asyncio.to_thread(self._fsync_fd, os.dup(fh.fileno()))
+        finally:
+            fh.close()
+        # keep disk usage bounded even while every sink is down
+        try:
+            await asyncio.to_thread(self._enforce_retention)
+        except Exception as e:
+            logger.error(f"Spool retention failed: {e}")
+
+    @staticmethod
+    def _truncate_partial_record(path: str):
+        """Drop a torn last line left behind by a crash mid-write."""
+        with open(path, 'rb+') as fh:
+            data = fh.read()
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                logger.warning(f"Truncating {len(data) - end} bytes of partial record in {path}")
+                fh.truncate(end)
+
+    # --- lifecycle -----------------------------------------------------
+
+    async def open(self):
+        """Recover the spool directory and start the fsync task."""
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        segment_ids = self._segment_ids()
+        if segment_ids:
+            self._truncate_partial_record(self._segment_path(segment_ids[-1]))
+        self._open_segment(segment_ids[-1] if segment_ids else 1)
+        self._synced = (self._segment_id, self._write_pos)
+        self._sync_now = asyncio.Event()
+        self._sync_task = asyncio.create_task(self._sync_loop())
+        self._update_size()
+
+    def add_sink(self, name: str, deliver: Deliver):
+        """Register a sink and start replaying to it from its committed offset."""
+        position = self._load_offset(name)
+        cursor = SinkCursor(name=name, deliver=deliver, position=position)
+        self._sinks[name] = cursor
+        cursor.task = asyncio.create_task(self._replay(cursor))
+
+    async def close(self):
+        """Stop the replayers and make every appended record durable."""
+        if not self.enabled:
+            return
+        for cursor in self._sinks.values():
+            if cursor.task is not None:
+                cursor.task.cancel()
+        await asyncio.gather(*(c.task for c in self._sinks.values() if c.task),
+                             return_exceptions=True)
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+        await self._sync()
+        await asyncio.gather(*self._closing, return_exceptions=True)
+        self._closing = []
+        self._fh.close()
+        self._fh = None
+
+    # --- write path ----------------------------------------------------
+
+    async def append(self, records: List[dict]):
+        """Append readings and return once they are fsynced to disk."""
+        await asyncio.shield(self.write(records))
+
+    def write(self, records: List[dict]) -> asyncio.Future:
+        """Append readings without waiting for the fsync.
+
+        Readings keep the order of the ``write`` calls, and every call
+        until the next fsync shares it.
+
+        Returns:
+            asyncio.Future: Resolved once the readings are on disk; shared,
+                so shield it before awaiting
+        """
+        for record in records:
+            if self._write_pos >= self.segment_bytes:
+                self._rotate()
+            line = encode_record(record)
+            self._fh.write(line)
+            self._write_pos += len(line)
+        records_appended.inc(len(records))
+
+        if self._sync_waiter is None:
+            self._sync_waiter = asyncio.get_running_loop().create_future()
+        waiter = self._sync_waiter
+        self._unsynced += len(records)
+        if self._unsynced >= self.fsync_batch:
+            self._sync_now.set()
+        return waiter
+
+    async def _sync_loop(self):
+        interval = self.fsync_interval_ms / 1000
+        while True:
+            try:
+                await asyncio.wait_for(self._sync_now.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._sync_now.clear()
+            try:
+                await self._sync()
+            except Exception as e:
+                logger.error(f"Spool fsync failed: {e}")
+
+    async def _sync(self):
+        """fsync everything written so far and release the waiting appenders."""
+        waiter, self._sync_waiter = self._sync_waiter, None
+        if waiter is None:
+            return
+        self._unsynced = 0
+        synced = (self._segment_id, self._write_pos)
+        closing, self._closing = self._closing, []
+        started = time.perf_counter()
+        try:
+            self._fh.flush()
+            # a private descriptor stays valid if the segment rotates meanwhile
+            fd = os.dup(self._fh.fileno())
+            await asyncio.to_thread(self._fsync_fd, fd)
+            await asyncio.gather(*closing)
+        except Exception as e:
+            waiter.set_exception(e)
+            raise
+        fsync_latency.observe(time.perf_counter() - started)
+        self._synced = max(self._synced, synced)
+        waiter.set_result(None)
+        for cursor in self._sinks.values():
+            cursor.wakeup.set()
+
+    @staticmethod
+    def _fsync_fd(fd: int):
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # --- replay --------------------------------------------------------
+
+    def _offset_path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}{OFFSET_SUFFIX}")
+
+    def _load_offset(self, name: str) -> Position:
+        try:
+            with open(self._offset_path(name)) as fh:
+                segment_id, pos = fh.read().split()
+                return int(segment_id), int(pos)
+        except FileNotFoundError:
+            segment_ids = self._segment_ids()
+            return (segment_ids[0] if segment_ids else self._segment_id), 0
+
+    def _commit_offset(self, name: str, position: Position):
+        """Persist a sink offset atomically (write, fsync, rename)."""
+        path = self._offset_path(name)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(f"{position[0]} {position[1]}")
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+
+    def _read_batch(self, position: Position) -> Tuple[List[dict], List[Position], Position]:
+        """Read up to ``replay_batch`` synced records starting at ``position``.
+
+        Returns:
+            tuple: The records, the position after each of them and the
+                position to continue from
+        """
+        segment_id, pos = position
+        while True:
+            limit = self._synced[1] if segment_id == self._synced[0] else None
+            path = self._segment_path(segment_id)
+            if segment_id < self._synced[0] and (not os.path.exists(path)
+                                                  or pos >= os.path.getsize(path)):
+                # finished (or retention removed) this segment, move on
+                segment_id, pos = segment_id + 1, 0
+                continue
+            if limit is not None and pos >= limit:
+                return [], [], (segment_id, pos)
+
+            records, ends = [], []
+            try:
+                with open(path, 'rb') as fh:
+                    fh.seek(pos)
+                    while len(records) < self.replay_batch:
+                        if limit is not None and pos >= limit:
+                            break
+                        line = fh.readline()
+                        if not line.endswith(b'\n'):
+                            break
+                        pos += len(line)
+                        records.append(decode_record(line))
+                        ends.append((segment_id, pos))
+            except FileNotFoundError:
+                # removed by retention while we were reading it
+                segment_id, pos = segment_id + 1, 0
+                continue
+            return records, ends, (segment_id, pos)
+
+    async def _replay(self, cursor: SinkCursor):
+        backoff = 0.5
+        while True:
+            # cleared before reading, so a sync during the read still wakes us
+            cursor.wakeup.clear()
+            records, ends, next_position = await asyncio.to_thread(self._read_batch, cursor.position)
+            if not records:
+                cursor.position = next_position
+                await cursor.wakeup.wait()
+                continue
+
+            try:
+                await cursor.deliver(records)
+            except Exception as e:
+                delivery_failures.inc(sink=cursor.name)
+                if isinstance(e, PartialDelivery):
+                    if e.delivered:
+                        # only the records after the delivered prefix are sent again
+                        await self._advance(cursor, ends[e.delivered - 1], e.delivered)
+                    e = e.cause
+                logger.warning(f"Spool delivery to {cursor.name} failed, retrying in {backoff:.1f}s: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+
+            backoff = 0.5
+            await self._advance(cursor, next_position, len(records))
+
+    async def _advance(self, cursor: SinkCursor, position: Position, delivered: int):
+        # delivery is at least once: a crash before this commit, a failed
+        # batch or the records after a PartialDelivery are delivered again
+        cursor.position = position
+        await asyncio.to_thread(self._commit_offset, cursor.name, position)
+        records_delivered.inc(delivered, sink=cursor.name)
+        await asyncio.to_thread(self._enforce_retention)
+
+    # --- retention -----------------------------------------------------
+
+    def _update_size(self) -> int:
+        total = sum(os.path.getsize(self._segment_path(i)) for i in self._segment_ids())
+        spool_bytes.set(total)
+        return total
+
+    def _enforce_retention(self):
+        """Delete consumed segments, then the oldest ones if over the size or age limits."""
+        with self._retention_lock:
+            consumed_before = min((c.position[0] for c in self._sinks.values()),
+                                  default=self._segment_id)
+            oldest_allowed = time.time() - self.max_age_hours * 3600
+            total = self._update_size()
+
+            for segment_id in self._segment_ids():
+                if segment_id == self._segment_id:
+                    break
+                path = self._segment_path(segment_id)
+                size = os.path.getsize(path)
+                if segment_id < consumed_before:
+                    reason = None
+                elif total > self.max_bytes:
+                    reason = 'size'
+                elif os.path.getmtime(path) < oldest_allowed:
+                    reason = 'age'
+                else:
+                    break
+                os.remove(path)
+                total -= size
+                if reason is not None:
+                    segments_dropped.inc(reason=reason)
+                    logger.warning(f"Spool retention ({reason}) dropped unreplayed segment {segment_id}")
+                    for cursor in self._sinks.values():
+                        if cursor.position[0] <= segment_id:
+                            cursor.position = (segment_id + 1, 0)
+            spool_bytes.set(total)
@@ -1,28 +1,221 @@
-from attrs import define, field
+from attrs import define, field, validators
+import os
+import time
 import logging
-from api.rds import RDSConfig
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+from sqlalchemy import bindparam, null, or_, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.sql.dml import Insert
+from api.rds import RDSConfig, _to_bool
 from api.models.db_model import WeatherData
+from api import metrics
 
 logger = logging.getLogger(__name__)
 
+rows_per_flush = metrics.histogram('db_rows_per_flush', 'Rows written per batched insert',
+                                   buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+flush_latency = metrics.histogram('db_flush_seconds', 'Duration of one batched insert and commit')
+rows_failed = metrics.counter('db_rows_failed_total', 'Rows lost because the batched insert failed')
+pool_checkout_wait = metrics.histogram('db_pool_checkout_seconds',
+                                       'Time spent waiting for a pooled connection')
+pool_exhausted = metrics.counter('db_pool_exhausted_total',
+                                 'Checkouts that timed out because the pool was exhausted')
+
 
 @define
 class SQLClient:
+    """Blocking WeatherData and WeatherRollup queries on the shared engine.
+
+    Every batch of rows is written as a single ``executemany`` insert.
+    ``flush_size`` and ``flush_interval_ms`` are the batching settings of
+    ``AsyncSQLClient``, which buffers the readings and calls
+    ``insert_rows`` in a worker thread.
+    """
     rds_config: RDSConfig = field(kw_only=True)
-    db_engine = field(init=False, default=None)
+    flush_size: int = field(
+        kw_only=True,
+        factory=lambda: int(os.getenv("DB_FLUSH_SIZE", 100)),
+        converter=int,
+        validator=validators.gt(0)
+    )
+    flush_interval_ms: int = field(
+        kw_only=True,
+        factory=lambda: int(os.getenv("DB_FLUSH_INTERVAL_MS", 1000)),
+        converter=int,
+        validator=validators.gt(0)
+    )
+    store_raw_data: bool = field(
+        kw_only=True,
+        factory=lambda: os.getenv("DB_STORE_RAW_DATA", "true"),
+        converter=_to_bool,
+        validator=validators.instance_of(bool)
+    )
+    data_model: WeatherData = field(init=False, factory=lambda: WeatherData(schema_name='dbo'))
+    _insert_stmt: Insert = field(init=False, default=None)
+    _rollup_stmt: Insert = field(init=False, default=None)
 
     def __attrs_post_init__(self):
-        self.db_engine = self.rds_config.get_engine()
+        # built once so SQLAlchemy's compiled cache serves every flush.
+        # Nullable columns default to NULL for rows without them, and RawData
+        # is a literal NULL unless it is stored, so the row's value is ignored
+        table = self.data_model.weather_data
+        values = {}
+        for column in table.c:
+            if column.name in ('Id', 'Timestamp'):
+                continue
+            if column.name == 'RawData' and not self.store_raw_data:
+                values[column.name] = null()
+            elif column.nullable:
+                values[column.name] = bindparam(column.name, value=None, required=False)
+            else:
+                values[column.name] = bindparam(column.name)
+        self._insert_stmt = table.insert().values(values)
+        self._rollup_stmt = self.data_model.weather_rollup.insert()
+
+    @property
+    def db_engine(self) -> Engine:
+        """The shared engine, built (and the DBAPI driver imported) on first use."""
+        return self.rds_config.get_engine()
+
+    def create_schema(self):
+        """Create the WeatherData and WeatherRollup tables and their indexes if they are missing.
+
+        A one-time startup/migration step, kept off the insert path.
+        """
+        self.data_model.metadata.create_all(self.db_engine)
 
-    def store_payload(self, payload_data: dict):
+    def _connect(self) -> Connection:
+        """Check a connection out of the pool, recording the wait."""
+        started = time.perf_counter()
         try:
-            with self.db_engine.connect() as conn:
-                data_model = WeatherData(schema_name='dbo')
-                data_model.metadata.create_all(self.db_engine)
+            return self.db_engine.connect()
+        except PoolTimeoutError:
+            pool_exhausted.inc()
+            raise
+        finally:
+            pool_checkout_wait.observe(time.perf_counter() - started)
 
-                conn.execute(data_model.weather_data.insert(), payload_data)
+    def insert_rows(self, rows: List[dict]):
+        """Write ``rows`` as one executemany insert and commit.
+
+        Raises:
+            Exception: Whatever the driver raised, after counting the rows as failed
+        """
+        started = time.perf_counter()
+        try:
+            with self._connect() as conn:
+                # a list of parameter sets runs as one executemany
+                conn.execute(self._insert_stmt, rows)
                 conn.commit()
-                conn.close()
 
-        except Exception as e:
-            logger.error(f"Error storing to database: {e}")
+            rows_per_flush.observe(len(rows))
+            flush_latency.observe(time.perf_counter() - started)
+
+        except Exception:
+            rows_failed.inc(len(rows))
+            raise
+
+    def _select(self, include_raw: bool):
+        table = self.data_model.weather_data
+        columns = [column for column in table.c if include_raw or column.name != 'RawData']
+        return select(*columns)
+
+    def fetch_latest(self, device_id: Optional[str] = None,
+                     include_raw: bool = False) -> Optional[dict]:
+        """Return the newest reading, of one device if given, served by the Timestamp indexes."""
+        table = self.data_model.weather_data
+        stmt = self._select(include_raw)
+        if device_id is not None:
+            stmt = stmt.where(table.c.DeviceId == device_id)
+        stmt = stmt.order_by(table.c.Timestamp.desc(), table.c.Id.desc()).limit(1)
+        with self._connect() as conn:
+            rows = _as_dicts(conn.execute(stmt))
+        return rows[0] if rows else None
+
+    def fetch_page(self,
+                   start: Optional[datetime],
+                   end: Optional[datetime],
+                   after: Optional[Tuple[datetime, int]],
+                   limit: int,
+                   device_id: Optional[str] = None,
+                   include_raw: bool = False) -> List[dict]:
+        """Return up to ``limit`` readings in ``[start, end)``, oldest first.
+
+        Keyset pagination on (Timestamp, Id): ``after`` is the key of the last
+        row already returned, so every page is an index seek instead of an
+        OFFSET scan.
+        """
+        table = self.data_model.weather_data
+        conditions = []
+        if device_id is not None:
+            conditions.append(table.c.DeviceId == device_id)
+        if start is not None:
+            conditions.append(table.c.Timestamp >= start)
+        if end is not None:
+            conditions.append(table.c.Timestamp < end)
+        if after is not None:
+            after_ts, after_id = after
+            # the sargable bound first, the tie-break on Id second
+            conditions.append(table.c.Timestamp >= after_ts)
+            conditions.append(or_(table.c.Timestamp > after_ts, table.c.Id > after_id))
+        stmt = (self._select(include_raw)
+                .where(*conditions)
+                .order_by(table.c.Timestamp, table.c.Id)
+                .limit(limit))
+        with self._connect() as conn:
+            return _as_dicts(conn.execute(stmt))
+
+    def stream_rows(self,
+                    start: Optional[datetime],
+                    end: Optional[datetime],
+                    chunk_rows: int,
+                    device_id: Optional[str] = None,
+                    include_raw: bool = True) -> Iterator[List[dict]]:
+        """Yield the readings in ``[start, end)`` oldest first, ``chunk_rows`` at a time.
+
+        One query on one connection, read through a server-side cursor, so
+        only the current chunk is held in memory however long the range.
+        The connection stays checked out until the iterator is exhausted
+        or closed.
+        """
+        table = self.data_model.weather_data
+        conditions = []
+        if device_id is not None:
+            conditions.append(table.c.DeviceId == device_id)
+        if start is not None:
+            conditions.append(table.c.Timestamp >= start)
+        if end is not None:
+            conditions.append(table.c.Timestamp < end)
+        stmt = (self._select(include_raw)
+                .where(*conditions)
+                .order_by(table.c.Timestamp, table.c.Id))
+        with self._connect() as conn:
+            result = conn.execution_options(yield_per=chunk_rows).execute(stmt)
+            keys = [str(key) for key in result.keys()]
+            for rows in result.partitions():
+                yield [dict(zip(keys, row)) for row in rows]
+
+    def insert_rollups(self, rows: List[dict]):
+        """Write closed aggregate windows to WeatherRollup in one executemany insert.
+
+        Raises:
+            Exception: Whatever the driver raised
+        """
+        with self._connect() as conn:
+            conn.execute(self._rollup_stmt, rows)
+            conn.commit()
+
+
+def _as_dicts(result) -> List[dict]:
+    # plain str keys, the column names are str subclasses that orjson rejects
+    keys = [str(key) for key in result.keys()]
+    return [dict(zip(keys, row)) for row in result]
+
+
+if __name__ == "__main__":
+    # run the schema migration on its own, e.g. before a deployment
+    logging.basicConfig(level=logging.INFO)
+    SQLClient(rds_config=RDSConfig()).create_schema()
+    logger.info("WeatherData schema is up to date")
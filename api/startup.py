@@ -0,0 +1,84 @@
+"""
+Cold-start profile: how long the imports and each lifespan step took.
+
+``python -m api.startup [module]`` prints the slowest imports of
+``api.main`` (or ``module``) in a fresh interpreter, from ``-X importtime``.
+"""
+import os
+import sys
+import time
+import logging
+import subprocess
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+import api
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+phase_seconds = metrics.gauge('startup_phase_seconds', 'Duration of each cold-start phase')
+
+
+class StartupProfile:
+    """Phases of the cold start, reported once the app is ready.
+
+    ``import`` runs from the import of the ``api`` package to the end of
+    ``api.main``; the lifespan steps run concurrently, so they add up to
+    more than ``lifespan``, which is wall time.
+    """
+
+    def __init__(self, started: float):
+        self.started = started
+        self.phases: Dict[str, float] = {}
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = seconds
+        phase_seconds.set(seconds, phase=name)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def report(self) -> str:
+        total = sum(self.phases.get(name, 0.0) for name in ('import', 'lifespan'))
+        phases = ', '.join(f"{name} {seconds * 1000:.0f}" for name, seconds in self.phases.items())
+        return f"Cold start in {total * 1000:.0f} ms ({phases})"
+
+
+profile = StartupProfile(api.IMPORT_STARTED)
+
+
+def import_times(module: str = 'api.main') -> List[Tuple[str, int, int]]:
+    """Import ``module`` in a new interpreter.
+
+    Returns:
+        list: (module, self µs, cumulative µs) of every module imported
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                               capture_output=True, text=True, cwd=os.getcwd())
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{completed.stderr[-2000:]}")
+    times = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def main(module: str = 'api.main', top: int = 25):
+    times = import_times(module)
+    total = next(cumulative for name, _, cumulative in reversed(times) if name == module)
+    print(f"import {module}: {total / 1000:.0f} ms, {len(times)} modules")
+    print(f"{'cumulative ms':>14} {'self ms':>8}  module")
+    for name, self_us, cumulative_us in sorted(times, key=lambda t: t[2], reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>8.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
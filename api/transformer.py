@@ -1,11 +1,12 @@
 """
 Data transformation module for sensor data processing.
 """
-import json
 from .models.air_data import SensorReading
+from . import encoding
 import logging
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from decimal import Decimal, InvalidOperation
+import numpy as np
 from attrs import define, field, validators
 
 
@@ -26,6 +27,75 @@ class ValidationRanges:
     pressure_max: float = field(default=1100.0, validator=validators.instance_of(float))
     humidity_min: float = field(default=0.0, validator=validators.instance_of(float))
     humidity_max: float = field(default=100.0, validator=validators.instance_of(float))
+    # optional fields, within the DECIMAL(6, 2) and SMALLINT columns
+    pm_min: float = field(default=0.0, validator=validators.instance_of(float))
+    pm_max: float = field(default=1000.0, validator=validators.instance_of(float))
+    signal_min: float = field(default=-150.0, validator=validators.instance_of(float))
+    signal_max: float = field(default=0.0, validator=validators.instance_of(float))
+
+    def checks(self) -> Tuple[Tuple[str, float, float], ...]:
+        """(field, min, max) of every range check, in the order they are reported.
+
+        Pressure is in hPa, after scaling. An out of range value of one of
+        ``NULLABLE_FIELDS`` is stored as NULL, any other fails the reading.
+        """
+        return (('Temperature', self.temp_min, self.temp_max),
+                ('Humidity', self.humidity_min, self.humidity_max),
+                ('Pressure', self.pressure_min, self.pressure_max),
+                ('PM10', self.pm_min, self.pm_max),
+                ('PM25', self.pm_min, self.pm_max),
+                ('Signal', self.signal_min, self.signal_max))
+
+
+@define(frozen=True)
+class ValueTypeSpec:
+    """Where a ``sensordatavalues`` entry goes in the transformed output."""
+    field: str
+    scale: Decimal = Decimal(1)
+    # lower wins when several sensors report the same field
+    priority: int = 0
+
+
+# airrohr firmware value_type names mapped to output fields
+DEFAULT_VALUE_TYPES: Dict[str, ValueTypeSpec] = {
+    'BME280_temperature': ValueTypeSpec('Temperature', priority=0),
+    'BME280_humidity': ValueTypeSpec('Humidity', priority=0),
+    'BME280_pressure': ValueTypeSpec('Pressure', scale=Decimal('0.01'), priority=0),
+    'BMP280_temperature': ValueTypeSpec('Temperature', priority=1),
+    'BMP280_pressure': ValueTypeSpec('Pressure', scale=Decimal('0.01'), priority=1),
+    'SHT3X_temperature': ValueTypeSpec('Temperature', priority=2),
+    'SHT3X_humidity': ValueTypeSpec('Humidity', priority=2),
+    'HTU21D_temperature': ValueTypeSpec('Temperature', priority=3),
+    'HTU21D_humidity': ValueTypeSpec('Humidity', priority=3),
+    'DHT22_temperature': ValueTypeSpec('Temperature', priority=4),
+    'DHT22_humidity': ValueTypeSpec('Humidity', priority=4),
+    'SDS_P1': ValueTypeSpec('PM10', priority=0),
+    'SDS_P2': ValueTypeSpec('PM25', priority=0),
+    'PMS_P1': ValueTypeSpec('PM10', priority=1),
+    'PMS_P2': ValueTypeSpec('PM25', priority=1),
+    'SPS30_P1': ValueTypeSpec('PM10', priority=2),
+    'SPS30_P2': ValueTypeSpec('PM25', priority=2),
+    'signal': ValueTypeSpec('Signal'),
+}
+
+REQUIRED_FIELDS = ('Temperature', 'Pressure', 'Humidity')
+# a bad PM or signal value doesn't reject the reading, but must not overflow
+# its column and fail the whole batched insert
+NULLABLE_FIELDS = ('PM10', 'PM25', 'Signal')
+TWO_PLACES = Decimal('0.01')
+MAX_LOOKUP_ENTRIES = 1024
+
+
+def _sensor_key(value_type: str) -> Tuple[str, str]:
+    """Split a value_type into (sensor, measurement), e.g. BME280_pressure -> (BME280, pressure).
+
+    Firmware housekeeping values such as ``signal`` or ``min_micro`` are
+    grouped under ``device``.
+    """
+    sensor, sep, measurement = value_type.partition('_')
+    if sep and sensor.isupper():
+        return sensor, measurement
+    return 'device', value_type
 
 
 @define
@@ -34,6 +104,23 @@ class SensorDataTransformer:
 
     strict_mode: bool = field(default=True, validator=validators.instance_of(bool))
     ranges: ValidationRanges = field(factory=ValidationRanges)
+    value_types: Dict[str, ValueTypeSpec] = field(factory=lambda: dict(DEFAULT_VALUE_TYPES))
+    required_fields: Tuple[str, ...] = field(default=REQUIRED_FIELDS)
+    # value_type -> (spec or None, sensor, measurement), filled once per name
+    _lookup: Dict[str, Tuple[Optional[ValueTypeSpec], str, str]] = field(init=False, factory=dict)
+
+    def __attrs_post_init__(self):
+        for value_type in self.value_types:
+            self._resolve(value_type)
+
+    def _resolve(self, value_type: str) -> Tuple[Optional[ValueTypeSpec], str, str]:
+        entry = self._lookup.get(value_type)
+        if entry is None:
+            entry = (self.value_types.get(value_type), *_sensor_key(value_type))
+            # names come from the client, don't let unknown ones grow the cache forever
+            if len(self._lookup) < MAX_LOOKUP_ENTRIES:
+                self._lookup[value_type] = entry
+        return entry
 
     def _validate_value(self, value: float,
                         min_val: float,
@@ -61,7 +148,7 @@ class SensorDataTransformer:
             logger.warning(msg)
             return False
 
-        if not isinstance(value, (int, float)):
+        if not isinstance(value, (int, float, Decimal)):
             msg = f"{field_name} is not numeric: {type(value)}"
             if self.strict_mode:
                 raise DataQualityError(msg)
@@ -77,32 +164,45 @@ class SensorDataTransformer:
 
         return True
 
-    def _safe_extract_value(self,
-                            data: 'SensorReading',
-                            index: int,
-                            field_name: str) -> Optional[float]:
+    def _extract_values(self, data: 'SensorReading') -> Tuple[Dict[str, Decimal], Dict[str, dict]]:
         """
-        Safely extract value from sensordatavalues array.
+        Extract every value of the sensordatavalues array in one pass, by value_type name.
+
         Args:
             data: Sensor data model
-            index: Index in sensordatavalues array
-            field_name: Name of field for error messages
 
         Returns:
-            float or None: Extracted value or None if extraction fails
+            tuple: Mapped output fields (scaled Decimals) and the readings of
+            every sensor, known or not, grouped by sensor type
+
+        Raises:
+            DataQualityError: If strict_mode=True and a mapped value is not numeric
         """
-        try:
-            if not data.sensordatavalues or len(data.sensordatavalues) <= index:
-                raise IndexError(f"Index {index} out of range")
+        fields: Dict[str, Tuple[int, Decimal]] = {}
+        sensors: Dict[str, dict] = {}
+        for item in data.sensordatavalues or ():
+            spec, sensor, measurement = self._resolve(item.value_type)
+            try:
+                number = Decimal(item.value)
+                if not number.is_finite():
+                    raise InvalidOperation(item.value)
+            except (InvalidOperation, TypeError, ValueError):
+                number = None
+            sensors.setdefault(sensor, {})[measurement] = number if number is not None else item.value
+
+            if spec is None:
+                continue
+            if number is None:
+                msg = f"Failed to extract {spec.field} from {item.value_type}: {item.value!r}"
+                if self.strict_mode:
+                    raise DataQualityError(msg)
+                logger.error(msg)
+                continue
+            current = fields.get(spec.field)
+            if current is None or spec.priority < current[0]:
+                fields[spec.field] = (spec.priority, number * spec.scale)
 
-            value = data.sensordatavalues[index].value
-            return float(value)
-        except (IndexError, AttributeError, ValueError, TypeError) as e:
-            msg = f"Failed to extract {field_name} at index {index}: {e}"
-            if self.strict_mode:
-                raise DataQualityError(msg)
-            logger.error(msg)
-            return None
+        return {name: value for name, (_, value) in fields.items()}, sensors
 
     def transform_to_dict(self,
                           data: 'SensorReading') -> Optional[dict]:
@@ -110,71 +210,158 @@ class SensorDataTransformer:
         Transform sensor data model to a dictionary with extracted values.
         Includes data quality validation.
 
+        Values are looked up by value_type name, so reordered or missing
+        sensordatavalues entries never end up in the wrong column.
+
         Args:
             data: Sensor data model object with sensordatavalues array
 
         Returns:
-            dict: Transformed data with Temperature, Pressure, Humidity, and RawData
+            dict: Transformed data with DeviceId, Temperature, Pressure, Humidity,
+            PM10, PM25, Signal, the per-sensor readings and RawData
             None: If validation fails and strict_mode=False
 
         Raises:
             DataQualityError: If validation fails and strict_mode=True
         """
         try:
-            # Extract raw JSON for storage
-            sensor_data = data.model_dump_json()
-            sensor_data_json = json.loads(sensor_data)
-
-            # Extract and validate Temperature
-            temp = self._safe_extract_value(data, 2, 'Temperature')
-            if temp is not None:
-                self._validate_value(temp,
-                                     self.ranges.temp_min,
-                                     self.ranges.temp_max, 'Temperature')
-
-            # Extract and validate Humidity
-            humidity = self._safe_extract_value(data, 4, 'Humidity')
-            if humidity is not None:
-                self._validate_value(humidity,
-                                     self.ranges.humidity_min,
-                                     self.ranges.humidity_max, 'Humidity')
-
-            # Extract and validate Pressure (convert from Pa to hPa)
-            pressure_raw = self._safe_extract_value(data, 3, 'Pressure')
-            if pressure_raw is not None:
-                pressure = pressure_raw / 100.0
-                self._validate_value(pressure,
-                                     self.ranges.pressure_min,
-                                     self.ranges.pressure_max, 'Pressure')
-            else:
-                pressure = None
+            # Serialize the raw payload once, embedded as-is in MQTT and SQL
+            raw_data = encoding.raw_json(data.model_dump_json())
+
+            values, sensors = self._extract_values(data)
+
+            for name, min_val, max_val in self.ranges.checks():
+                if name not in values:
+                    continue
+                if name not in NULLABLE_FIELDS:
+                    self._validate_value(values[name], min_val, max_val, name)
+                elif not (min_val <= values[name] <= max_val):
+                    self._drop_value(values, name, min_val, max_val)
 
             # Check if all required values are present
-            if None in (temp, humidity, pressure):
-                msg = "Missing required sensor values"
+            missing = [name for name in self.required_fields if name not in values]
+            if missing:
+                msg = f"Missing required sensor values: {', '.join(missing)}"
                 if self.strict_mode:
                     raise DataQualityError(msg)
                 logger.warning(msg)
                 return None
 
-            # Convert to Decimal for database precision (matches SQL DECIMAL types)
-            result_dict = {
-                'Temperature': round(Decimal(str(temp)), 2),
-                'Pressure': round(Decimal(str(pressure)), 2),
-                'Humidity': round(Decimal(str(humidity)), 2),
-                'RawData': sensor_data_json
-            }
+            result_dict = self._build_result(data.esp8266id, values, sensors, raw_data)
 
             logger.debug(f"Successfully transformed sensor data: {result_dict}")
             return result_dict
 
-        except (json.JSONDecodeError, InvalidOperation) as e:
+        except InvalidOperation as e:
             msg = f"Data transformation error: {e}"
             if self.strict_mode:
                 raise DataQualityError(msg)
             logger.error(msg)
             return None
 
+    def transform_batch(self,
+                        readings: List['SensorReading']) -> Tuple[List[dict], np.ndarray]:
+        """
+        Transform a batch of readings with vectorized range checks.
+
+        Values are extracted once per reading into columnar arrays and every
+        ValidationRanges check runs as a NumPy mask over the whole batch. A
+        row is rejected where transform_to_dict would raise DataQualityError
+        (strict_mode=True) or return None (strict_mode=False); in lenient
+        mode out-of-range values are logged and the row is kept, as today.
+        Out-of-range PM and signal values are left out (NULL) in both modes.
+
+        Args:
+            readings: Validated sensor data models
+
+        Returns:
+            tuple: Transformed dicts of the accepted rows, in input order, and
+            an array with one rejection reason per input row ('' if accepted)
+        """
+        n = len(readings)
+        checks = self.ranges.checks()
+        column_names = dict.fromkeys([name for name, _, _ in checks] + list(self.required_fields))
+        columns = {name: np.full(n, np.nan) for name in column_names}
+        reasons = np.full(n, '', dtype=object)
+        extracted = [None] * n
+
+        for i, reading in enumerate(readings):
+            try:
+                values, sensors = self._extract_values(reading)
+            except DataQualityError as e:
+                reasons[i] = str(e)
+                continue
+            extracted[i] = (values, sensors)
+            for name, column in columns.items():
+                if name in values:
+                    column[i] = float(values[name])
+        extracted_ok = reasons == ''
+
+        # missing values are checked last in transform_to_dict, so range failures overwrite them
+        missing = np.zeros((len(self.required_fields), n), dtype=bool)
+        for row, name in enumerate(self.required_fields):
+            missing[row] = np.isnan(columns[name])
+        for i in np.flatnonzero(missing.any(axis=0) & extracted_ok):
+            names = [name for row, name in enumerate(self.required_fields) if missing[row, i]]
+            reasons[i] = f"Missing required sensor values: {', '.join(names)}"
+
+        # NaN compares False both ways, so missing values never count as out of range
+        out_of_range = {name: (columns[name] < min_val) | (columns[name] > max_val)
+                        for name, min_val, max_val in checks}
+        for name, min_val, max_val in reversed(checks):
+            if name in NULLABLE_FIELDS:
+                continue
+            for i in np.flatnonzero(out_of_range[name] & extracted_ok):
+                msg = f"{name} out of range: {extracted[i][0][name]} (expected {min_val}-{max_val})"
+                if self.strict_mode:
+                    reasons[i] = msg
+                else:
+                    logger.warning(msg)
+
+        accepted = reasons == ''
+        for name, min_val, max_val in checks:
+            if name in NULLABLE_FIELDS:
+                for i in np.flatnonzero(out_of_range[name] & accepted):
+                    self._drop_value(extracted[i][0], name, min_val, max_val)
+
+        results = []
+        for i in np.flatnonzero(accepted):
+            values, sensors = extracted[i]
+            try:
+                result = self._build_result(readings[i].esp8266id, values, sensors, raw_data=None)
+            except (InvalidOperation, ValueError) as e:
+                # e.g. a value too large to round, rejects this row like transform_to_dict does
+                reasons[i] = f"Data transformation error: {e}"
+                continue
+            result['RawData'] = encoding.raw_json(readings[i].model_dump_json())
+            results.append(result)
+        return results, reasons
+
+    @staticmethod
+    def _drop_value(values: Dict[str, Decimal], name: str, min_val: float, max_val: float):
+        """Leave out an optional value outside its range, it is stored as NULL."""
+        logger.warning(f"{name} out of range: {values.pop(name)} (expected {min_val}-{max_val}), "
+                       f"stored as NULL")
+
+    def _build_result(self, device_id: str, values: Dict[str, Decimal],
+                      sensors: Dict[str, dict], raw_data) -> dict:
+        # Decimal keeps database precision (matches SQL DECIMAL types)
+        return {
+            'DeviceId': device_id,
+            'Temperature': self._round(values.get('Temperature')),
+            'Pressure': self._round(values.get('Pressure')),
+            'Humidity': self._round(values.get('Humidity')),
+            'PM10': self._round(values.get('PM10')),
+            'PM25': self._round(values.get('PM25')),
+            'Signal': int(values['Signal']) if 'Signal' in values else None,
+            'Sensors': sensors,
+            'RawData': raw_data
+        }
+
+    @staticmethod
+    def _round(value: Optional[Decimal]) -> Optional[Decimal]:
+        return None if value is None else value.quantize(TWO_PLACES)
+
     # future transformation palceholders
     def transform_to_csv(self, data) -> str:
         """Transform sensor data to CSV format."""
@@ -0,0 +1,56 @@
+"""
+Encode/decode passes per reading, before and after sharing one serialized form.
+
+"before" is the old hot path: model_dump_json -> json.loads for RawData in
+the transformer, then json.dumps(default=str) of the whole payload in the
+publisher. "after" serializes the model once, embeds it as an orjson
+fragment and encodes the payload once:
+
+    python -m benchmarks.bench_encoding [n_readings]
+"""
+import json
+import sys
+import time
+from decimal import Decimal
+from api import encoding
+from api.models.air_data import SensorReading
+
+SOURCE = 'api/models/source.json'
+
+
+def before(reading: SensorReading) -> bytes:
+    raw = json.loads(reading.model_dump_json())
+    payload = {'Temperature': Decimal('34.22'), 'Pressure': Decimal('1011.81'),
+               'Humidity': Decimal('22.82'), 'RawData': raw}
+    return json.dumps(payload, default=str).encode()
+
+
+def after(reading: SensorReading) -> bytes:
+    raw = encoding.raw_json(reading.model_dump_json())
+    payload = {'Temperature': Decimal('34.22'), 'Pressure': Decimal('1011.81'),
+               'Humidity': Decimal('22.82'), 'RawData': raw}
+    return encoding.dumps(payload)
+
+
+def timed(fn, reading: SensorReading, n: int) -> float:
+    started = time.perf_counter()
+    for _ in range(n):
+        fn(reading)
+    return time.perf_counter() - started
+
+
+def main(n: int = 20000):
+    with open(SOURCE) as fh:
+        reading = SensorReading(**json.load(fh))
+    assert json.loads(before(reading)) == json.loads(after(reading))
+
+    t_before = timed(before, reading, n)
+    t_after = timed(after, reading, n)
+    print(f"{n} readings")
+    print(f"  dump -> loads -> dumps: {t_before / n * 1e6:8.1f} us/reading")
+    print(f"  single encode:          {t_after / n * 1e6:8.1f} us/reading")
+    print(f"  speedup:                {t_before / t_after:8.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
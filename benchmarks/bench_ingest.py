@@ -0,0 +1,256 @@
+"""
+Throughput, latency and allocations of the ingest pipeline, per stage and end to end.
+
+Stages are timed one call at a time on synthetic readings:
+
+    validate   SensorReading.model_validate_json on the request body
+    transform  SensorDataTransformer.transform_to_dict
+    encode     the MQTT payload encoding (encoding.dumps)
+    publish    MQTTPublisher.publish_payload, enqueue only
+    store      AsyncSQLClient.store_payload, buffer only
+    insert     SQLClient.insert_rows, per row of a 100-row batch
+
+The HTTP scenarios post to the app through an in-process ASGI client,
+with a stand-in MQTT client that acknowledges every message and a
+temporary SQLite database, so nothing leaves the machine:
+
+    python -m benchmarks.bench_ingest                 # report
+    python -m benchmarks.bench_ingest --save          # write benchmarks/baseline.json
+    python -m benchmarks.bench_ingest --compare       # exit 1 on a regression
+
+Timings depend on the machine, save a baseline on the one you compare on.
+"""
+import os
+import sys
+import json
+import logging
+import time
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+import warnings
+from statistics import quantiles
+from unittest import mock
+from benchmarks.stand_ins import FakeMQTTClient, use_fake_broker, use_sqlite
+from benchmarks.synthetic import batches, payloads
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# gated metrics and how much worse than the baseline they may get,
+# --tolerance overrides the two timings
+TOLERANCES = {'ops_per_s': 0.30, 'p50_us': 0.30, 'alloc_bytes': 0.10}
+
+
+def summarize(latencies_ns: list, elapsed_s: float, ops: int, alloc_bytes: float) -> dict:
+    cuts = quantiles(latencies_ns, n=100, method='inclusive')
+    return {
+        'ops_per_s': round(ops / elapsed_s, 1),
+        'p50_us': round(cuts[49] / 1000, 2),
+        'p99_us': round(cuts[98] / 1000, 2),
+        'alloc_bytes': round(alloc_bytes),
+    }
+
+
+def peak_allocation(fn, args_list: list) -> float:
+    """Mean of the peak traced memory per call, over a sample of calls."""
+    sample = args_list[:200]
+    tracemalloc.start()
+    total = 0
+    for args in sample:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        fn(*args)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / len(sample)
+
+
+def bench_sync(fn, args_list: list) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    for args in args_list:
+        t0 = time.perf_counter_ns()
+        fn(*args)
+        latencies.append(time.perf_counter_ns() - t0)
+    elapsed = time.perf_counter() - started
+    return summarize(latencies, elapsed, len(args_list), peak_allocation(fn, args_list))
+
+
+async def bench_async(fn, args_list: list) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    for args in args_list:
+        t0 = time.perf_counter_ns()
+        await fn(*args)
+        latencies.append(time.perf_counter_ns() - t0)
+        # let the background tasks drain, as they would between requests
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+    # allocations of the coroutine body, driven without the event loop in between
+    return summarize(latencies, elapsed, len(args_list),
+                     peak_allocation(lambda *a: _drive(fn(*a)), args_list))
+
+
+def _drive(coro):
+    try:
+        coro.send(None)
+    except StopIteration:
+        pass
+    else:
+        coro.close()
+
+
+async def bench_stages(n: int) -> dict:
+    from api import encoding
+    from api.models.air_data import SensorReading
+    from api.routers import sensor_readings as ingest
+
+    bodies = [json.dumps(payload).encode() for payload in payloads(n, seed=1)]
+    readings = [SensorReading.model_validate_json(body) for body in bodies]
+    results = [ingest.transformer.transform_to_dict(reading) for reading in readings]
+
+    stages = {
+        'validate': bench_sync(SensorReading.model_validate_json, [(body,) for body in bodies]),
+        'transform': bench_sync(ingest.transformer.transform_to_dict, [(r,) for r in readings]),
+        'encode': bench_sync(encoding.dumps, [(result,) for result in results]),
+        'publish': await bench_async(ingest.mqtt_publisher.publish_payload,
+                                     [(result,) for result in results]),
+        'store': await bench_async(ingest.sql_agent.store_payload, [(result,) for result in results]),
+    }
+    # the enqueued messages and rows are written by the background tasks meanwhile
+    await ingest.sql_agent.flush()
+
+    rows = list(batches(results, 100))
+    insert = bench_sync(ingest.sql_agent.sql_client.insert_rows, [(batch,) for batch in rows])
+    per_row = len(results) / len(rows)
+    stages['insert'] = {
+        'ops_per_s': round(insert['ops_per_s'] * per_row, 1),
+        'p50_us': round(insert['p50_us'] / per_row, 2),
+        'p99_us': round(insert['p99_us'] / per_row, 2),
+        'alloc_bytes': round(insert['alloc_bytes'] / per_row),
+    }
+    return stages
+
+
+async def drain():
+    """Wait until everything accepted so far is published and written."""
+    from api.routers import sensor_readings as ingest
+
+    await ingest.mqtt_publisher._queue.join()
+    await ingest.sql_agent.flush()
+
+
+async def bench_http(client, path: str, bodies: list, concurrency: int,
+                     readings_per_body: int, headers: dict) -> dict:
+    latencies = []
+    pending = iter(bodies)
+
+    async def worker():
+        for body in pending:
+            t0 = time.perf_counter_ns()
+            response = await client.post(path, content=body, headers=headers, auth=('', ''))
+            latencies.append(time.perf_counter_ns() - t0)
+            if response.status_code != 200:
+                raise RuntimeError(f"{path} answered {response.status_code}: {response.text[:200]}")
+            # the in-process transport never waits on a socket, yield like a server would
+            await asyncio.sleep(0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    # sustained throughput: the backlog left in the queues counts too
+    await drain()
+    elapsed = time.perf_counter() - started
+    # readings per second, latency per request
+    return summarize(latencies, elapsed, len(bodies) * readings_per_body, 0)
+
+
+async def bench_end_to_end(n: int, concurrency: int) -> dict:
+    import httpx
+    from api.main import app
+
+    single = [json.dumps(payload).encode() for payload in payloads(n, seed=2)]
+    batch = [json.dumps(chunk).encode() for chunk in batches(payloads(n, seed=3), 100)]
+    headers = {'Content-Type': 'application/json'}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        return {
+            'http_single': await bench_http(client, '/sensor-data', single, concurrency, 1, headers),
+            'http_batch': await bench_http(client, '/sensor-data/batch', batch,
+                                           max(1, concurrency // 8), 100, headers),
+        }
+
+
+async def run(n: int, concurrency: int) -> dict:
+    from api.main import app, lifespan
+
+    with mock.patch('paho.mqtt.client.Client', FakeMQTTClient):
+        async with lifespan(app):
+            results = await bench_stages(n)
+            results.update(await bench_end_to_end(n, concurrency))
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerances: dict) -> list:
+    regressions = []
+    for name, base in baseline.items():
+        current = results.get(name)
+        if current is None:
+            continue
+        for metric, tolerance in tolerances.items():
+            if not base.get(metric):
+                continue
+            change = current[metric] / base[metric] - 1
+            worse = -change if metric == 'ops_per_s' else change
+            if worse > tolerance:
+                regressions.append(f"{name}.{metric}: {base[metric]} -> {current[metric]} "
+                                   f"({change:+.0%}, tolerance {tolerance:.0%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-n', type=int, default=5000, help="readings per stage and scenario")
+    parser.add_argument('-c', '--concurrency', type=int, default=32, help="concurrent HTTP clients")
+    parser.add_argument('--save', action='store_true', help=f"write the results to {BASELINE}")
+    parser.add_argument('--compare', action='store_true', help="fail if worse than the baseline")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCES['ops_per_s'],
+                        help="allowed slowdown in throughput and p50 latency, as a fraction")
+    args = parser.parse_args(argv)
+
+    use_fake_broker()
+    # measure throughput, not the 503s of the default queue bound under a burst
+    os.environ.setdefault('MQTT_QUEUE_MAXSIZE', '1000000')
+    warnings.filterwarnings('ignore')  # SQLite has no native Decimal
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        use_sqlite(os.path.join(tmp, 'bench.db'))
+        results = asyncio.run(run(args.n, args.concurrency))
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as fh:
+            baseline = json.load(fh)
+    print(f"{'stage':<12} {'ops/s':>11} {'p50 us':>9} {'p99 us':>9} {'alloc B':>9}  vs baseline ops/s")
+    for name, stats in results.items():
+        base = baseline.get(name, {}).get('ops_per_s')
+        delta = f"{stats['ops_per_s'] / base - 1:+.0%}" if base else '-'
+        print(f"{name:<12} {stats['ops_per_s']:>11,.0f} {stats['p50_us']:>9.1f} "
+              f"{stats['p99_us']:>9.1f} {stats['alloc_bytes']:>9,}  {delta}")
+
+    if args.save:
+        with open(BASELINE, 'w') as fh:
+            json.dump(results, fh, indent=2)
+            fh.write('\n')
+        print(f"baseline saved to {BASELINE}")
+    if args.compare:
+        tolerances = dict(TOLERANCES, ops_per_s=args.tolerance, p50_us=args.tolerance)
+        regressions = compare(results, baseline, tolerances)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Per-insert cost of the SQL write path, before and after caching the schema.
+
+"before" rebuilds WeatherData and runs metadata.create_all for every
+reading (the old SQLClient.store_payload); "after" reuses the table and the
+insert statement built once by SQLClient. Runs against in-memory SQLite so
+it needs no database server:
+
+    python -m benchmarks.bench_sql_insert [n_inserts]
+"""
+import sys
+import time
+import warnings
+from decimal import Decimal
+from api.models.db_model import WeatherData
+from api.rds import RDSConfig
+from api.sql_client import SQLClient
+
+
+ROW = {
+    'Temperature': Decimal('21.50'),
+    'Pressure': Decimal('1011.80'),
+    'Humidity': Decimal('45.10'),
+    'RawData': {'esp8266id': '6786729', 'sensordatavalues': []},
+}
+
+
+def sqlite_config() -> RDSConfig:
+    return RDSConfig(DB_DRIVER='sqlite', DB_DATABASE=':memory:')
+
+
+def insert_before(engine, n: int) -> float:
+    started = time.perf_counter()
+    for _ in range(n):
+        with engine.connect() as conn:
+            data_model = WeatherData(schema_name='dbo')
+            data_model.metadata.create_all(engine)
+            conn.execute(data_model.weather_data.insert(), ROW)
+            conn.commit()
+    return time.perf_counter() - started
+
+
+def insert_after(client: SQLClient, n: int) -> float:
+    started = time.perf_counter()
+    for _ in range(n):
+        client.insert_rows([ROW])
+    return time.perf_counter() - started
+
+
+def main(n: int = 2000):
+    warnings.filterwarnings('ignore')  # SQLite has no native Decimal
+
+    before_engine = sqlite_config().get_engine()
+    before = insert_before(before_engine, n)
+
+    client = SQLClient(rds_config=sqlite_config())
+    client.create_schema()
+    after = insert_after(client, n)
+
+    print(f"{n} single-row inserts")
+    print(f"  create_all per insert: {before / n * 1e6:8.1f} us/insert")
+    print(f"  cached schema:         {after / n * 1e6:8.1f} us/insert")
+    print(f"  speedup:               {before / after:8.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
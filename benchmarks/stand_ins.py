@@ -0,0 +1,106 @@
+"""
+Local stand-ins for the MQTT broker and the database.
+
+``FakeMQTTClient`` replaces paho's client: ``publish`` returns at once and a
+separate thread sends the PUBACKs back through ``on_publish``, like paho's
+network thread does. ``use_sqlite`` points the SQL client at a SQLite
+database file.
+"""
+import os
+import queue
+import threading
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+from paho.mqtt.enums import CallbackAPIVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.reasoncodes import ReasonCode
+
+
+def use_sqlite(path: str):
+    """Point RDSConfig at a SQLite file, before the API modules are imported.
+
+    A file rather than ``:memory:``, whose single shared connection can't
+    take the concurrent flushes of the writer threads.
+    """
+    os.environ['DB_DRIVER'] = 'sqlite'
+    os.environ['DB_DATABASE'] = path
+
+
+def use_fake_broker():
+    """Make MQTTPublisher.connect go ahead, it skips MQTT without a broker address."""
+    os.environ['BROKER_HIVE'] = 'localhost'
+
+
+class _MessageInfo:
+    __slots__ = ('rc', 'mid')
+
+    def __init__(self, mid: int):
+        self.rc = MQTT_ERR_SUCCESS
+        self.mid = mid
+
+
+class _ConnectFlags:
+    session_present = False
+
+
+class FakeMQTTClient:
+    """The subset of ``paho.mqtt.client.Client`` that MQTTPublisher uses."""
+
+    def __init__(self, callback_api_version=CallbackAPIVersion.VERSION2, client_id='', protocol=None):
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.published = 0
+        self.bytes_published = 0
+        self._mid = 0
+        self._lock = threading.Lock()
+        self._acks: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = None
+
+    def tls_set(self, **kwargs):
+        pass
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def max_queued_messages_set(self, queue_size):
+        pass
+
+    def connect_async(self, host, port=1883, keepalive=60, **kwargs):
+        pass
+
+    def loop_start(self):
+        self._thread = threading.Thread(target=self._network_loop, name='fake-mqtt', daemon=True)
+        self._thread.start()
+
+    def loop_stop(self):
+        if self._thread is not None:
+            self._acks.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def disconnect(self):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        with self._lock:
+            self._mid += 1
+            mid = self._mid
+        self.published += 1
+        self.bytes_published += len(payload)
+        self._acks.put(mid)
+        return _MessageInfo(mid)
+
+    def _network_loop(self):
+        self.on_connect(self, None, _ConnectFlags(), ReasonCode(PacketTypes.CONNACK, 'Success'), None)
+        success = ReasonCode(PacketTypes.PUBACK, 'Success')
+        while True:
+            mid = self._acks.get()
+            if mid is None:
+                return
+            self.on_publish(self, None, mid, success, None)
@@ -0,0 +1,40 @@
+"""
+Synthetic sensor payloads shaped like api/models/source.json.
+"""
+import random
+from typing import Iterator, List
+
+VALUE_TYPES = ('SDS_P1', 'SDS_P2', 'BME280_temperature', 'BME280_pressure',
+               'BME280_humidity', 'samples', 'min_micro', 'max_micro', 'interval', 'signal')
+
+
+def make_payload(i: int, rng: random.Random, devices: int = 100) -> dict:
+    """One reading as the firmware posts it; ``samples`` makes every payload unique."""
+    values = {
+        'SDS_P1': f"{rng.uniform(0, 80):.2f}",
+        'SDS_P2': f"{rng.uniform(0, 40):.2f}",
+        'BME280_temperature': f"{rng.uniform(-10, 40):.2f}",
+        'BME280_pressure': f"{rng.uniform(95000, 104000):.2f}",
+        'BME280_humidity': f"{rng.uniform(10, 95):.2f}",
+        'samples': str(5000000 + i),
+        'min_micro': str(rng.randint(20, 40)),
+        'max_micro': str(rng.randint(15000, 25000)),
+        'interval': '145000',
+        'signal': str(rng.randint(-90, -40)),
+    }
+    return {
+        'esp8266id': str(6786000 + i % devices),
+        'software_version': 'NRZ-2024-135',
+        'sensordatavalues': [{'value_type': name, 'value': values[name]} for name in VALUE_TYPES],
+    }
+
+
+def payloads(n: int, seed: int = 0, devices: int = 100) -> List[dict]:
+    """``n`` reproducible payloads spread over ``devices`` sensors."""
+    rng = random.Random(seed)
+    return [make_payload(i, rng, devices) for i in range(n)]
+
+
+def batches(items: List[dict], size: int) -> Iterator[List[dict]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
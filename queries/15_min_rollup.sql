@@ -0,0 +1,14 @@
+-- 15-minute temperature buckets from the rollup table written by the API,
+-- instead of aggregating the raw WeatherData rows on every run
+SELECT
+    [WindowStart] AS TimeBucket,
+    SUM([Count]) AS RecordCount,
+    SUM([MeanValue] * [Count]) / SUM([Count]) AS AvgTemperature,
+    MIN([MinValue]) AS MinTemperature,
+    MAX([MaxValue]) AS MaxTemperature
+FROM [dbo].[WeatherRollup]
+WHERE [WindowSeconds] = 900
+  AND [Metric] = 'Temperature'
+  AND [WindowStart] > '2026-01-01'
+GROUP BY [WindowStart]
+ORDER BY TimeBucket DESC;
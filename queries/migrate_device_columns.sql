@@ -0,0 +1,57 @@
+-- Adds the typed device, PM and signal columns to an existing WeatherData
+-- table and backfills them from RawData. New databases get them from
+-- `python -m api.sql_client`; run this once on databases created before.
+
+IF COL_LENGTH('dbo.WeatherData', 'DeviceId') IS NULL
+    ALTER TABLE [dbo].[WeatherData] ADD
+        [DeviceId] VARCHAR(32) NULL,
+        [PM10] DECIMAL(6, 2) NULL,
+        [PM25] DECIMAL(6, 2) NULL,
+        [Signal] SMALLINT NULL;
+GO
+
+-- RawData becomes optional (DB_STORE_RAW_DATA=false)
+ALTER TABLE [dbo].[WeatherData] ALTER COLUMN [RawData] NVARCHAR(MAX) NULL;
+GO
+
+-- one pass over the old rows, batched to keep the log small
+DECLARE @batch INT = 10000;
+WHILE 1 = 1
+BEGIN
+    UPDATE TOP (@batch) w
+    SET [DeviceId] = JSON_VALUE(w.[RawData], '$.esp8266id'),
+        [PM10] = v.[PM10],
+        [PM25] = v.[PM25],
+        [Signal] = v.[Signal]
+    FROM [dbo].[WeatherData] w
+    OUTER APPLY (
+        SELECT
+            -- same sensor priority as the transformer: SDS, then PMS, then SPS30
+            COALESCE(MAX(CASE WHEN [value_type] = 'SDS_P1' THEN TRY_CAST([value] AS DECIMAL(6, 2)) END),
+                     MAX(CASE WHEN [value_type] = 'PMS_P1' THEN TRY_CAST([value] AS DECIMAL(6, 2)) END),
+                     MAX(CASE WHEN [value_type] = 'SPS30_P1' THEN TRY_CAST([value] AS DECIMAL(6, 2)) END)) AS [PM10],
+            COALESCE(MAX(CASE WHEN [value_type] = 'SDS_P2' THEN TRY_CAST([value] AS DECIMAL(6, 2)) END),
+                     MAX(CASE WHEN [value_type] = 'PMS_P2' THEN TRY_CAST([value] AS DECIMAL(6, 2)) END),
+                     MAX(CASE WHEN [value_type] = 'SPS30_P2' THEN TRY_CAST([value] AS DECIMAL(6, 2)) END)) AS [PM25],
+            MAX(CASE WHEN [value_type] = 'signal'
+                     THEN TRY_CAST([value] AS SMALLINT) END) AS [Signal]
+        FROM OPENJSON(w.[RawData], '$.sensordatavalues')
+             WITH ([value_type] NVARCHAR(64), [value] NVARCHAR(64))
+    ) v
+    WHERE w.[DeviceId] IS NULL AND w.[RawData] IS NOT NULL;
+
+    IF @@ROWCOUNT < @batch BREAK;
+END
+GO
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_weatherdata_device_timestamp')
+    CREATE INDEX [ix_weatherdata_device_timestamp]
+        ON [dbo].[WeatherData] ([DeviceId], [Timestamp]);
+GO
+
+-- Optional, for large tables that are mostly scanned by time range:
+-- a nonclustered columnstore index compresses the typed columns and serves
+-- aggregates like queries/15_min_agg.sql without reading RawData.
+-- CREATE NONCLUSTERED COLUMNSTORE INDEX [ncci_weatherdata]
+--     ON [dbo].[WeatherData] ([Timestamp], [DeviceId], [Temperature], [Pressure],
+--                             [Humidity], [PM10], [PM25], [Signal]);
@@ -0,0 +1,8 @@
+-- Adds the Quality column (measurements flagged as outliers, see
+-- QUALITY_ACTION) to an existing WeatherData table. New databases get it
+-- from `python -m api.sql_client`; run this once on databases created before.
+-- Rows written before stay NULL, i.e. not checked.
+
+IF COL_LENGTH('dbo.WeatherData', 'Quality') IS NULL
+    ALTER TABLE [dbo].[WeatherData] ADD [Quality] VARCHAR(64) NULL;
+GO
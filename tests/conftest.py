@@ -0,0 +1,51 @@
+import os
+import copy
+import json
+import tempfile
+from unittest import mock
+import pytest
+from benchmarks.stand_ins import FakeMQTTClient, use_fake_broker, use_sqlite
+
+# the API modules read their settings at import, so configure before importing them
+_db = tempfile.NamedTemporaryFile(prefix='sensor-api-test-', suffix='.db', delete=False)
+use_sqlite(_db.name)
+use_fake_broker()
+os.environ.pop('SPOOL_DIR', None)
+os.environ.pop('SINK_SOCKET', None)
+os.environ['DB_FLUSH_INTERVAL_MS'] = '20'
+
+SOURCE = os.path.join(os.path.dirname(__file__), os.pardir, 'api', 'models', 'source.json')
+AUTH = ('', '')
+
+
+@pytest.fixture
+def reading():
+    """The sample payload of api/models/source.json, a fresh copy per test."""
+    with open(SOURCE) as fh:
+        return json.load(fh)
+
+
+def with_value(reading: dict, value_type: str, value: str) -> dict:
+    reading = copy.deepcopy(reading)
+    for entry in reading['sensordatavalues']:
+        if entry['value_type'] == value_type:
+            entry['value'] = value
+    return reading
+
+
+@pytest.fixture
+def client():
+    """The app with its lifespan running against the stand-in broker and SQLite."""
+    from fastapi.testclient import TestClient
+    from api.main import app
+    from api.routers import sensor_readings
+    sensor_readings.dedup._entries.clear()
+    with mock.patch('paho.mqtt.client.Client', FakeMQTTClient):
+        with TestClient(app) as test_client:
+            test_client.auth = AUTH
+            yield test_client
+
+
+def pytest_sessionfinish(session, exitstatus):
+    _db.close()
+    os.unlink(_db.name)
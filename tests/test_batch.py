@@ -0,0 +1,61 @@
+from unittest import mock
+from api.routers import sensor_readings
+from .conftest import with_value
+
+
+def test_batch_accepts_valid_and_rejects_invalid(client, reading):
+    bad = with_value(reading, 'BME280_temperature', '500')
+    other = dict(reading, esp8266id='42')
+    response = client.post('/sensor-data/batch', json=[reading, bad, other])
+    assert response.status_code == 200
+    body = response.json()
+    assert body['status'] == 'partial'
+    assert (body['accepted'], body['rejected']) == (2, 1)
+    assert [result['status'] for result in body['results']] == ['accepted', 'rejected', 'accepted']
+
+
+def test_batch_retry_is_a_duplicate(client, reading):
+    client.post('/sensor-data/batch', json=[reading])
+    body = client.post('/sensor-data/batch', json=[reading]).json()
+    assert (body['accepted'], body['duplicates']) == (0, 1)
+
+
+def test_batch_retry_after_server_error_is_accepted(client, reading):
+    with mock.patch.object(sensor_readings, 'dispatch_local', side_effect=OSError("disk full")):
+        response = client.post('/sensor-data/batch', json=[reading])
+    assert response.status_code == 500
+
+    body = client.post('/sensor-data/batch', json=[reading]).json()
+    assert (body['accepted'], body['duplicates']) == (1, 0)
+
+
+def test_single_retry_after_server_error_is_accepted(client, reading):
+    with mock.patch.object(sensor_readings, 'dispatch_local', side_effect=OSError("disk full")):
+        assert client.post('/sensor-data', json=reading).status_code == 500
+    assert client.post('/sensor-data', json=reading).json()['status'] == 'success'
+
+
+def test_batch_rejects_only_the_row_that_cannot_be_transformed(client, reading):
+    huge = dict(with_value(reading, 'SDS_P1', '1e30'), esp8266id='43')
+    # without the PM range check, so the value reaches the rounding
+    with mock.patch.object(sensor_readings.transformer.ranges, 'pm_max', 1e40):
+        response = client.post('/sensor-data/batch', json=[reading, huge])
+    assert response.status_code == 200
+    body = response.json()
+    assert [result['status'] for result in body['results']] == ['accepted', 'rejected']
+    assert 'transformation error' in body['results'][1]['error']
+
+
+def test_out_of_range_optional_values_are_stored_as_null(client, reading):
+    glitch = with_value(with_value(reading, 'SDS_P1', '123456'), 'signal', '99999999')
+    data = client.post('/sensor-data', json=glitch).json()['data']
+    assert (data['PM10'], data['Signal']) == (None, None)
+    assert data['PM25'] == 5.15
+
+
+def test_device_id_longer_than_the_column_is_rejected(client, reading):
+    too_long = dict(reading, esp8266id='1' * 33)
+    assert client.post('/sensor-data', json=too_long).status_code == 422
+    body = client.post('/sensor-data/batch', json=[too_long, dict(reading, esp8266id='2' * 32)]).json()
+    assert [result['status'] for result in body['results']] == ['rejected', 'accepted']
+    assert 'esp8266id' in body['results'][0]['error']
@@ -0,0 +1,57 @@
+from api.change_filter import ChangeFilter
+
+
+def _reading(**values) -> dict:
+    reading = {'Temperature': 20.0, 'Pressure': 1000.0, 'Humidity': 50.0, 'PM10': None, 'PM25': None}
+    reading.update(values)
+    return reading
+
+
+def test_deadband_compares_with_the_last_reading_that_passed():
+    change_filter = ChangeFilter(deadbands={'Temperature': 0.5}, min_interval=0, max_interval=0)
+    assert change_filter.check('a', _reading(), now=0)
+    assert not change_filter.check('a', _reading(Temperature=20.3), now=1)
+    # drift adds up against 20.0, not against the suppressed 20.3
+    assert change_filter.check('a', _reading(Temperature=20.6), now=2)
+    assert not change_filter.check('a', _reading(Temperature=20.2), now=3)
+
+
+def test_measurements_without_a_deadband_are_not_compared():
+    change_filter = ChangeFilter(deadbands={'Temperature': 0.5}, min_interval=0, max_interval=0)
+    assert change_filter.check('a', _reading(), now=0)
+    assert not change_filter.check('a', _reading(Pressure=1050.0), now=1)
+
+
+def test_a_measurement_appearing_is_a_change():
+    change_filter = ChangeFilter(deadbands={'PM10': 5}, min_interval=0, max_interval=0)
+    assert change_filter.check('a', _reading(), now=0)
+    assert not change_filter.check('a', _reading(), now=1)
+    assert change_filter.check('a', _reading(PM10=1.0), now=2)
+    assert change_filter.check('a', _reading(), now=3)
+
+
+def test_intervals():
+    change_filter = ChangeFilter(deadbands={'Temperature': 0.5}, min_interval=10, max_interval=60)
+    assert change_filter.check('a', _reading(), now=0)
+    assert not change_filter.check('a', _reading(Temperature=30.0), now=5)
+    assert change_filter.check('a', _reading(Temperature=30.0), now=10)
+    assert not change_filter.check('a', _reading(Temperature=30.0), now=69)
+    assert change_filter.check('a', _reading(Temperature=30.0), now=70)
+
+
+def test_devices_are_independent_and_forget_keeps_the_others():
+    change_filter = ChangeFilter(deadbands={'Temperature': 0.5}, min_interval=0, max_interval=0)
+    for device, temperature in (('a', 10.0), ('b', 20.0), ('c', 30.0)):
+        assert change_filter.check(device, _reading(Temperature=temperature), now=0)
+    change_filter.forget('a')
+    assert change_filter.check('a', _reading(Temperature=10.0), now=1)
+    # 'c' moved into the freed row with its own state
+    assert not change_filter.check('c', _reading(Temperature=30.2), now=1)
+    assert change_filter.check('b', _reading(Temperature=21.0), now=1)
+
+
+def test_select_skips_readings_not_accepted():
+    change_filter = ChangeFilter(deadbands={'Temperature': 0.5}, min_interval=0, max_interval=0)
+    results = [dict(_reading(), DeviceId='a'), dict(_reading(), DeviceId='b')]
+    assert change_filter.select(results, [False, True], now=0) == [False, True]
+    assert change_filter.check('a', _reading(), now=1)
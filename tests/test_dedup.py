@@ -0,0 +1,49 @@
+import pytest
+from api.dedup import DedupIndex
+from api.models.air_data import SensorReading
+from .conftest import with_value
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Monotonic time of the index, advanced by the test."""
+    now = [1000.0]
+    monkeypatch.setattr('api.dedup.time.monotonic', lambda: now[0])
+    return now
+
+
+def test_retry_in_the_next_bucket_is_a_duplicate(reading, clock):
+    index = DedupIndex(window=60, max_entries=100)
+    sensor = SensorReading(**reading)
+    assert not index.check_and_add(index.key(sensor, now=119))
+    assert index.check_and_add(index.key(sensor, now=121))
+    # two buckets later the first post is no longer compared
+    assert not index.check_and_add(index.key(sensor, now=241))
+
+
+def test_keys_expire_after_two_windows(reading, clock):
+    index = DedupIndex(window=60, max_entries=100)
+    key = index.key(SensorReading(**reading), now=0)
+    assert not index.check_and_add(key)
+    clock[0] += 119
+    assert index.check_and_add(key)
+    clock[0] += 2
+    assert not index.check_and_add(key)
+
+
+def test_other_values_are_not_duplicates(reading, clock):
+    index = DedupIndex(window=60, max_entries=100)
+    assert not index.check_and_add(index.key(SensorReading(**reading), now=0))
+    changed = with_value(reading, 'SDS_P1', '11.00')
+    assert not index.check_and_add(index.key(SensorReading(**changed), now=0))
+
+
+def test_oldest_keys_are_evicted_and_discarded_keys_forgotten(reading, clock):
+    index = DedupIndex(window=60, max_entries=2)
+    keys = [index.key(SensorReading(**with_value(reading, 'SDS_P1', str(n))), now=0)
+            for n in range(3)]
+    for key in keys:
+        assert not index.check_and_add(key)
+    assert not index.check_and_add(keys[0])
+    index.discard(keys[2])
+    assert not index.check_and_add(keys[2])
@@ -0,0 +1,23 @@
+import asyncio
+from unittest import mock
+from benchmarks.stand_ins import FakeMQTTClient
+from api.publisher import MQTTPublisher
+
+
+def test_topic_aliases_are_off_without_paho_message_store(monkeypatch):
+    # the stand-in has no _out_messages, like a paho release that renamed it
+    monkeypatch.setenv('MQTT_TOPIC_ALIAS_MAX', '10')
+    publisher = MQTTPublisher()
+
+    async def scenario():
+        with mock.patch('paho.mqtt.client.Client', FakeMQTTClient):
+            assert await publisher.connect()
+        try:
+            return publisher._publish_target('sensors/6786729')
+        finally:
+            await publisher.close()
+
+    topic, properties = asyncio.run(scenario())
+    assert publisher.topic_alias_max == 0
+    assert topic == 'sensors/6786729'
+    assert getattr(properties, 'TopicAlias', None) is None
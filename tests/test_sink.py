@@ -0,0 +1,75 @@
+import asyncio
+from api.auth import RateLimiter
+from api.sink import SinkClient, SinkServer
+
+
+def test_workers_share_the_sink_rate_limit_and_events(tmp_path):
+    limiter = RateLimiter(rate=0.001, burst=2)
+    path = str(tmp_path / 'sink.sock')
+
+    async def scenario():
+        async def allow(device):
+            return limiter.acquire(device)
+
+        async def sampling(rate):
+            server.broadcast('sampling', rate)
+
+        server = SinkServer(path, handlers={'allow': allow, 'sampling': sampling})
+        await server.start()
+        workers = [SinkClient(path=path), SinkClient(path=path)]
+        rates = []
+        for worker in workers:
+            await worker.open()
+            worker.add_event_listener('sampling', rates.append)
+        try:
+            waits = [await worker.call('allow', 'device-1') for worker in workers * 2]
+            await workers[0].call('sampling', 0.25)
+            await asyncio.sleep(0.05)
+        finally:
+            for worker in workers:
+                await worker.close()
+            await server.close()
+        return waits, rates
+
+    waits, rates = asyncio.run(scenario())
+    # a burst of 2 for the device, however the requests are spread over the workers
+    assert [wait == 0 for wait in waits] == [True, True, False, False]
+    assert rates == [0.25, 0.25]
+
+
+def test_dispatch_keeps_its_order_without_waiting_for_durability(tmp_path):
+    path = str(tmp_path / 'sink.sock')
+
+    async def scenario():
+        order, synced = [], asyncio.get_running_loop().create_future()
+
+        async def finish(value):
+            await synced
+            return value
+
+        async def dispatch(value):
+            order.append(value)
+            return finish(value)
+
+        async def latest():
+            return len(order)
+
+        server = SinkServer(path, handlers={'dispatch': dispatch, 'latest': latest})
+        await server.start()
+        worker = SinkClient(path=path)
+        await worker.open()
+        try:
+            calls = [asyncio.ensure_future(worker.call('dispatch', n)) for n in range(3)]
+            # answered while every dispatch still waits for its fsync
+            seen = await asyncio.wait_for(worker.call('latest'), 1)
+            assert not any(call.done() for call in calls)
+            synced.set_result(None)
+            return order, seen, await asyncio.gather(*calls)
+        finally:
+            await worker.close()
+            await server.close()
+
+    order, seen, results = asyncio.run(scenario())
+    assert order == [0, 1, 2]
+    assert seen == 3
+    assert results == [0, 1, 2]
@@ -0,0 +1,233 @@
+import asyncio
+import threading
+from decimal import Decimal
+from unittest import mock
+import pytest
+from api.spool import PartialDelivery, Spool, decode_record, encode_record
+
+
+async def _drained(spool: Spool, name: str, timeout: float = 5.0):
+    """Wait until the sink ``name`` committed everything appended so far."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while spool._sinks[name].position != spool._synced:
+        assert loop.time() < deadline, f"{name} did not catch up"
+        await asyncio.sleep(0.01)
+
+
+def test_records_round_trip_with_exact_decimals():
+    record = {'DeviceId': '6786729', 'Temperature': Decimal('21.30'), 'Signal': -62}
+    assert decode_record(encode_record(record)) == record
+    assert decode_record(encode_record(record))['Temperature'].as_tuple().exponent == -2
+
+
+def test_replay_resumes_from_the_committed_offset(tmp_path):
+    delivered = []
+
+    async def deliver(records):
+        delivered.extend(record['n'] for record in records)
+
+    async def run(numbers):
+        spool = Spool(directory=str(tmp_path), fsync_interval_ms=1, replay_batch=2)
+        await spool.open()
+        await spool.append([{'n': n} for n in numbers])
+        spool.add_sink('sql', deliver)
+        await _drained(spool, 'sql')
+        await spool.close()
+
+    asyncio.run(run(range(5)))
+    assert delivered == [0, 1, 2, 3, 4]
+    # a restart replays only what was appended after the offset
+    asyncio.run(run(range(5, 7)))
+    assert delivered == [0, 1, 2, 3, 4, 5, 6]
+
+
+def test_failed_batch_is_delivered_again(tmp_path):
+    batches = []
+
+    async def deliver(records):
+        batches.append([record['n'] for record in records])
+        if len(batches) == 1:
+            raise ConnectionError("database paused")
+
+    async def scenario():
+        spool = Spool(directory=str(tmp_path), fsync_interval_ms=1)
+        await spool.open()
+        await spool.append([{'n': n} for n in range(3)])
+        spool.add_sink('sql', deliver)
+        await _drained(spool, 'sql')
+        await spool.close()
+
+    asyncio.run(scenario())
+    assert batches == [[0, 1, 2], [0, 1, 2]]
+
+
+def test_consumed_segments_are_deleted(tmp_path):
+    async def scenario():
+        sink_up = asyncio.Event()
+
+        async def deliver(records):
+            await sink_up.wait()
+
+        spool = Spool(directory=str(tmp_path), fsync_interval_ms=1, segment_bytes=64)
+        await spool.open()
+        spool.add_sink('mqtt', deliver)
+        for n in range(6):
+            await spool.append([{'n': n, 'padding': 'x' * 40}])
+        # two records per segment, kept until the sink has them
+        assert len(spool._segment_ids()) == 3
+        sink_up.set()
+        await _drained(spool, 'mqtt')
+        segments = spool._segment_ids()
+        current = spool._segment_id
+        await spool.close()
+        return segments, current
+
+    segments, current = asyncio.run(scenario())
+    assert segments == [current]
+
+
+def test_replay_resumes_after_the_delivered_prefix(tmp_path):
+    batches = []
+
+    async def deliver(records):
+        batches.append([record['n'] for record in records])
+        if len(batches) == 1:
+            raise PartialDelivery(2, ConnectionError("broker went away"))
+
+    async def scenario():
+        spool = Spool(directory=str(tmp_path), fsync_interval_ms=1)
+        await spool.open()
+        await spool.append([{'n': n} for n in range(5)])
+        spool.add_sink('mqtt', deliver)
+        await _drained(spool, 'mqtt')
+        end = spool._synced
+        await spool.close()
+        return end
+
+    end = asyncio.run(scenario())
+    assert batches == [[0, 1, 2, 3, 4], [2, 3, 4]]
+    assert Spool(directory=str(tmp_path))._load_offset('mqtt') == end
+
+
+def test_mqtt_delivery_reports_the_acknowledged_prefix():
+    from api.routers import sensor_readings
+
+    async def publish(record, wait_ack=False):
+        if record['n'] == 2:
+            raise ConnectionError("not acknowledged")
+        return True
+
+    with mock.patch.object(sensor_readings.mqtt_publisher, 'publish_payload', side_effect=publish):
+        with pytest.raises(PartialDelivery) as raised:
+            asyncio.run(sensor_readings.deliver_to_mqtt([{'n': n} for n in range(4)]))
+    assert raised.value.delivered == 2
+    assert isinstance(raised.value.cause, ConnectionError)
+
+
+def test_append_during_an_empty_read_wakes_the_replayer(tmp_path):
+    delivered = []
+    reading, appended = threading.Event(), threading.Event()
+    read_batch = Spool._read_batch
+
+    def slow_read(self, position):
+        batch = read_batch(self, position)
+        if not batch[0] and not appended.is_set():
+            # the append and its fsync land while this read is still running
+            reading.set()
+            appended.wait(5)
+        return batch
+
+    async def deliver(records):
+        delivered.extend(record['n'] for record in records)
+
+    async def scenario():
+        spool = Spool(directory=str(tmp_path), fsync_interval_ms=1)
+        await spool.open()
+        spool.add_sink('sql', deliver)
+        await asyncio.to_thread(reading.wait, 5)
+        await spool.append([{'n': 1}])
+        appended.set()
+        try:
+            await _drained(spool, 'sql', timeout=1.0)
+        finally:
+            await spool.close()
+
+    with mock.patch.object(Spool, '_read_batch', slow_read):
+        asyncio.run(scenario())
+    assert delivered == [1]
+
+
+def test_no_mqtt_replayer_without_a_broker(tmp_path):
+    from api.main import start_sinks, stop_sinks
+    from api.routers import sensor_readings
+
+    async def scenario():
+        await start_sinks()
+        try:
+            return sorted(sensor_readings.spool._sinks)
+        finally:
+            await stop_sinks()
+
+    with mock.patch.object(sensor_readings, 'spool', Spool(directory=str(tmp_path))), \
+            mock.patch.object(sensor_readings.mqtt_publisher, 'broker', ''):
+        assert asyncio.run(scenario()) == ['sql']
+
+
+def test_rotation_keeps_fsync_and_retention_off_the_event_loop(tmp_path):
+    on_loop = []
+    fsync, enforce_retention = Spool._fsync_fd, Spool._enforce_retention
+
+    def record_fsync(fd):
+        on_loop.append(('fsync', threading.current_thread() is threading.main_thread()))
+        fsync(fd)
+
+    def record_retention(self):
+        on_loop.append(('retention', threading.current_thread() is threading.main_thread()))
+        enforce_retention(self)
+
+    async def scenario():
+        spool = Spool(directory=str(tmp_path), fsync_interval_ms=1, segment_bytes=64)
+        await spool.open()
+        for n in range(4):
+            await spool.append([{'n': n, 'padding': 'x' * 40}])
+        synced = spool._synced
+        await spool.close()
+        return synced, spool._segment_id
+
+    with mock.patch.object(Spool, '_fsync_fd', staticmethod(record_fsync)), \
+            mock.patch.object(Spool, '_enforce_retention', record_retention):
+        synced, segment_id = asyncio.run(scenario())
+    assert ('retention', False) in on_loop
+    assert not any(main for _, main in on_loop)
+    assert synced[0] == segment_id
+
+
+def test_sink_frames_and_spool_records_share_one_format():
+    from datetime import datetime
+    from api.sink import decode_frame, encode_frame
+    row = {'Timestamp': datetime(2025, 5, 1, 12, 30), 'PM25': Decimal('5.15')}
+    assert encode_frame(row) == encode_record(row)
+    assert decode_record(encode_frame(row)) == row
+
+
+def test_enqueue_returns_before_the_fsync(tmp_path):
+    from api.routers import sensor_readings
+
+    async def scenario():
+        spool = Spool(directory=str(tmp_path), fsync_interval_ms=60000)
+        await spool.open()
+        try:
+            with mock.patch.object(sensor_readings, 'spool', spool):
+                first = await sensor_readings.enqueue_local([{'DeviceId': 'a', 'n': 1}])
+                second = await sensor_readings.enqueue_local([{'DeviceId': 'b', 'n': 2}])
+                pending = asyncio.gather(first, second)
+                await asyncio.sleep(0.01)
+                assert not pending.done()
+                # one fsync releases both groups
+                await spool._sync()
+                return await pending
+        finally:
+            await spool.close()
+
+    assert asyncio.run(scenario()) == [[True], [True]]
@@ -0,0 +1,24 @@
+from api.models.air_data import SensorReading
+from api.transformer import SensorDataTransformer
+from .conftest import with_value
+
+
+def test_batch_matches_single_transform(reading):
+    transformer = SensorDataTransformer()
+    payloads = [reading,
+                with_value(reading, 'SDS_P1', '123456'),
+                with_value(reading, 'signal', '12'),
+                with_value(reading, 'BME280_temperature', '500'),
+                with_value(with_value(reading, 'SDS_P2', '-1'), 'BME280_humidity', '101')]
+    readings = [SensorReading(**payload) for payload in payloads]
+    results, reasons = transformer.transform_batch(readings)
+    assert list(reasons == '') == [True, True, True, False, False]
+    assert reasons[3].startswith('Temperature out of range')
+    # an optional value doesn't hide the failing required one
+    assert reasons[4].startswith('Humidity out of range')
+    for reading, result in zip(readings[:3], results):
+        single = transformer.transform_to_dict(reading)
+        for name in ('Temperature', 'Pressure', 'Humidity', 'PM10', 'PM25', 'Signal'):
+            assert result[name] == single[name]
+    assert (results[1]['PM10'], results[2]['Signal']) == (None, None)
+